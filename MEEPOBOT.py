@@ -10,8 +10,15 @@ Basic motion library functions for driving robots
 
 import time
 import math
-import smbus2 as smbus
-from gpiozero import LED
+import threading
+from collections import OrderedDict
+from backend import smbus, LED
+from metrics import REGISTRY
+from servo import ServoTable
+
+# Bus transactions actually sent, by type, and how long each took
+I2C_WRITES = REGISTRY.counter('meepobot_i2c_writes_total', 'I2C write transactions sent to the PCA9685', ['kind'])
+I2C_SECONDS = REGISTRY.histogram('meepobot_i2c_write_seconds', 'Duration of one I2C write transaction')
 
 Dir = [
     'forward',
@@ -34,22 +41,81 @@ class PCA9685:
   __ALLLED_ON_H        = 0xFB
   __ALLLED_OFF_L       = 0xFC
   __ALLLED_OFF_H       = 0xFD
+  __MODE1_AI           = 0x20    # register auto-increment
+  __BLOCK_MAX          = 32      # SMBus block write limit in bytes
     
 
-  def __init__(self, address, debug=False):
+  def __init__(self, address, debug=False, autoincrement=True, cache=True):
     self.bus = smbus.SMBus(1)
     self.address = address
     self.debug = debug
+    self.autoincrement = autoincrement
+    # Shadow copy of the register file, None means the chip value is unknown
+    self.cache = cache
+    self.shadow = [None] * 256
+    self.writes_issued = 0
+    self.writes_suppressed = 0
+    # Actual PWM frequency from the prescaler, set by setPWMFreq
+    self.frequency = None
     if (self.debug):
       print("Reseting PCA9685")
-    self.write(self.__MODE1, 0x00)
+    # With auto-increment set, one transaction can fill a run of consecutive registers
+    self.write(self.__MODE1, self.__MODE1_AI if autoincrement else 0x00, force=True)
+
+  def invalidateCache(self):
+    "Forgets the shadow registers, call after the chip has been reset or power cycled"
+    self.shadow = [None] * 256
+
+  def cacheStats(self):
+    "Returns the number of I2C writes issued and suppressed by the shadow cache"
+    return {'issued': self.writes_issued, 'suppressed': self.writes_suppressed}
+
+  def reset(self):
+    "Software reset through the I2C general call address, then restores MODE1"
+    self.bus.write_byte(0x00, 0x06)
+    time.sleep(0.001)
+    self.invalidateCache()
+    self.write(self.__MODE1, self.__MODE1_AI if self.autoincrement else 0x00, force=True)
 
-  def write(self, reg, value):
+  def write(self, reg, value, force=False):
     "Writes an 8-bit value to the specified register/address"
+    if (self.cache and not force and self.shadow[reg] == value):
+      self.writes_suppressed += 1
+      return
+    start = time.perf_counter()
     self.bus.write_byte_data(self.address, reg, value)
+    I2C_SECONDS.observe(time.perf_counter() - start)
+    I2C_WRITES.labels('byte').inc()
+    self.shadow[reg] = value
+    self.writes_issued += 1
     if (self.debug):
       print("I2C: Write 0x%02X to register 0x%02X" % (value, reg))
 
+  def writeBlock(self, reg, data, force=False):
+    "Writes consecutive registers starting at reg in a single I2C transaction"
+    data = list(data)
+    if (self.cache and not force):
+      # Trim the burst down to the span of bytes that differ from the shadow
+      changed = [i for i, value in enumerate(data) if self.shadow[reg + i] != value]
+      if not changed:
+        self.writes_suppressed += 1
+        return
+      reg, data = reg + changed[0], data[changed[0]:changed[-1] + 1]
+    start = time.perf_counter()
+    if len(data) <= self.__BLOCK_MAX:
+      self.bus.write_i2c_block_data(self.address, reg, data)
+      kind = 'block'
+    else:
+      # Longer bursts do not fit an SMBus block write, send them as one raw I2C message
+      self.bus.i2c_rdwr(smbus.i2c_msg.write(self.address, [reg] + data))
+      kind = 'raw'
+    I2C_SECONDS.observe(time.perf_counter() - start)
+    I2C_WRITES.labels(kind).inc()
+    self.shadow[reg:reg + len(data)] = data
+    self.writes_issued += 1
+    if (self.debug):
+      print("I2C: Write %d bytes starting at register 0x%02X" % (len(data), reg))
+
   def read(self, reg):
     "Read an unsigned byte from the I2C device"
     result = self.bus.read_byte_data(self.address, reg)
@@ -69,26 +135,96 @@ class PCA9685:
     prescale = math.floor(prescaleval + 0.5)
     if (self.debug):
       print("Final pre-scale: %d" % prescale)
+    prescale = int(math.floor(prescale))
+    # The prescaler only gets close to the requested frequency (50 Hz comes out at 50.03 Hz)
+    self.frequency = 25000000.0 / 4096.0 / (prescale + 1)
+    if (self.cache and self.shadow[self.__PRESCALE] == prescale):
+      self.writes_suppressed += 1
+      return
 
-    oldmode = self.read(self.__MODE1)
-    newmode = (oldmode & 0x7F) | 0x10        # sleep
-    self.write(self.__MODE1, newmode)        # go to sleep
-    self.write(self.__PRESCALE, int(math.floor(prescale)))
-    self.write(self.__MODE1, oldmode)
+    oldmode = self.shadow[self.__MODE1]
+    if oldmode is None:
+      oldmode = self.read(self.__MODE1)
+    oldmode &= 0x7F
+    newmode = oldmode | 0x10                 # sleep
+    self.write(self.__MODE1, newmode, force=True)        # go to sleep
+    self.write(self.__PRESCALE, prescale, force=True)
+    self.write(self.__MODE1, oldmode, force=True)
     time.sleep(0.005)
-    self.write(self.__MODE1, oldmode | 0x80)
+    self.write(self.__MODE1, oldmode | 0x80, force=True)
+    # RESTART clears itself once the oscillator is running again
+    self.shadow[self.__MODE1] = oldmode
+
+  def _ledBytes(self, on, off):
+    return [on & 0xFF, on >> 8, off & 0xFF, off >> 8]
 
   def setPWM(self, channel, on, off):
     "Sets a single PWM channel"
-    self.write(self.__LED0_ON_L + 4*channel, on & 0xFF)
-    self.write(self.__LED0_ON_H + 4*channel, on >> 8)
-    self.write(self.__LED0_OFF_L + 4*channel, off & 0xFF)
-    self.write(self.__LED0_OFF_H + 4*channel, off >> 8)
+    if (self.autoincrement):
+      self.writeBlock(self.__LED0_ON_L + 4*channel, self._ledBytes(on, off))
+    else:
+      self.write(self.__LED0_ON_L + 4*channel, on & 0xFF)
+      self.write(self.__LED0_ON_H + 4*channel, on >> 8)
+      self.write(self.__LED0_OFF_L + 4*channel, off & 0xFF)
+      self.write(self.__LED0_OFF_H + 4*channel, off >> 8)
     if (self.debug):
       print("channel: %d  LED_ON: %d LED_OFF: %d" % (channel,on,off))
 
+  def setPWMRange(self, channel, values):
+    "Sets consecutive PWM channels from a list of (on, off) pairs in one burst"
+    if not (self.autoincrement):
+      for i, (on, off) in enumerate(values):
+        self.setPWM(channel + i, on, off)
+      return
+    data = []
+    for on, off in values:
+      data += self._ledBytes(on, off)
+    self.writeBlock(self.__LED0_ON_L + 4*channel, data)
+
+  def setPWMChannels(self, settings):
+    "Sets several channels from a {channel: (on, off)} dict, one burst per run of consecutive channels"
+    channels = sorted(settings)
+    start = 0
+    for i in range(1, len(channels) + 1):
+      if i == len(channels) or channels[i] != channels[i - 1] + 1:
+        run = channels[start:i]
+        self.setPWMRange(run[0], [settings[c] for c in run])
+        start = i
+
+  def setAllPWM(self, on, off):
+    "Sets every PWM channel at once through the ALL_LED registers"
+    data = self._ledBytes(on, off)
+    leds = self.shadow[self.__LED0_ON_L:self.__LED0_ON_L + 64]
+    if (self.cache and leds == data * 16):
+      self.writes_suppressed += 1
+      return
+    # ALL_LED is write-only and loads every channel, so it is always sent
+    if (self.autoincrement):
+      self.writeBlock(self.__ALLLED_ON_L, data, force=True)
+    else:
+      self.write(self.__ALLLED_ON_L, on & 0xFF, force=True)
+      self.write(self.__ALLLED_ON_H, on >> 8, force=True)
+      self.write(self.__ALLLED_OFF_L, off & 0xFF, force=True)
+      self.write(self.__ALLLED_OFF_H, off >> 8, force=True)
+    self.shadow[self.__LED0_ON_L:self.__LED0_ON_L + 64] = data * 16
+
+  def allOff(self):
+    """Forces every output fully off, including the servo channels. Only ALL_LED_OFF_H is
+    written (its full-off bit), so this is a single one-byte transaction"""
+    self.write(self.__ALLLED_OFF_H, 0x10, force=True)
+    for channel in range(16):
+      self.shadow[self.__LED0_OFF_H + 4 * channel] = 0x10
+
+  def getPWM(self, channel):
+    "The (on, off) last written to a channel, from the shadow registers; None if unknown"
+    data = self.shadow[self.__LED0_ON_L + 4 * channel:self.__LED0_ON_L + 4 * channel + 4]
+    if None in data:
+      return None
+    return (data[0] | data[1] << 8, data[2] | data[3] << 8)
+
   def setDutycycle(self, channel, pulse):
-    self.setPWM(channel, 0, int(pulse * (4096 / 100)))
+    # 4096 would set the full-off bit, so 100% is capped at 4095
+    self.setPWM(channel, 0, min(int(pulse * (4096 / 100)), 4095))
 
   def setLevel(self, channel, value):
     if (value == 1):
@@ -99,9 +235,153 @@ class PCA9685:
 
 
 
+class MotionScheduler:
+    "Holds the current motion until its deadline on a background thread, then runs its follow-up"
+    def __init__(self):
+        self.cond = threading.Condition(threading.RLock())
+        self.deadline = None
+        self.then = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def start(self, command, duration, then=None):
+        "Applies command now, replacing any pending motion; runs then after duration seconds"
+        with self.cond:
+            command()
+            if duration > 0:
+                self.deadline = time.monotonic() + duration
+                self.then = then
+            else:
+                # No duration: keep moving until the next command
+                self.deadline = None
+                self.then = None
+            self.cond.notify_all()
+
+    def cancel(self):
+        with self.cond:
+            self.deadline = None
+            self.then = None
+            self.cond.notify_all()
+
+    def busy(self):
+        "True while a timed motion has not reached its deadline"
+        return self.deadline is not None
+
+    def wait(self, timeout=None):
+        "Blocks until the pending motion has finished"
+        with self.cond:
+            return self.cond.wait_for(lambda: self.deadline is None, timeout)
+
+    def _run(self):
+        with self.cond:
+            while True:
+                if self.deadline is None:
+                    self.cond.wait()
+                    continue
+                remaining = self.deadline - time.monotonic()
+                if remaining > 0:
+                    self.cond.wait(remaining)
+                    continue
+                # Runs under the lock so a new command cannot be overwritten by a stale follow-up
+                then = self.then
+                self.deadline = None
+                self.then = None
+                if then is not None:
+                    try:
+                        then()
+                    except Exception as e:
+                        print(f"Motion follow-up failed: {e}")
+                self.cond.notify_all()
+
+
+class ActuationExecutor:
+    """Single thread that owns the I2C bus. Commands queued under the same key collapse
+    to the newest one, so only the latest wheel update or servo angle reaches the bus."""
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.pending = OrderedDict()    # key -> (command, submit time)
+        self.submitted = 0
+        self.executed = 0
+        self.coalesced = 0
+        self.discarded = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+        self.sequence = 0
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, key, command, urgent=False, discard=()):
+        """Queues command, replacing a still-pending command with the same key (None never coalesces).
+        urgent puts it ahead of everything queued, after dropping the pending commands under the
+        keys in discard"""
+        with self.cond:
+            if key is None:
+                self.sequence += 1
+                key = ('once', self.sequence)
+            elif key in self.pending:
+                # Latest wins; it moves to the back so it stays ordered after everything queued before it
+                del self.pending[key]
+                self.coalesced += 1
+            for stale in discard:
+                if self.pending.pop(stale, None) is not None:
+                    self.discarded += 1
+            self.pending[key] = (command, time.monotonic())
+            if urgent:
+                self.pending.move_to_end(key, last=False)
+            self.submitted += 1
+            self.cond.notify()
+
+    def call(self, command, urgent=False, discard=()):
+        "Runs command on the bus thread and waits for its result (see submit for urgent and discard)"
+        if threading.current_thread() is self.thread:
+            return command()
+        done = threading.Event()
+        result = {}
+        def run():
+            try:
+                result['value'] = command()
+            except Exception as e:
+                result['error'] = e
+            done.set()
+        self.submit(None, run, urgent, discard)
+        done.wait()
+        if 'error' in result:
+            raise result['error']
+        return result.get('value')
+
+    def stats(self):
+        "Queue depth, counters and command-to-bus latency in milliseconds"
+        with self.cond:
+            return {
+                'depth': len(self.pending),
+                'submitted': self.submitted,
+                'executed': self.executed,
+                'coalesced': self.coalesced,
+                'discarded': self.discarded,
+                'latency_avg_ms': 1000 * self.latency_total / self.executed if self.executed else 0.0,
+                'latency_max_ms': 1000 * self.latency_max,
+            }
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.pending:
+                    self.cond.wait()
+                key, (command, submitted_at) = self.pending.popitem(last=False)
+            latency = time.monotonic() - submitted_at
+            try:
+                command()
+            except Exception as e:
+                print(f"Actuation command {key} failed: {e}")
+            with self.cond:
+                self.executed += 1
+                self.latency_total += latency
+                self.latency_max = max(self.latency_max, latency)
+
+
 # Control Robot Library
 class MEEPOBOT():
-    def __init__(self):
+    def __init__(self, blocking=True, executor=False):
         self.PWMA = 0
         self.AIN1 = 2
         self.AIN2 = 1
@@ -123,155 +403,203 @@ class MEEPOBOT():
         self.motorD1 = LED(self.DIN1)  # Directional port 1, set the output mode to LED type
         self.motorD2 = LED(self.DIN2)  # Directional port 2, set the output mode to LED type
 
+        # (duty channel, forward-high pin, forward-low pin) per wheel; wheel D's pins are on GPIO
+        self.wheel_channels = [
+            (self.PWMA, self.AIN2, self.AIN1),
+            (self.PWMB, self.BIN1, self.BIN2),
+            (self.PWMC, self.CIN1, self.CIN2),
+            (self.PWMD, None, None),
+        ]
+        self.wheel_dirs = [Dir[0]] * 4
+        # Signed duties of the last wheel update as requested, before the limiter
+        self.wheel_duties = [0, 0, 0, 0]
+
+        # blocking=False makes the movement methods return at once; the scheduler stops them on time
+        self.blocking = blocking
+        self.motion = None if blocking else MotionScheduler()
+        # executor=True hands every bus write to one thread, for use from several threads at once
+        self.executor = ActuationExecutor() if executor else None
+        # Optional callable(name, args) told about every motor and servo command (session recording)
+        self.command_log = None
+        # Optional callable(duties) -> duties that every wheel update passes through (safety interlock)
+        self.wheel_limiter = None
+        # Calibrated angle -> tick table per servo channel (see servo_table)
+        self.servo_tables = {}
+
+    def _actuate(self, key, command):
+        if self.executor is None:
+            command()
+        else:
+            self.executor.submit(key, command)
+
     def MotorRun(self, motor, index, speed):
+        "Legacy single-motor call: changes one wheel of the last wheel update, limiter included"
         if speed > 100:
             return
-        if(motor == 0):
-            self.pwm.setDutycycle(self.PWMA, speed)
-            if(index == Dir[0]):
-                self.pwm.setLevel(self.AIN1, 0)
-                self.pwm.setLevel(self.AIN2, 1)
-            else:
-                self.pwm.setLevel(self.AIN1, 1)
-                self.pwm.setLevel(self.AIN2, 0)
-        elif(motor == 1):
-            self.pwm.setDutycycle(self.PWMB, speed)
-            if(index == Dir[0]):
-                self.pwm.setLevel(self.BIN1, 1)
-                self.pwm.setLevel(self.BIN2, 0)
-            else:
-                self.pwm.setLevel(self.BIN1, 0)
-                self.pwm.setLevel(self.BIN2, 1)
-        elif(motor == 2):
-            self.pwm.setDutycycle(self.PWMC,speed)
-            if(index == Dir[0]):
-                self.pwm.setLevel(self.CIN1,1)
-                self.pwm.setLevel(self.CIN2,0)
-            else:
-                self.pwm.setLevel(self.CIN1,0)
-                self.pwm.setLevel(self.CIN2,1)
-        elif(motor == 3):
-            self.pwm.setDutycycle(self.PWMD,speed)
-            if (index == Dir[0]):
-                self.motorD1.off()    # Set DIn1 to low level
-                self.motorD2.on()    # Set DIn2 to high level
-                #GPIO.output(self.DIN1,0)
-                #GPIO.output(self.DIN2,1)
-            else:
-                self.motorD1.on()    # Set DIn1 to high level
-                self.motorD2.off()  # Set DIn2 to low level
-                #GPIO.output(self.DIN1,1)
-                #GPIO.output(self.DIN2,0)
+        duties = list(self.wheel_duties)
+        duties[motor] = speed if index == Dir[0] else -speed
+        self.setWheels(duties)
 
     def MotorStop(self, motor):
-        if (motor == 0):
-            self.pwm.setDutycycle(self.PWMA, 0)
-        elif(motor == 1):
-            self.pwm.setDutycycle(self.PWMB, 0)
-        elif(motor == 2):
-            self.pwm.setDutycycle(self.PWMC, 0)
-        elif(motor == 3):
-            self.pwm.setDutycycle(self.PWMD, 0)
+        duties = list(self.wheel_duties)
+        duties[motor] = 0
+        self.setWheels(duties)
+
+    def setWheels(self, duties):
+        "Applies signed duties (-100..100) to the four wheels in one coalesced hardware update"
+        duties = list(duties)
+        self.wheel_duties = duties
+        if self.wheel_limiter:
+            duties = self.wheel_limiter(duties)
+        if self.command_log:
+            self.command_log('wheels', duties)
+        self._actuate('wheels', lambda: self._applyWheels(duties))
+
+    def _applyWheels(self, duties):
+        settings = {}
+        for motor, duty in enumerate(duties):
+            if duty > 0:
+                self.wheel_dirs[motor] = Dir[0]
+            elif duty < 0:
+                self.wheel_dirs[motor] = Dir[1]
+            # A stopped wheel keeps its last direction so the pins are not toggled needlessly
+            forward = self.wheel_dirs[motor] == Dir[0]
+            pwm, in1, in2 = self.wheel_channels[motor]
+            # 4096 would set the full-off bit, so full speed is capped at 4095
+            settings[pwm] = (0, min(int(abs(duty) * (4096 / 100)), 4095))
+            if in1 is not None:
+                settings[in1] = (0, 4095 if forward else 0)
+                settings[in2] = (0, 0 if forward else 4095)
+        if self.wheel_dirs[3] == Dir[0]:
+            self.motorD1.off()
+            self.motorD2.on()
+        else:
+            self.motorD1.on()
+            self.motorD2.off()
+        self.pwm.setPWMChannels(settings)
+
+    def emergencyStop(self, keep=()):
+        """Cuts every PWM output with one ALL_LED write, run by the bus thread ahead of anything
+        queued for it; a wheel update still pending is dropped. The channels in keep (e.g. the
+        camera servos) get their last pulse back right after; wheel D's direction pins are on
+        GPIO and stay. Returns time.perf_counter_ns() of the moment the outputs were cut."""
+        if self.executor is not None:
+            return self.executor.call(lambda: self._emergencyStop(keep), urgent=True, discard=('wheels',))
+        return self._emergencyStop(keep)
+
+    def _emergencyStop(self, keep):
+        kept = {channel: self.pwm.getPWM(channel) for channel in keep}
+        self.pwm.allOff()
+        cut = time.perf_counter_ns()
+        kept = {channel: value for channel, value in kept.items() if value is not None}
+        if kept:
+            self.pwm.setPWMChannels(kept)
+        return cut
+
+    def drive(self, vx, vy, omega):
+        """Mecanum drive: vx forward, vy to the left, omega counter-clockwise, all in duty percent.
+        Wheel duties are scaled down together if any of them would exceed 100."""
+        duties = [
+            vx - vy - omega,    # motor 0, front left
+            vx + vy + omega,    # motor 1, front right
+            vx + vy - omega,    # motor 2, rear left
+            vx - vy + omega,    # motor 3, rear right
+        ]
+        peak = max(abs(d) for d in duties)
+        if peak > 100:
+            duties = [d * 100 / peak for d in duties]
+        self.setWheels(duties)
+
+    def driveFor(self, vx, vy, omega, t_time, then=None):
+        "Drives for t_time seconds, then stops (or calls then); returns at once when non-blocking"
+        if self.blocking:
+            self.drive(vx, vy, omega)
+            time.sleep(t_time)
+            return
+        if then is None:
+            then = lambda: self.setWheels([0, 0, 0, 0])
+        self.motion.start(lambda: self.drive(vx, vy, omega), t_time, then)
+
     # forward
     def t_up(self,speed,t_time):
-        self.MotorRun(0,'forward',speed)
-        self.MotorRun(1,'forward',speed)
-        self.MotorRun(2,'forward',speed)
-        self.MotorRun(3,'forward',speed)
-        time.sleep(t_time)
+        self.driveFor(speed, 0, 0, t_time)
     # Back
     def t_down(self,speed,t_time):
-        self.MotorRun(0,'backward',speed)
-        self.MotorRun(1,'backward',speed)
-        self.MotorRun(2,'backward',speed)
-        self.MotorRun(3,'backward',speed)
-        time.sleep(t_time)
+        self.driveFor(-speed, 0, 0, t_time)
 
     # shift left
     def moveLeft(self,speed,t_time):
-        self.MotorRun(0,'backward',speed)
-        self.MotorRun(1,'forward',speed)
-        self.MotorRun(2,'forward',speed)
-        self.MotorRun(3,'backward',speed)
-        time.sleep(t_time)
+        self.driveFor(0, speed, 0, t_time)
 
     #shift right
     def moveRight(self,speed,t_time):
-        self.MotorRun(0,'forward',speed)
-        self.MotorRun(1,'backward',speed)
-        self.MotorRun(2,'backward',speed)
-        self.MotorRun(3,'forward',speed)
-        time.sleep(t_time)
+        self.driveFor(0, -speed, 0, t_time)
 
     # turn left
     def turnLeft(self,speed,t_time):
-        self.MotorRun(0,'backward',speed)
-        self.MotorRun(1,'forward',speed)
-        self.MotorRun(2,'backward',speed)
-        self.MotorRun(3,'forward',speed)
-        time.sleep(t_time)
+        self.driveFor(0, 0, speed, t_time)
     
     # turn right
     def turnRight(self,speed,t_time):
-        self.MotorRun(0,'forward',speed)
-        self.MotorRun(1,'backward',speed)
-        self.MotorRun(2,'forward',speed)
-        self.MotorRun(3,'backward',speed)
-        time.sleep(t_time)
+        self.driveFor(0, 0, -speed, t_time)
     
     # forward left
     def forward_Left(self,speed,t_time):
-        self.MotorStop(0)
-        self.MotorRun(1,'forward',speed)
-        self.MotorRun(2,'forward',speed)
-        self.MotorStop(0)
-        time.sleep(t_time)
+        self.driveFor(speed / 2, speed / 2, 0, t_time)
 
     # forward right
     def forward_Right(self,speed,t_time):
-        self.MotorRun(0,'forward',speed)
-        self.MotorStop(1)
-        self.MotorStop(2)
-        self.MotorRun(3,'forward',speed)
-        time.sleep(t_time)
+        self.driveFor(speed / 2, -speed / 2, 0, t_time)
 
     # backward left
     def backward_Left(self,speed,t_time):
-        self.MotorRun(0,'backward',speed)
-        self.MotorStop(1)
-        self.MotorStop(2)
-        self.MotorRun(3,'backward',speed)
-        time.sleep(t_time)
+        self.driveFor(-speed / 2, speed / 2, 0, t_time)
     
     # backward right
     def backward_Right(self,speed,t_time):
-        self.MotorStop(0)
-        self.MotorRun(1,'backward',speed)
-        self.MotorRun(2,'backward',speed)
-        self.MotorStop(3)
-        time.sleep(t_time)
+        self.driveFor(-speed / 2, -speed / 2, 0, t_time)
 
 
     # stop
     def t_stop(self,t_time):
-        self.MotorStop(0)
-        self.MotorStop(1)
-        self.MotorStop(2)
-        self.MotorStop(3)
-        time.sleep(t_time)
+        if self.blocking:
+            self.setWheels([0, 0, 0, 0])
+            time.sleep(t_time)
+        else:
+            # A timed stop still occupies the scheduler so programs wait it out
+            self.motion.start(lambda: self.setWheels([0, 0, 0, 0]), t_time)
+
+    def motionBusy(self):
+        "True while a non-blocking timed motion is still running"
+        return self.motion is not None and self.motion.busy()
 
-        # set servo
+    # set servo
     def set_servo_pulse(self,channel,pulse):
-        pulse_length = 1000000    # 1,000,000 us per second
-        pulse_length //= 60       # 60 Hz
-        print('{0}us per period'.format(pulse_length))
-        pulse_length //= 4096     # 12 bits of resolution
-        print('{0}us per bit'.format(pulse_length))
-        pulse *= 1000
-        pulse //= pulse_length
-        self.pwm.setPWM(channel, 0, pulse)
+        "Pulse width in milliseconds, at the PWM frequency actually set (50 Hz)"
+        ticks = int(round(pulse * 1000 * 4096 * self.pwm.frequency / 1000000))
+        self._actuate(('servo', channel), lambda: self.pwm.setPWM(channel, 0, ticks))
+
+    def servo_table(self, channel):
+        "The ServoTable of a servo channel, built on first use with the default calibration"
+        if channel not in self.servo_tables:
+            self.servo_tables[channel] = ServoTable(frequency=self.pwm.frequency)
+        return self.servo_tables[channel]
+
+    def set_servo_calibration(self, channel, **calibration):
+        "Rebuilds a channel's table: min_angle, max_angle, zero_us, us_per_degree, trim (ServoTable)"
+        self.servo_tables[channel] = ServoTable(frequency=self.pwm.frequency, **calibration)
+        return self.servo_tables[channel]
 
     # set servo angle
     def set_servo_angle(self,channel,angle):
-        angle=4096*((angle*11)+500)/20000
-        self.pwm.setPWM(channel,0,int(angle))
+        self.set_servo_angles({channel: angle})
+
+    def set_servo_angles(self, angles):
+        """Sets several servos from a {channel: angle} dict. Consecutive channels (tilt 9 and
+        pan 10) go out in one register burst"""
+        if self.command_log:
+            for channel, angle in angles.items():
+                self.command_log('servo', (channel, angle))
+        settings = {channel: (0, self.servo_table(channel).lookup(angle)) for channel, angle in angles.items()}
+        key = ('servo', next(iter(settings))) if len(settings) == 1 else ('servos', tuple(sorted(settings)))
+        self._actuate(key, lambda: self.pwm.setPWMChannels(settings))
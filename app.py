@@ -1,51 +1,177 @@
-from flask import Flask, render_template, Response, request, jsonify
+from flask import Flask, render_template, Response, request, jsonify, g
 from MEEPOBOT import MEEPOBOT
+from streaming import FrameHub, Overlay
+from camera import CaptureThread, make_config
+from control import SteeringController
+from pipeline import PipelineRunner, FrameContext
+from vision import FaceTracker, RateCounter, LINE_COLORS, get_color_lut
+from modes import FaceTrackMode, LineFollowMode, PanTiltTrackMode, QRNavMode
+from qr import QRReader
+from recording import SessionRecorder
+from workers import VisionPool, EncodeWorker
+from buffers import BufferPool, FrameImages
+from teleop import TeleopChannel
+from safety import SafetyInterlock
+from program import MotionVM, ProgramError, compile_program
+from servo import ServoEngine
+from metrics import REGISTRY, GCWatch, GC_BUCKETS
+from backend import DistanceSensor, Button, Picamera2
 import time
+import math
 import cv2
 import numpy as np
 import threading
 import sys
-from gpiozero import DistanceSensor, Button
-from queue import Queue
-import smbus2 as smbus
+import os
+import json
 import ctypes
 import inspect
-import libcamera
-from picamera2 import Picamera2
+try:
+    from flask_sock import Sock
+except ImportError:
+    # Without flask-sock the page falls back to the POST routes
+    Sock = None
 
 clbrobot = None
 picamera = None
+capture = None
+steering = None
+safety = None
+# Moves the pan/tilt servos along smooth trajectories (see /servo_control)
+servos = None
+# Runs the programs uploaded to /run_instructions (SEQUENTIAL mode)
+motion_vm = None
+# Active SessionRecorder while a session is being recorded (see /recording)
+recorder = None
 HARDWARE_INITIALIZED = False
 MODE = 'STOP'
-INSTRUCTION_QUEUE = Queue()
 PAN_ANGLE = 70
 TILT_ANGLE = 0
-current_frame = None
+# Set whenever the camera may be needed again (new viewer, mode change)
+CAMERA_WAKE = threading.Event()
+frame_hub = FrameHub(max_fps=30, on_subscribe=CAMERA_WAKE.set)
+# Stream sizes (width, height): vision runs on the lores stream, viewers see the main stream
+VISION_SIZE = (320, 240)
+STREAM_SIZE = (640, 480)
 face_cascade = None
+face_tracker = None
+# MEEPOBOT_VISION_WORKERS=N runs detection in N worker processes and JPEG encoding in
+# one more; 0 (default) keeps everything on the autonomous loop thread
+VISION_WORKERS = int(os.environ.get('MEEPOBOT_VISION_WORKERS', 0))
+vision_pool = None
+encoder = None
+# How long a pass waits for its own frame's result before steering on an older one
+WORKER_WAIT = 0.01
+
+# Metrics served at /metrics. Hot paths only bump counters and histograms;
+# the callback metrics below read their sources when someone scrapes
+LOOP_SECONDS = REGISTRY.histogram('meepobot_loop_seconds', 'One autonomous loop pass, excluding the wait for a frame', ['mode'])
+FRAME_WAIT_SECONDS = REGISTRY.histogram('meepobot_frame_wait_seconds', 'Time the autonomous loop waited for a camera frame', ['mode'])
+STAGE_SECONDS = REGISTRY.histogram('meepobot_stage_seconds', 'Duration of one mode pipeline stage', ['mode', 'stage'])
+FRAMES_PROCESSED = REGISTRY.counter('meepobot_frames_processed_total', 'Camera frames run through a mode pipeline', ['mode'])
+ENCODE_SECONDS = REGISTRY.histogram('meepobot_encode_seconds', 'JPEG encoding time of one viewer frame')
+FRAMES_ENCODED = REGISTRY.counter('meepobot_frames_encoded_total', 'Viewer frames encoded to JPEG')
+STREAM_FRAMES = REGISTRY.counter('meepobot_stream_frames_total', 'MJPEG frames sent to viewers')
+STREAM_BYTES = REGISTRY.counter('meepobot_stream_bytes_total', 'MJPEG bytes sent to viewers')
+HTTP_SECONDS = REGISTRY.histogram('meepobot_http_request_seconds', 'Flask handler time per endpoint', ['endpoint'])
+HTTP_REQUESTS = REGISTRY.counter('meepobot_http_requests_total', 'HTTP requests per endpoint and status', ['endpoint', 'status'])
+PROGRAM_LATE_SECONDS = REGISTRY.histogram('meepobot_program_step_late_seconds', 'How late a motion program step ended after its planned duration', buckets=GC_BUCKETS)
+SAFETY_STOP_SECONDS = REGISTRY.histogram('meepobot_safety_stop_seconds', 'Obstacle in range to wheels cut (ALL_LED write done)', buckets=GC_BUCKETS)
+QR_DECODE_SECONDS = REGISTRY.histogram('meepobot_qr_decode_seconds', 'One QR decode attempt (region first, then the full frame)')
+GC_SECONDS = REGISTRY.histogram('meepobot_gc_pause_seconds', 'Garbage collector pause', ['generation'], GC_BUCKETS)
+GC_COLLECTED = REGISTRY.counter('meepobot_gc_collected_total', 'Objects freed by the garbage collector')
+GCWatch(GC_SECONDS, GC_COLLECTED).start()
+LOOP_RATE = RateCounter()
+# Derived images (gray, HSV, downscaled...) of the current vision frame, shared by its stages
+frame_images = FrameImages()
+REGISTRY.gauge('meepobot_loop_fps', 'Autonomous loop passes per second', fn=lambda: round(LOOP_RATE.stats()[0], 2))
+REGISTRY.counter('meepobot_vision_image_cache_hits_total', 'Derived frame images served from the per-frame cache', fn=lambda: frame_images.hits)
+REGISTRY.counter('meepobot_vision_image_cache_misses_total', 'Derived frame images computed', fn=lambda: frame_images.misses)
+REGISTRY.gauge('meepobot_stream_viewers', 'Open /video_feed connections', fn=lambda: frame_hub.subscribers)
+REGISTRY.counter('meepobot_stream_dropped_total', 'Frames slow viewers skipped', fn=lambda: frame_hub.frames_dropped)
+REGISTRY.counter('meepobot_camera_frames_total', 'Frames captured from the camera', fn=lambda: capture.captured)
+REGISTRY.counter('meepobot_camera_dropped_total', 'Camera frames dropped because every buffer was in use', fn=lambda: capture.dropped)
+REGISTRY.gauge('meepobot_program_running', 'A motion program is running (SEQUENTIAL mode)', fn=lambda: int(motion_vm.running()))
+REGISTRY.counter('meepobot_program_instructions_total', 'Motion program instructions executed', fn=lambda: motion_vm.executed)
+REGISTRY.gauge('meepobot_actuation_queue_depth', 'Commands waiting for the bus thread', fn=lambda: len(clbrobot.executor.pending))
+REGISTRY.counter('meepobot_actuation_coalesced_total', 'Bus commands replaced by a newer one before running', fn=lambda: clbrobot.executor.coalesced)
+REGISTRY.counter('meepobot_i2c_writes_suppressed_total', 'I2C writes skipped by the PCA9685 shadow registers', fn=lambda: clbrobot.pwm.writes_suppressed)
+REGISTRY.counter('meepobot_steering_overruns_total', 'Steering controller ticks that missed their deadline', fn=lambda: steering.overruns)
+REGISTRY.gauge('meepobot_obstacle_distance_meters', 'Ultrasonic distance reading', fn=lambda: safety.distance)
+REGISTRY.gauge('meepobot_ultrasonic_sample_hz', 'New ultrasonic readings per second', fn=lambda: safety.samples.stats()[0])
+REGISTRY.gauge('meepobot_safety_speed_scale', 'Forward speed allowed by the obstacle distance (0..1)', fn=lambda: safety.scale)
+REGISTRY.counter('meepobot_safety_stops_total', 'Emergency stops for an obstacle in range', fn=lambda: safety.stops)
+REGISTRY.counter('meepobot_servo_writes_total', 'Pan/tilt register bursts sent by the servo engine', fn=lambda: servos.writes)
+REGISTRY.counter('meepobot_qr_frames_skipped_total', 'QR_NAV frames not decoded because the picture had not changed', fn=lambda: qr_mode.reader.skipped)
+REGISTRY.counter('meepobot_qr_decodes_total', 'QR decode attempts', fn=lambda: qr_mode.reader.attempts)
+REGISTRY.counter('meepobot_qr_hits_total', 'QR decode attempts that found a code', fn=lambda: qr_mode.reader.hits)
+REGISTRY.gauge('meepobot_teleop_connections', 'Open manual control WebSocket connections', fn=lambda: teleop.connections)
+REGISTRY.counter('meepobot_teleop_coalesced_total', 'Manual commands merged into a newer one before reaching the bus', fn=lambda: teleop.coalesced)
+REGISTRY.counter('meepobot_teleop_deadman_stops_total', 'Stops after the driving client went quiet', fn=lambda: teleop.deadman_stops)
+REGISTRY.gauge('meepobot_vision_workers_in_flight', 'Frames being processed by the vision workers', fn=lambda: vision_pool.busy())
+REGISTRY.counter('meepobot_vision_workers_dropped_total', 'Frames not sent to the vision workers because the ring was full', fn=lambda: vision_pool.dropped)
+REGISTRY.counter('meepobot_vision_workers_superseded_total', 'Worker results discarded because a newer frame finished first', fn=lambda: vision_pool.superseded)
+REGISTRY.counter('meepobot_encoder_dropped_total', 'Viewer frames dropped because the encode worker was busy', fn=lambda: encoder.dropped)
 
 # Line following color configuration (HSV ranges)
 LINE_COLOR_MODE = 'black'  # Options: 'black', 'red', 'blue', 'green', 'yellow', 'white', 'custom'
-LINE_COLOR_LOWER = np.array([0, 0, 0])      # HSV lower bound
-LINE_COLOR_UPPER = np.array([180, 255, 60]) # HSV upper bound for black
+LINE_COLOR_RANGES = LINE_COLORS['black']    # List of HSV (lower, upper) ranges
 
 try:
     face_cascade = cv2.CascadeClassifier('./image/haarcascade_frontalface_default.xml')
+    # Full detection every 10th frame, cheap search around the last face in between
+    face_tracker = FaceTracker(face_cascade, detect_every=10)
 except:
     face_cascade = None
 
+def publish_encoded(jpeg, seconds):
+    ENCODE_SECONDS.observe(seconds)
+    FRAMES_ENCODED.inc()
+    frame_hub.publish(jpeg)
+
+def program_finished(status):
+    # Called by the motion VM when a program ends, is cancelled or fails. A replaced
+    # program hands SEQUENTIAL on to the one replacing it
+    global MODE
+    if status != 'replaced' and MODE == 'SEQUENTIAL':
+        MODE = 'STOP'
+
+if VISION_WORKERS > 0:
+    # Workers are forked here, before any other thread exists
+    try:
+        vision_pool = VisionPool(VISION_WORKERS, VISION_SIZE)
+        encoder = EncodeWorker(STREAM_SIZE, on_jpeg=publish_encoded)
+    except Exception as e:
+        print(f"Vision workers error: {e}")
+        vision_pool = encoder = None
+
 try:
-    clbrobot = MEEPOBOT()
-    makerobo_sensor = DistanceSensor(echo=21, trigger=20, max_distance=3, threshold_distance=0.2)
+    # Non-blocking: movement calls return at once and the motion scheduler stops the wheels on time.
+    # The executor serialises bus access from the Flask threads and the autonomous loop.
+    clbrobot = MEEPOBOT(blocking=False, executor=True)
+    # FACE_TRACK and LINE_FOLLOW post errors; this thread steers at a fixed 50 Hz
+    steering = SteeringController(clbrobot, rate=50)
+    steering.start()
+    # queue_len=5 (gpiozero averages 9 readings by default) so in-range fires sooner
+    makerobo_sensor = DistanceSensor(echo=21, trigger=20, queue_len=5, max_distance=3, threshold_distance=0.2)
+    # Stops forward motion under 0.2 m and slows it down from 0.6 m, in every mode
+    safety = SafetyInterlock(clbrobot, makerobo_sensor, slow_distance=0.6, histogram=SAFETY_STOP_SECONDS)
+    # Uploaded programs run on their own thread; sensor conditions read the interlock's distance
+    motion_vm = MotionVM(clbrobot, distance=lambda: safety.distance, on_finish=program_finished,
+                         histogram=PROGRAM_LATE_SECONDS)
     
-    # Initialize servo positions: pan=70, tilt=0
-    clbrobot.set_servo_angle(10, 70)  # Pan servo
-    clbrobot.set_servo_angle(9, 0)    # Tilt servo
+    # Tilt has 90 degrees of travel, pan the full 180
+    clbrobot.set_servo_calibration(9, max_angle=90)
+    # Initialize servo positions: pan=70, tilt=0. Targets are then reached at up to
+    # 240 deg/s, with pan (10) and tilt (9) written together at 50 Hz
+    servos = ServoEngine(clbrobot, {'pan': (10, PAN_ANGLE), 'tilt': (9, TILT_ANGLE)}, rate=50)
+    servos.start()
 
     picamera = Picamera2()
-    config = picamera.create_preview_configuration(main={"format": 'RGB888', "size": (320, 240)}, raw={"format": "SRGGB12", "size": (1920, 1080)})
-    config["transform"] = libcamera.Transform(hflip=0, vflip=1)
-    picamera.configure(config)
-    picamera.start()
+    picamera.configure(make_config(picamera, STREAM_SIZE, VISION_SIZE))
+    # Starts the camera and captures into a ring of preallocated buffers on its own thread
+    capture = CaptureThread(picamera, streams=('lores', 'main'), slots=3)
+    capture.start()
     
     HARDWARE_INITIALIZED = True
     
@@ -71,263 +197,212 @@ def _async_raise(tid, exctype):
 def stop_thread(thread):
     _async_raise(thread.ident, SystemExit)
 
+def publish_frame(frame):
+    # JPEG encoding only happens while someone has /video_feed open
+    if frame is None or not frame_hub.has_viewers():
+        return
+    if encoder and encoder.accepts(frame):
+        # Encoded in the worker process, publish_encoded() hands it to the viewers
+        encoder.submit(frame)
+        return
+    start = time.perf_counter()
+    jpeg = cv2.imencode('.jpg', frame)[1]
+    ENCODE_SECONDS.observe(time.perf_counter() - start)
+    FRAMES_ENCODED.inc()
+    frame_hub.publish(jpeg)
+
+# Mode stages: each takes the FrameContext of the current pass
+
+def encode_stage(ctx):
+    publish_frame(ctx.image)
+
+def stop_stage(ctx):
+    clbrobot.t_stop(0)
+
+def face_error(ctx, e):
+    print(f"Face tracking error: {e}")
+    steering.clear()
+    clbrobot.t_stop(0)
+    publish_frame(ctx.image)
+    time.sleep(0.1)
+
+def line_error(ctx, e):
+    print(f"Line follow error: {e}")
+    steering.clear()
+    clbrobot.t_stop(0)
+    publish_frame(ctx.image)
+    time.sleep(0.1)
+
+def qr_error(ctx, e):
+    print(f"QR navigation error: {e}")
+    clbrobot.t_stop(0)
+    publish_frame(ctx.image)
+    time.sleep(0.1)
+
+def offloaded(mode):
+    # Stages of a vision mode whose compute stages run in the worker processes. Each pass
+    # queues its frame and steers on the newest result back from the workers, if any
+    def offload(ctx):
+        ctx.offloaded = False
+        if vision_pool.alive and vision_pool.accepts(ctx.size):
+            vision_pool.configure({'ranges': LINE_COLOR_RANGES, 'detector': line_mode.detector})
+            queued = vision_pool.submit(ctx.mode, ctx.frame.seq, ctx.lores, ctx.size)
+            # Give the workers a few ms to return this frame's result, else use the newest one
+            result = vision_pool.latest(ctx.mode, ctx.frame.seq if queued else 0, WORKER_WAIT)
+            if result is not None:
+                ctx.__dict__.update(result)
+                ctx.offloaded = True
+        else:
+            # Workers gone or frame too large for the ring: run the stages here
+            for name, func in mode.compute_stages():
+                func(ctx)
+            ctx.offloaded = True
+
+    def steer(ctx):
+        if ctx.offloaded:
+            mode.steer(ctx)
+
+    def draw(ctx):
+        if ctx.offloaded:
+            mode.draw(ctx)
+
+    return [('offload', offload), ('steer', steer), ('overlay', draw, True)]
+
+def vision_stages(mode):
+    if vision_pool:
+        return offloaded(mode)
+    return mode.stages()
+
+# Every mode is a pipeline of named stages, run once per camera frame and timed per stage.
+# Optional stages (overlay, encoding) only run while someone watches /video_feed.
+# A new mode only needs its stages registered here.
+pipelines = PipelineRunner(histogram=STAGE_SECONDS)
+pipelines.register('STOP', [('stop', stop_stage), ('encode', encode_stage, True)],
+                   uses_camera=False, delay=0.1)
+pipelines.register('MANUAL', [('encode', encode_stage, True)],
+                   uses_camera=False, selectable=False)
+# The motion VM drives SEQUENTIAL on its own thread, the camera only runs for viewers
+pipelines.register('SEQUENTIAL', [('encode', encode_stage, True)],
+                   uses_camera=False, selectable=False)
+# The vision modes live in modes.py so the replay benchmark can run them headless.
+# LINE_FOLLOW segments with a LUT compiled per colour; detector is 'contour' or 'scanline'
+line_mode = LineFollowMode(get_color_lut(LINE_COLOR_RANGES), 'contour', steering)
+pipelines.register('LINE_FOLLOW', vision_stages(line_mode) + [('encode', encode_stage, True)], on_error=line_error)
+if face_tracker:
+    face_mode = FaceTrackMode(face_tracker, steering)
+    pipelines.register('FACE_TRACK', vision_stages(face_mode) + [('encode', encode_stage, True)], on_error=face_error)
+    # Same detection, but the camera servos follow the face and the wheels stay still
+    pan_tilt_mode = PanTiltTrackMode(face_tracker, servos)
+    pipelines.register('FACE_PAN_TILT', vision_stages(pan_tilt_mode) + [('encode', encode_stage, True)], on_error=face_error)
+
+# QR_NAV decodes on the QR reader's own thread, so it stays out of the vision workers
+qr_mode = QRNavMode(QRReader(threaded=True, histogram=QR_DECODE_SECONDS), clbrobot)
+pipelines.register('QR_NAV', qr_mode.stages() + [('encode', encode_stage, True)], on_error=qr_error)
+
 def autonomous_task():
-    global MODE, PAN_ANGLE, TILT_ANGLE, current_frame, clbrobot, picamera, face_cascade
+    global MODE, PAN_ANGLE, TILT_ANGLE, clbrobot, capture, face_cascade, steering
 
     if not HARDWARE_INITIALIZED:
         print("Autonomous task cannot run: Hardware failed to initialize.")
         return
 
+    held = None
+    last_seq = 0
+    # The viewer frame is copied into this buffer for the overlay instead of a fresh copy per frame
+    frame_buffers = BufferPool()
     while True:
-        try:
-            frame = picamera.capture_array()
-            frame = cv2.flip(frame, 1)
-            frame_with_overlay = frame.copy()
-        except Exception as e:
-            time.sleep(0.1)
-            continue
-        
-        if MODE == 'STOP':
-            clbrobot.t_stop(0)
-            current_frame = cv2.imencode('.jpg', frame_with_overlay)[1].tobytes()
+        # The frame from the previous iteration is done with, hand its buffer back
+        if held is not None:
+            capture.release(held)
+            held = None
+
+        mode = MODE
+        pipeline = pipelines.get(mode)
+        if pipeline is None:
             time.sleep(0.1)
             continue
-            
-        elif MODE == 'SEQUENTIAL':
-            if not INSTRUCTION_QUEUE.empty():
-                instruction, duration = INSTRUCTION_QUEUE.get()
-                
-                # Execute movement command (duration is handled by MEEPOBOT internally)
-                if instruction == 't_up': 
-                    clbrobot.t_up(50, duration)
-                elif instruction == 't_down': 
-                    clbrobot.t_down(50, duration)
-                elif instruction == 'turnLeft': 
-                    clbrobot.turnLeft(50, duration)
-                elif instruction == 'turnRight': 
-                    clbrobot.turnRight(50, duration)
-                elif instruction == 't_stop':
-                    clbrobot.t_stop(duration)
-                
-                # No need for time.sleep() - MEEPOBOT already waits for duration
-                clbrobot.t_stop(0)
-            else:
-                # Queue is empty, stop robot and return to STOP mode
-                clbrobot.t_stop(0)
-                MODE = 'STOP'
-            
-            current_frame = cv2.imencode('.jpg', frame_with_overlay)[1].tobytes()
-
-        elif MODE == 'FACE_TRACK':
-            if face_cascade:
-                try:
-                    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-                    faces = face_cascade.detectMultiScale(gray, 1.3, 5)
-                    
-                    if len(faces) > 0:
-                        x, y, w, h = faces[0]
-                        cv2.rectangle(frame_with_overlay, (x, y), (x+w, y+h), (0, 255, 0), 2)
-                        
-                        # Draw center point
-                        Xcent = int(x + w / 2)
-                        Ycent = int(y + h / 2)
-                        cv2.circle(frame_with_overlay, (Xcent, Ycent), 5, (0, 255, 0), -1)
-                        
-                        # Draw crosshair
-                        cv2.line(frame_with_overlay, (160, 0), (160, 240), (255, 0, 0), 1)
-                        cv2.line(frame_with_overlay, (0, 120), (320, 120), (255, 0, 0), 1)
-                        
-                        dispW = 320
-                        errorPan = Xcent - dispW / 2
-                        
-                        # Proportional control with dead zone
-                        # Dead zone: ±30 pixels (centered enough)
-                        # Far zone: >80 pixels (turn more aggressively)
-                        
-                        if abs(errorPan) < 30:
-                            # Face is centered - move forward
-                            clbrobot.t_up(30, 0.2)
-                            cv2.putText(frame_with_overlay, "FORWARD", (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 255, 0), 2)
-                            time.sleep(0.2)
-                            
-                        elif abs(errorPan) > 80:
-                            # Face is far off - turn aggressively with minimal forward
-                            if errorPan > 0:
-                                clbrobot.turnRight(30, 0.15)
-                                cv2.putText(frame_with_overlay, "TURN RIGHT++", (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 255, 255), 2)
-                            else:
-                                clbrobot.turnLeft(30, 0.15)
-                                cv2.putText(frame_with_overlay, "TURN LEFT++", (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 255, 255), 2)
-                            time.sleep(0.15)
-                            
-                        else:
-                            # Face is slightly off - gentle turn while moving forward
-                            turn_speed = int(abs(errorPan) * 0.3)  # Proportional: 30-24 speed range
-                            if errorPan > 0:
-                                clbrobot.turnRight(turn_speed, 0.12)
-                                cv2.putText(frame_with_overlay, "TURN RIGHT", (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 200, 255), 2)
-                            else:
-                                clbrobot.turnLeft(turn_speed, 0.12)
-                                cv2.putText(frame_with_overlay, "TURN LEFT", (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 200, 255), 2)
-                            time.sleep(0.12)
-                            
-                    else:
-                        clbrobot.t_stop(0)
-                        cv2.putText(frame_with_overlay, "SEARCHING...", (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 0, 255), 2)
-                        time.sleep(0.1)
-                        
-                except Exception as e:
-                    print(f"Face tracking error: {e}")
-                    clbrobot.t_stop(0)
-                    time.sleep(0.1)
-            else:
-                MODE = 'STOP'
-            
-            current_frame = cv2.imencode('.jpg', frame_with_overlay)[1].tobytes()
 
-        elif MODE == 'LINE_FOLLOW':
+        if not pipeline.uses_camera and not frame_hub.has_viewers():
+            if mode == 'STOP':
+                clbrobot.t_stop(0)
             try:
-                # Crop the lower portion of the frame (like notebook does 60:120 of 160x120)
-                crop_img = frame[150:240, 0:320]  # Adjusted for 320x240 resolution
-                
-                # Convert to HSV for color detection
-                hsv = cv2.cvtColor(crop_img, cv2.COLOR_BGR2HSV)
-                
-                # Create mask based on selected color
-                mask = cv2.inRange(hsv, LINE_COLOR_LOWER, LINE_COLOR_UPPER)
-                
-                # Special handling for red (spans 0 and 180 in hue)
-                if LINE_COLOR_MODE == 'red':
-                    mask2 = cv2.inRange(hsv, np.array([170, 120, 70]), np.array([180, 255, 255]))
-                    mask = cv2.bitwise_or(mask, mask2)
-                
-                # Clean up the mask
-                mask = cv2.erode(mask, None, iterations=2)
-                mask = cv2.dilate(mask, None, iterations=2)
-                
-                contours, hierarchy = cv2.findContours(mask.copy(), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-                
-                if len(contours) > 0:
-                    # Junction detection: Check if multiple significant contours exist
-                    large_contours = [cnt for cnt in contours if cv2.contourArea(cnt) > 500]
-                    is_junction = len(large_contours) > 1
-                    
-                    # Calculate total line area (junction indicator)
-                    total_line_area = sum([cv2.contourArea(cnt) for cnt in contours])
-                    junction_threshold = 8000  # Large area = junction/intersection
-                    
-                    c = max(contours, key=cv2.contourArea)
-                    M = cv2.moments(c)
-                    
-                    if M['m00'] > 0:
-                        cx = int(M['m10'] / M['m00'])
-                        cy = int(M['m01'] / M['m00'])
-                        
-                        # Draw line on the cropped image showing detected line
-                        cv2.line(crop_img, (cx, 0), (cx, 90), (255, 0, 0), 2)
-                        cv2.circle(crop_img, (cx, cy), 5, (0, 0, 255), -1)
-                        cv2.drawContours(crop_img, contours, -1, (0, 255, 0), 1)
-                        
-                        # JUNCTION DETECTED - Slow down and decide
-                        if is_junction or total_line_area > junction_threshold:
-                            cv2.putText(frame_with_overlay, "JUNCTION - Deciding...", (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (255, 165, 0), 2)
-                            
-                            # Slow down at junction
-                            clbrobot.t_up(15, 0.15)
-                            time.sleep(0.15)
-                            
-                            # Decision logic: Find the contour most aligned with forward direction
-                            # Check which path is most "straight ahead" (closest to center-bottom)
-                            best_contour = None
-                            best_score = float('inf')
-                            
-                            for cnt in large_contours:
-                                M_cnt = cv2.moments(cnt)
-                                if M_cnt['m00'] > 0:
-                                    cnt_cx = int(M_cnt['m10'] / M_cnt['m00'])
-                                    cnt_cy = int(M_cnt['m01'] / M_cnt['m00'])
-                                    # Score: distance from center + prefer paths lower in frame (ahead)
-                                    score = abs(cnt_cx - 160) + (90 - cnt_cy) * 0.5
-                                    if score < best_score:
-                                        best_score = score
-                                        best_contour = cnt
-                            
-                            # Use best path if found, otherwise use largest
-                            if best_contour is not None:
-                                M_best = cv2.moments(best_contour)
-                                if M_best['m00'] > 0:
-                                    cx = int(M_best['m10'] / M_best['m00'])
-                                    # Mark chosen path
-                                    cv2.drawContours(crop_img, [best_contour], -1, (255, 0, 255), 3)
-                        
-                        # Smooth proportional line following with wider dead zone
-                        error = cx - 160  # Error from center (160px)
-                        
-                        if abs(error) < 40:  # Dead zone - line is centered enough
-                            # Go straight when line is reasonably centered
-                            speed = 25 if (is_junction or total_line_area > junction_threshold) else 35
-                            clbrobot.t_up(speed, 0.15)
-                            cv2.putText(frame_with_overlay, "Forward", (10, 55), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 255, 0), 2)
-                            time.sleep(0.15)
-                            
-                        elif abs(error) > 100:  # Line is far off - aggressive turn
-                            turn_speed = 20
-                            turn_duration = 0.08
-                            if error > 0:  # Line on right
-                                clbrobot.turnRight(turn_speed, turn_duration)
-                                cv2.putText(frame_with_overlay, "Turn Right++", (10, 55), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 255, 255), 2)
-                            else:  # Line on left
-                                clbrobot.turnLeft(turn_speed, turn_duration)
-                                cv2.putText(frame_with_overlay, "Turn Left++", (10, 55), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 255, 255), 2)
-                            time.sleep(0.08)
-                            
-                        else:  # Gentle correction - proportional control
-                            turn_speed = int(abs(error) * 0.15)  # Slower turns: 6-15 speed
-                            turn_duration = 0.06
-                            if error > 0:  # Line slightly right
-                                clbrobot.turnRight(turn_speed, turn_duration)
-                                cv2.putText(frame_with_overlay, "Adjust Right", (10, 55), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 200, 255), 2)
-                            else:  # Line slightly left
-                                clbrobot.turnLeft(turn_speed, turn_duration)
-                                cv2.putText(frame_with_overlay, "Adjust Left", (10, 55), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 200, 255), 2)
-                            time.sleep(0.06)
-                    else:
-                        clbrobot.t_stop(0)
-                        cv2.putText(frame_with_overlay, "No line detected", (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 0, 255), 2)
-                        time.sleep(0.1)
-                else:
-                    clbrobot.t_stop(0)
-                    cv2.putText(frame_with_overlay, "Searching...", (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 0, 255), 2)
-                    time.sleep(0.1)
-                
-                # Put the processed crop back into frame for visualization
-                frame_with_overlay[150:240, 0:320] = crop_img
-                
+                capture.set_running(False)
             except Exception as e:
-                print(f"Line follow error: {e}")
-                clbrobot.t_stop(0)
-                time.sleep(0.1)
-            
-            current_frame = cv2.imencode('.jpg', frame_with_overlay)[1].tobytes()
+                print(f"Camera suspend error: {e}")
+            CAMERA_WAKE.wait(timeout=1.0)
+            CAMERA_WAKE.clear()
+            continue
 
-        time.sleep(0.02)  # Small delay for all modes to prevent CPU overload
+        try:
+            capture.set_running(True)
+            # The viewer stream is only copied out of the camera while someone is watching
+            watching = frame_hub.has_viewers()
+            capture.enable('main', watching)
+            start = time.perf_counter_ns()
+            held = capture.acquire(last_seq, timeout=1.0)
+            if held is None:
+                continue
+            ready = time.perf_counter_ns()
+            FRAME_WAIT_SECONDS.labels(mode).observe((ready - start) / 1e9)
+            last_seq = held.seq
+            # Vision works on the small lores stream, viewers get the main stream
+            VW, VH = VISION_SIZE
+            lores = held.arrays['lores']
+            if lores.shape[0] != VH * 3 // 2:
+                # Frame from before a /camera_config change
+                continue
+            frame_with_overlay = None
+            if watching:
+                main = held.arrays['main']
+                frame_with_overlay = frame_buffers.get('overlay', main.shape)
+                np.copyto(frame_with_overlay, main)
+            pipelines.record(mode, 'capture', time.perf_counter_ns() - start)
+            ctx = FrameContext(mode, held, lores, VISION_SIZE, frame_with_overlay,
+                               Overlay(frame_with_overlay, VISION_SIZE), watching, frame_images)
+        except Exception as e:
+            time.sleep(0.1)
+            continue
+        
+        rec = recorder
+        recorded = rec is not None and rec.frame(held.seq, held.timestamp, lores, VISION_SIZE, {
+            'mode': mode, 'color': LINE_COLOR_MODE, 'ranges': LINE_COLOR_RANGES,
+            'detector': line_mode.detector, 'size': list(VISION_SIZE)})
+        pipelines.run(ctx)
+        if recorded:
+            rec.decision(held.seq, mode, getattr(ctx, 'error', None), getattr(ctx, 'forward', None))
+        LOOP_SECONDS.labels(mode).observe((time.perf_counter_ns() - ready) / 1e9)
+        FRAMES_PROCESSED.labels(mode).inc()
+        LOOP_RATE.add(0)
+        time.sleep(pipeline.delay)  # Small delay for all modes to prevent CPU overload
 
 t = threading.Thread(target=autonomous_task)
 t.daemon = True
 t.start()
 
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+@app.after_request
+def record_request(response):
+    endpoint = request.endpoint or 'unknown'
+    HTTP_SECONDS.labels(endpoint).observe(time.perf_counter() - g.request_start)
+    HTTP_REQUESTS.labels(endpoint, str(response.status_code)).inc()
+    return response
+
 @app.route('/')
 def index():
     return render_template('index.html')
 
-@app.route('/manual_control', methods=['POST'])
-def manual_control():
+def manual_drive(command, speed=50):
+    # Shared by /manual_control and the control channel; returns the new mode
     global MODE
     
-    command = request.json.get('command')
-    speed = request.json.get('speed', 50)
-    
+    if motion_vm:
+        motion_vm.cancel()
     MODE = 'MANUAL'
+    if steering:
+        steering.release()
     
     if clbrobot:
         if command == 'forward':
@@ -341,55 +416,155 @@ def manual_control():
         elif command == 'stop':
             clbrobot.t_stop(0)
             MODE = 'STOP'
+    return MODE
+
+def move_servo(servo, steps=0, angle=None):
+    # Moves pan or tilt by steps (signed) of 5 degrees, or to angle; the servo engine
+    # gets there smoothly. PAN_ANGLE and TILT_ANGLE are the targets
+    global PAN_ANGLE, TILT_ANGLE
     
-    return jsonify({'status': 'ok', 'command': command, 'mode': MODE})
+    if servos and servo in ('pan', 'tilt'):
+        if angle is None:
+            angle = servos.target(servo) + 5 * steps
+        if servo == 'pan':
+            PAN_ANGLE = servos.set_target('pan', angle)
+        else:
+            TILT_ANGLE = servos.set_target('tilt', angle)
+
+# Manual drive over a WebSocket: updates are coalesced to at most 20 bus commands a second,
+# and the robot stops when the driving client goes quiet for half a second
+teleop = TeleopChannel(manual_drive, move_servo, rate=20, deadman=0.5)
+if Sock:
+    sock = Sock(app)
+
+    @sock.route('/control_ws')
+    def control_ws(ws):
+        teleop.serve(ws)
+
+@app.route('/manual_control', methods=['POST'])
+def manual_control():
+    command = request.json.get('command')
+    speed = request.json.get('speed', 50)
+    mode = manual_drive(command, speed)
+    return jsonify({'status': 'ok', 'command': command, 'mode': mode})
 
 @app.route('/servo_control', methods=['POST'])
 def servo_control():
-    global PAN_ANGLE, TILT_ANGLE
-    
+    # {"servo": "pan", "action": "increment"} for a 5 degree step, {"servo": "pan", "angle": 90} to aim
     servo = request.json.get('servo')
     action = request.json.get('action')
-    step = 5
+    if 'angle' in request.json:
+        try:
+            move_servo(servo, angle=float(request.json['angle']))
+        except (TypeError, ValueError):
+            return jsonify({'status': 'failed', 'message': 'angle must be a number.'})
+    elif action in ('increment', 'decrement'):
+        move_servo(servo, 1 if action == 'increment' else -1)
+    return jsonify({'status': 'ok', 'pan': PAN_ANGLE, 'tilt': TILT_ANGLE})
+
+@app.route('/servo_stats')
+def servo_stats():
+    if servos is None:
+        return jsonify({'status': 'failed', 'message': 'Servos not initialized.'})
+    return jsonify(servos.stats())
+
+@app.route('/safety', methods=['GET', 'POST'])
+def safety_control():
+    # Obstacle interlock status; POST {"enabled": false} turns it off (e.g. on a test stand)
+    if safety is None:
+        return jsonify({'status': 'failed', 'message': 'Distance sensor not available.'})
     
-    if clbrobot:
-        if servo == 'pan':
-            if action == 'increment': PAN_ANGLE += step
-            elif action == 'decrement': PAN_ANGLE -= step
-            PAN_ANGLE = max(min(PAN_ANGLE, 180), 0)
-            clbrobot.set_servo_angle(10, PAN_ANGLE)
-            
-        elif servo == 'tilt':
-            if action == 'increment': TILT_ANGLE += step
-            elif action == 'decrement': TILT_ANGLE -= step
-            TILT_ANGLE = max(min(TILT_ANGLE, 90), 0)
-            clbrobot.set_servo_angle(9, TILT_ANGLE)
+    if request.method == 'POST':
+        if 'enabled' in request.json:
+            safety.enabled = bool(request.json['enabled'])
+        if 'slow_distance' in request.json:
+            try:
+                slow_distance = float(request.json['slow_distance'])
+            except (TypeError, ValueError):
+                return jsonify({'status': 'failed', 'message': 'slow_distance must be a number.'})
+            if slow_distance <= safety.stop_distance:
+                return jsonify({'status': 'failed', 'message': 'slow_distance must be above the stop distance.'})
+            safety.slow_distance = slow_distance
+    
+    stats = safety.stats()
+    stats['status'] = 'ok'
+    return jsonify(stats)
 
-    return jsonify({'status': 'ok', 'pan': PAN_ANGLE, 'tilt': TILT_ANGLE})
+@app.route('/teleop_stats')
+def teleop_stats():
+    stats = teleop.stats()
+    stats['websocket'] = Sock is not None
+    return jsonify(stats)
+
+@app.route('/actuation_stats')
+def actuation_stats():
+    if clbrobot and clbrobot.executor:
+        return jsonify(clbrobot.executor.stats())
+    return jsonify({'status': 'failed', 'message': 'Actuation executor not running.'})
 
 @app.route('/run_instructions', methods=['POST'])
 def run_instructions():
+    # {"program": [statements]} (see program.compile_program) or the older
+    # {"instructions": "t_up:2,turnLeft:1"}; compiled once, then run by the motion VM
     global MODE
 
-    with INSTRUCTION_QUEUE.mutex:
-        INSTRUCTION_QUEUE.queue.clear()
-        
-    instructions_str = request.json.get('instructions')
+    if motion_vm is None:
+        return jsonify({'status': 'failed', 'message': 'Hardware not initialized.'})
     
-    for instruction_pair in instructions_str.split(','):
-        try:
-            cmd, duration = instruction_pair.split(':')
-            duration = float(duration)
-            if cmd in ['t_up', 't_down', 'turnLeft', 'turnRight', 't_stop']:
-                INSTRUCTION_QUEUE.put((cmd, duration))
-        except:
-            pass
-
-    if not INSTRUCTION_QUEUE.empty():
-        MODE = 'SEQUENTIAL'
-        return jsonify({'status': 'running', 'mode': MODE, 'count': INSTRUCTION_QUEUE.qsize()})
-    else:
-        return jsonify({'status': 'failed', 'message': 'No valid instructions parsed.'})
+    source = request.json.get('program', request.json.get('instructions'))
+    try:
+        program = compile_program(source)
+    except ProgramError as e:
+        return jsonify({'status': 'failed', 'message': str(e)})
+
+    # The mode is set before the program starts: a short one can finish (and reset it) at once
+    teleop.cancel()
+    MODE = 'SEQUENTIAL'
+    if steering:
+        steering.release()
+    try:
+        run = motion_vm.start(program)
+    except ProgramError as e:
+        if not motion_vm.running():
+            MODE = 'STOP'
+        return jsonify({'status': 'failed', 'message': str(e)})
+    CAMERA_WAKE.set()
+    return jsonify({'status': 'running', 'mode': MODE, 'run': run,
+                    'count': len(program.steps), 'instructions': len(program.code)})
+
+@app.route('/program', methods=['GET', 'POST'])
+def program_control():
+    # Status and timing of the motion VM; POST {"action": "stop"} cancels the running program
+    if motion_vm is None:
+        return jsonify({'status': 'failed', 'message': 'Hardware not initialized.'})
+    
+    if request.method == 'POST' and request.json.get('action') == 'stop':
+        motion_vm.cancel()
+    
+    stats = motion_vm.stats()
+    if request.args.get('listing') and motion_vm.program:
+        stats['listing'] = motion_vm.program.listing()
+    return jsonify(stats)
+
+@app.route('/program_events')
+def program_events():
+    # Server-sent events: the motion VM's progress events after ?after=<seq>
+    if motion_vm is None:
+        return jsonify({'status': 'failed', 'message': 'Hardware not initialized.'})
+    
+    def stream(after):
+        while True:
+            events = motion_vm.events(after, timeout=10.0)
+            if not events:
+                # Comment line: keeps proxies from closing the connection
+                yield ': keepalive\n\n'
+                continue
+            for event in events:
+                yield 'data: %s\n\n' % json.dumps(event)
+            after = events[-1]['seq']
+    
+    return Response(stream(request.args.get('after', 0, type=int)), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache'})
 
 @app.route('/set_mode', methods=['POST'])
 def set_mode():
@@ -397,8 +572,20 @@ def set_mode():
     
     new_mode = request.json.get('mode')
     
-    if new_mode in ['FACE_TRACK', 'LINE_FOLLOW', 'STOP']:
+    if new_mode in pipelines.selectable():
+        teleop.cancel()
+        if motion_vm:
+            motion_vm.cancel()
         MODE = new_mode
+        CAMERA_WAKE.set()
+        if face_tracker:
+            face_tracker.reset()
+        if vision_pool:
+            vision_pool.reset()
+        qr_mode.reset()
+        if steering:
+            # Only the new mode's measurements may steer (None for modes without a profile)
+            steering.release(MODE if MODE in steering.profiles else None)
         if MODE == 'STOP' and clbrobot:
             clbrobot.t_stop(0)
             
@@ -408,46 +595,178 @@ def set_mode():
 
 @app.route('/set_line_color', methods=['POST'])
 def set_line_color():
-    global LINE_COLOR_MODE, LINE_COLOR_LOWER, LINE_COLOR_UPPER
+    global LINE_COLOR_MODE, LINE_COLOR_RANGES
     
     color = request.json.get('color', 'black')
+    
+    if color == 'custom':
+        # Either one lower/upper pair or a list of ranges (for hues that wrap around)
+        ranges = request.json.get('ranges')
+        if ranges is None:
+            ranges = [(request.json.get('lower'), request.json.get('upper'))]
+        try:
+            ranges = [([int(c) for c in lower], [int(c) for c in upper]) for lower, upper in ranges]
+            if not ranges or any(len(lower) != 3 or len(upper) != 3 for lower, upper in ranges):
+                raise ValueError
+        except (TypeError, ValueError):
+            return jsonify({'status': 'failed', 'message': 'Invalid custom range.'})
+    elif color in LINE_COLORS:
+        ranges = LINE_COLORS[color]
+    else:
+        return jsonify({'status': 'failed', 'message': 'Invalid color specified.'})
+    
+    line_mode.lut = get_color_lut(ranges)
     LINE_COLOR_MODE = color
+    LINE_COLOR_RANGES = ranges
+    return jsonify({'status': 'color_set', 'color': color, 
+                   'lower': list(ranges[0][0]), 
+                   'upper': list(ranges[0][1]),
+                   'ranges': [[list(lower), list(upper)] for lower, upper in ranges]})
+
+@app.route('/set_line_detector', methods=['POST'])
+def set_line_detector():
+    detector = request.json.get('detector')
+    if detector in ['contour', 'scanline']:
+        line_mode.detector = detector
+        return jsonify({'status': 'detector_set', 'detector': detector})
     
-    # Predefined HSV color ranges
-    color_ranges = {
-        'black':  ([0, 0, 0],      [180, 255, 60]),
-        'white':  ([0, 0, 200],    [180, 30, 255]),
-        'red':    ([0, 120, 70],   [10, 255, 255]),    # Red wraps around hue
-        'red2':   ([170, 120, 70], [180, 255, 255]),   # Red second range
-        'blue':   ([100, 100, 50], [130, 255, 255]),
-        'green':  ([40, 50, 50],   [80, 255, 255]),
-        'yellow': ([20, 100, 100], [40, 255, 255]),
-        'orange': ([10, 100, 100], [25, 255, 255]),
-    }
+    return jsonify({'status': 'failed', 'message': 'Invalid detector specified.'})
+
+@app.route('/controller', methods=['GET', 'POST'])
+def controller():
+    if not steering:
+        return jsonify({'status': 'failed', 'message': 'Steering controller not running.'})
     
-    if color in color_ranges:
-        LINE_COLOR_LOWER = np.array(color_ranges[color][0])
-        LINE_COLOR_UPPER = np.array(color_ranges[color][1])
-        return jsonify({'status': 'color_set', 'color': color, 
-                       'lower': LINE_COLOR_LOWER.tolist(), 
-                       'upper': LINE_COLOR_UPPER.tolist()})
+    if request.method == 'POST':
+        profile = request.json.get('profile')
+        if profile not in steering.profiles:
+            return jsonify({'status': 'failed', 'message': 'Invalid profile specified.'})
+        gains = {name: value for name, value in request.json.items() if name in steering.profiles[profile]}
+        try:
+            rate = steering.rate
+            if 'rate' in request.json:
+                rate = float(request.json['rate'])
+                if not math.isfinite(rate):
+                    raise ValueError
+            steering.set_gains(profile, **gains)
+            steering.rate = max(5.0, min(rate, 200.0))
+        except (TypeError, ValueError):
+            return jsonify({'status': 'failed', 'message': 'Invalid gain value.'})
     
-    return jsonify({'status': 'failed', 'message': 'Invalid color specified.'})
+    return jsonify(steering.stats())
 
-def gen_frames():
-    global current_frame
-    while True:
-        if current_frame is not None:
-            yield (b'--frame\r\n'
-                   b'Content-Type: image/jpeg\r\n\r\n' + current_frame + b'\r\n')
-        else:
-            time.sleep(0.05)
+def gen_frames(max_fps=None):
+    # Blocks until the capture thread publishes a new frame instead of resending the old one
+    frames = frame_hub.stream(max_fps)
+    try:
+        for chunk in frames:
+            STREAM_FRAMES.inc()
+            STREAM_BYTES.inc(len(chunk))
+            yield chunk
+    finally:
+        # Closing the hub generator right away keeps the viewer count accurate
+        frames.close()
 
 @app.route('/video_feed')
 def video_feed():
-    return Response(gen_frames(),
+    max_fps = request.args.get('fps', type=float)
+    return Response(gen_frames(max_fps),
                     mimetype='multipart/x-mixed-replace; boundary=frame')
 
+@app.route('/camera_config', methods=['GET', 'POST'])
+def camera_config():
+    global VISION_SIZE, STREAM_SIZE
+
+    if request.method == 'POST':
+        main_size = tuple(request.json.get('main', STREAM_SIZE))
+        lores_size = tuple(request.json.get('lores', VISION_SIZE))
+        sizes_ok = all(len(size) == 2 and size[0] > 0 and size[1] > 0 and size[0] % 2 == 0 and size[1] % 2 == 0
+                       for size in (main_size, lores_size))
+        # libcamera requires the lores stream to be no larger than the main stream
+        if not sizes_ok or lores_size[0] > main_size[0] or lores_size[1] > main_size[1]:
+            return jsonify({'status': 'failed', 'message': 'Invalid stream sizes.'})
+        old_sizes = (STREAM_SIZE, VISION_SIZE)
+        STREAM_SIZE, VISION_SIZE = main_size, lores_size
+        if capture:
+            try:
+                capture.reconfigure(make_config(picamera, main_size, lores_size))
+            except Exception as e:
+                STREAM_SIZE, VISION_SIZE = old_sizes
+                return jsonify({'status': 'failed', 'message': str(e)})
+
+    return jsonify({'status': 'ok', 'main': list(STREAM_SIZE), 'lores': list(VISION_SIZE)})
+
+@app.route('/vision_stats')
+def vision_stats():
+    stats = {}
+    if vision_pool and vision_pool.alive:
+        # The face modes run on worker 0; the in-process tracker sits idle
+        if vision_pool.tracker_stats:
+            stats['face'] = vision_pool.tracker_stats
+    elif face_tracker:
+        stats['face'] = face_tracker.stats()
+    stats['qr'] = qr_mode.stats()
+    stats['images'] = frame_images.stats()
+    if vision_pool:
+        stats['workers'] = vision_pool.stats()
+    return jsonify(stats)
+
+@app.route('/pipeline_stats')
+def pipeline_stats():
+    # Per-mode, per-stage latency percentiles of the autonomous loop
+    return jsonify(pipelines.stats())
+
+@app.route('/stream_stats')
+def stream_stats():
+    stats = frame_hub.stats()
+    stats['encoded'] = FRAMES_ENCODED.get()
+    if encoder:
+        stats['encoder'] = encoder.stats()
+    if capture:
+        stats.update(capture.stats())
+    return jsonify(stats)
+
+@app.route('/recording', methods=['GET', 'POST'])
+def recording():
+    # Records the vision frames, settings, decisions and motor commands for replay.py
+    global recorder
+    
+    if request.method == 'POST':
+        action = request.json.get('action')
+        if action == 'start' and recorder is None:
+            # Clients only choose a file name; recordings always go to recordings/
+            name = request.json.get('name') or time.strftime('session-%Y%m%d-%H%M%S.rec')
+            if not isinstance(name, str) or name != os.path.basename(name) or '\\' in name \
+                    or name.startswith('.'):
+                return jsonify({'status': 'failed', 'message': 'Invalid recording name.'})
+            path = os.path.join('recordings', name)
+            try:
+                os.makedirs('recordings', exist_ok=True)
+                recorder = SessionRecorder(path, every=int(request.json.get('every', 1)))
+            except (OSError, TypeError, ValueError) as e:
+                return jsonify({'status': 'failed', 'message': str(e)})
+            if clbrobot:
+                clbrobot.command_log = recorder.command
+        elif action == 'stop' and recorder is not None:
+            if clbrobot:
+                clbrobot.command_log = None
+            finished, recorder = recorder, None
+            finished.close()
+            return jsonify(dict(finished.stats(), status='stopped'))
+        else:
+            return jsonify({'status': 'failed', 'message': 'Invalid recording action.'})
+    
+    if recorder is None:
+        return jsonify({'status': 'idle'})
+    return jsonify(dict(recorder.stats(), status='recording'))
+
+@app.route('/metrics')
+def metrics():
+    # Prometheus text by default, ?format=json for the dashboard
+    if request.args.get('format') == 'json':
+        return jsonify(REGISTRY.snapshot())
+    return Response(REGISTRY.prometheus(), mimetype='text/plain; version=0.0.4')
+
 def shutdown_session(exception=None):
     global clbrobot, picamera
     if clbrobot:
@@ -0,0 +1,27 @@
+'''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''
+@ Filename: backend.py
+@ Version: V1.0
+@ Author: Afandi Azmi
+@ Description: Hardware backend selection
+
+Real Raspberry Pi drivers, or the simulation in sim.py with MEEPOBOT_BACKEND=sim
+'''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''
+
+
+import os
+
+BACKEND = os.environ.get('MEEPOBOT_BACKEND', 'hardware')
+
+if BACKEND == 'sim':
+    # Simulated I2C bus (PCA9685 register file), GPIO and camera
+    import sim as smbus
+    from sim import LED, DistanceSensor, Button, Picamera2, MappedArray, Transform
+else:
+    import smbus2 as smbus
+    from gpiozero import LED, DistanceSensor, Button
+    try:
+        from picamera2 import Picamera2, MappedArray
+        from libcamera import Transform
+    except ImportError:
+        # The motor library works without the camera stack installed
+        Picamera2 = MappedArray = Transform = None
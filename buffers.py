@@ -0,0 +1,144 @@
+'''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''
+@ Filename: buffers.py
+@ Version: V1.0
+@ Author: Afandi Azmi
+@ Description: Frame scratch buffers
+
+Preallocated NumPy arrays reused from frame to frame by the vision and stream paths,
+and the per-frame cache of images derived from the vision frame
+'''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''
+
+
+import time
+import cv2
+import numpy as np
+
+
+class BufferPool:
+    """Named scratch arrays for per-frame work, passed as dst=/out= so the hot loop does not
+    allocate (frame-sized arrays would otherwise go through mmap/munmap and fresh page
+    faults every frame). A buffer is only reallocated when its shape or dtype changes, e.g.
+    after a resolution change. Buffers are overwritten on the next frame and a pool is not
+    thread-safe: each thread that processes frames needs its own."""
+    def __init__(self):
+        self.buffers = {}
+        self.allocations = 0
+
+    def get(self, name, shape, dtype=np.uint8):
+        shape = tuple(shape)
+        buffer = self.buffers.get(name)
+        if buffer is None or buffer.shape != shape or buffer.dtype != dtype:
+            buffer = self.buffers[name] = np.empty(shape, dtype)
+            self.allocations += 1
+        return buffer
+
+    def stats(self):
+        return {
+            'buffers': len(self.buffers),
+            'bytes': sum(buffer.nbytes for buffer in self.buffers.values()),
+            'allocations': self.allocations,
+        }
+
+
+class FrameImages:
+    """Images derived from one YUV420 (I420) vision frame, each computed the first time a
+    stage asks for it and shared by every later stage of the same frame: two modes on one
+    frame (e.g. ball tracking and line following) convert or downscale it once between them.
+    Entries are keyed by variant, parameters and ROI (x, y, w, h), and dropped when the next
+    frame starts. Results live in a BufferPool, so they are overwritten by a later frame
+    and, like a pool, an instance belongs to one thread.
+
+    gray is the Y plane itself and costs nothing. bgr converts the whole frame once and
+    crops it; hsv, small and blur are computed on the ROI only. derive() caches anything
+    else a stage computes from the frame, under the key it gives."""
+    def __init__(self):
+        self.buffers = BufferPool()
+        self.cache = {}
+        self.used = {}
+        self.seq = None
+        self.yuv = None
+        self.size = None
+        self.frames = 0
+        self.hits = 0
+        self.misses = 0
+        self.compute_ns = {}
+
+    def start(self, seq, yuv, size):
+        "Moves on to a new frame; the same frame again (same seq and array) keeps its images"
+        if seq is not None and seq == self.seq and yuv is self.yuv:
+            return self
+        self.cache.clear()
+        self.used.clear()
+        self.seq = seq
+        self.yuv = yuv
+        self.size = size
+        self.frames += 1
+        return self
+
+    def derive(self, key, compute):
+        "compute() once per frame for key (a tuple starting with the variant name)"
+        image = self.cache.get(key)
+        if image is not None:
+            self.hits += 1
+            return image
+        start = time.perf_counter_ns()
+        image = self.cache[key] = compute()
+        self.misses += 1
+        self.compute_ns[key[0]] = self.compute_ns.get(key[0], 0) + time.perf_counter_ns() - start
+        return image
+
+    def _buffer(self, name, shape, dtype=np.uint8):
+        # One buffer per use of a variant in a frame, so different ROIs do not share one
+        n = self.used.get(name, 0)
+        self.used[name] = n + 1
+        return self.buffers.get((name, n), shape, dtype)
+
+    def gray(self, roi=None):
+        w, h = self.size
+        return _crop(self.yuv[:h, :w], roi)
+
+    def bgr(self, roi=None):
+        def convert():
+            w, h = self.size
+            return cv2.cvtColor(self.yuv[:h * 3 // 2, :w], cv2.COLOR_YUV2BGR_I420,
+                                dst=self._buffer('bgr', (h, w, 3)))
+        return _crop(self.derive(('bgr',), convert), roi)
+
+    def hsv(self, roi=None):
+        def convert():
+            bgr = self.bgr(roi)
+            return cv2.cvtColor(bgr, cv2.COLOR_BGR2HSV, dst=self._buffer('hsv', bgr.shape))
+        return self.derive(('hsv', roi), convert)
+
+    def small(self, size, roi=None):
+        "Grayscale downscaled to size (width, height)"
+        size = tuple(size)
+        def resize():
+            return cv2.resize(self.gray(roi), size, dst=self._buffer('small', size[::-1]),
+                              interpolation=cv2.INTER_AREA)
+        return self.derive(('small', size, roi), resize)
+
+    def blur(self, ksize=5, roi=None, source='gray'):
+        "Gaussian blur of the gray, bgr or hsv image"
+        def smooth():
+            image = getattr(self, source)(roi)
+            return cv2.GaussianBlur(image, (ksize, ksize), 0, dst=self._buffer(('blur', source), image.shape))
+        return self.derive(('blur', source, ksize, roi), smooth)
+
+    def stats(self):
+        requests = self.hits + self.misses
+        return {
+            'frames': self.frames,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / requests, 3) if requests else 0.0,
+            'compute_ms': {name: round(ns / 1e6, 1) for name, ns in self.compute_ns.items()},
+            'buffers': self.buffers.stats(),
+        }
+
+
+def _crop(image, roi):
+    if roi is None:
+        return image
+    x, y, w, h = roi
+    return image[y:y + h, x:x + w]
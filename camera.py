@@ -0,0 +1,211 @@
+'''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''
+@ Filename: camera.py
+@ Version: V1.0
+@ Author: Afandi Azmi
+@ Description: Camera capture thread
+
+Captures Picamera2 frames on their own thread into preallocated buffers
+'''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''
+
+
+import time
+import threading
+from contextlib import ExitStack
+import cv2
+import numpy as np
+from backend import MappedArray, Transform
+
+
+def make_config(picam, main_size=(640, 480), lores_size=(320, 240)):
+    "Dual-stream config: RGB888 main stream for viewers, small YUV420 lores stream for vision"
+    config = picam.create_preview_configuration(
+        main={"format": 'RGB888', "size": tuple(main_size)},
+        lores={"format": 'YUV420', "size": tuple(lores_size)})
+    # The sensor does both flips, so frames need no per-frame cv2.flip
+    config["transform"] = Transform(hflip=1, vflip=1)
+    return config
+
+
+def yuv_gray(yuv, size):
+    "Grayscale view of a YUV420 frame: just its Y plane, no conversion"
+    w, h = size
+    return yuv[:h, :w]
+
+
+def yuv_bgr(yuv, size):
+    "Converts a YUV420 (I420) frame to BGR"
+    w, h = size
+    return cv2.cvtColor(yuv[:h * 3 // 2, :w], cv2.COLOR_YUV2BGR_I420)
+
+
+def pack_yuv420(src, size, stride, dst):
+    """Copies a YUV420 (I420) camera buffer whose rows are `stride` bytes (chroma rows
+    stride / 2) into dst, a packed (h * 3 // 2, w) frame as the vision code expects"""
+    w, h = size
+    flat = src.reshape(-1)
+    out = dst.reshape(-1)
+    np.copyto(dst[:h], flat[:h * stride].reshape(h, stride)[:, :w])
+    cw, ch, cs = w // 2, h // 2, stride // 2
+    for plane in range(2):
+        start = h * stride + plane * ch * cs
+        np.copyto(out[h * w + plane * ch * cw:h * w + (plane + 1) * ch * cw].reshape(ch, cw),
+                  flat[start:start + ch * cs].reshape(ch, cs)[:, :cw])
+
+
+class Frame:
+    "One captured frame: per-stream capture buffers plus its sequence number and sensor timestamp (ns)"
+    def __init__(self, slot, arrays):
+        self.slot = slot
+        self.arrays = arrays
+        self.seq = 0
+        self.timestamp = 0
+        self.readers = 0
+
+
+class CaptureThread:
+    """Copies each Picamera2 request straight from the camera buffer into one of a few
+    preallocated slots. Consumers get the newest slot without copying it, and a slot
+    is never overwritten while a consumer still holds it. YUV420 streams whose rows are
+    padded (the ISP aligns the stride) are packed to stride == width on the way."""
+    def __init__(self, picam, streams=('main',), slots=3):
+        self.picam = picam
+        self.streams = list(streams)
+        # Streams can be switched off, e.g. the viewer stream while nobody is watching
+        self.enabled = {stream: True for stream in self.streams}
+        self.slots = slots
+        self.frames = []
+        self.latest = None
+        self.layouts = {}    # stream -> (size, stride) for padded YUV420 streams
+        self.cond = threading.Condition()
+        # Serialises camera start/stop/configure between the loop and the Flask threads
+        self.control = threading.RLock()
+        self.running = False
+        self.captured = 0
+        self.dropped = 0
+        self.suspends = 0
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self.set_running(True)
+        self.thread.start()
+
+    def set_running(self, running):
+        "Starts or pauses the camera; stop()/start() keep the configuration so resuming is fast"
+        with self.control:
+            with self.cond:
+                if running == self.running:
+                    return
+                self.running = running
+                if running:
+                    self.picam.start()
+                else:
+                    self.suspends += 1
+                self.cond.notify_all()
+            if not running:
+                # Outside the frame lock: the capture thread may still be finishing its last request
+                self.picam.stop()
+
+    def enable(self, stream, enabled):
+        self.enabled[stream] = enabled
+
+    def reconfigure(self, config):
+        "Applies a new camera configuration; buffers are reallocated for the new sizes"
+        with self.control:
+            running = self.running
+            self.set_running(False)
+            with self.cond:
+                # Wait for consumers to hand back their slots before dropping them
+                self.cond.wait_for(lambda: all(frame.readers == 0 for frame in self.frames), 1.0)
+                self.frames = []
+                self.latest = None
+            self.picam.configure(config)
+            if running:
+                self.set_running(True)
+
+    def acquire(self, last_seq=0, timeout=1.0):
+        "Returns the newest frame after last_seq (held until release) or None on timeout"
+        with self.cond:
+            ready = self.cond.wait_for(lambda: self.latest is not None and self.latest.seq != last_seq, timeout)
+            if not ready:
+                return None
+            frame = self.latest
+            frame.readers += 1
+            return frame
+
+    def release(self, frame):
+        with self.cond:
+            frame.readers -= 1
+            self.cond.notify_all()
+
+    def stats(self):
+        return {
+            'running': self.running,
+            'captured': self.captured,
+            'capture_dropped': self.dropped,
+            'suspends': self.suspends,
+        }
+
+    def _layout(self, name, array):
+        # (size, stride) of a YUV420 stream with padded rows, None for anything else
+        config = self.picam.stream_configuration(name)
+        if config.get('format') != 'YUV420':
+            return None
+        w, h = config['size']
+        stride = config.get('stride') or array.shape[1]
+        return ((w, h), stride) if stride != w else None
+
+    def _free_slot(self):
+        for frame in self.frames:
+            if frame is not self.latest and frame.readers == 0:
+                return frame
+        return None
+
+    def _store(self, arrays, timestamp):
+        with self.cond:
+            if not self.frames:
+                self.layouts = {name: layout for name, layout in
+                                ((name, self._layout(name, a)) for name, a in arrays.items()) if layout}
+                shapes = {name: (a.shape if name not in self.layouts else
+                                 (self.layouts[name][0][1] * 3 // 2, self.layouts[name][0][0]))
+                          for name, a in arrays.items()}
+                self.frames = [Frame(i, {name: np.empty(shapes[name], a.dtype) for name, a in arrays.items()})
+                               for i in range(self.slots)]
+            frame = self._free_slot()
+            if frame is None:
+                # Every slot is held by a consumer, skip this frame rather than overwrite one
+                self.dropped += 1
+                return
+        for name, array in arrays.items():
+            if not self.enabled[name]:
+                continue
+            if name in self.layouts:
+                size, stride = self.layouts[name]
+                pack_yuv420(array, size, stride, frame.arrays[name])
+            else:
+                np.copyto(frame.arrays[name], array)
+        with self.cond:
+            self.captured += 1
+            frame.seq = self.captured
+            frame.timestamp = timestamp
+            self.latest = frame
+            self.cond.notify_all()
+
+    def _run(self):
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: self.running)
+            try:
+                request = self.picam.capture_request()
+            except Exception as e:
+                time.sleep(0.1)
+                continue
+            try:
+                timestamp = request.get_metadata().get('SensorTimestamp', time.monotonic_ns())
+                with ExitStack() as stack:
+                    arrays = {stream: stack.enter_context(MappedArray(request, stream)).array
+                              for stream in self.streams}
+                    self._store(arrays, timestamp)
+            except Exception as e:
+                print(f"Capture error: {e}")
+            finally:
+                request.release()
@@ -0,0 +1,169 @@
+'''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''
+@ Filename: control.py
+@ Version: V1.0
+@ Author: Afandi Azmi
+@ Description: Closed-loop steering
+
+Fixed-rate PID steering controller fed by the vision modes
+'''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''
+
+
+import math
+import time
+import threading
+
+
+# Gains per vision mode. Errors are normalised to -1..1 (target at the left/right edge),
+# outputs are wheel duty. Forward speed falls to zero as |error| reaches slow_error.
+DEFAULT_PROFILES = {
+    'FACE_TRACK':  {'kp': 48.0, 'ki': 0.0, 'kd': 4.0, 'slow_error': 0.5, 'max_turn': 40.0},
+    'LINE_FOLLOW': {'kp': 32.0, 'ki': 2.0, 'kd': 3.0, 'slow_error': 0.6, 'max_turn': 30.0},
+}
+
+
+class SteeringController:
+    """Runs a PID loop on a fixed tick. Vision modes post their latest error with
+    set_measurement(); every tick turns the newest error into a forward speed and a turn
+    rate for MEEPOBOT.drive. A measurement older than `timeout` stops the wheels.
+
+    Only the active profile (see release) may post: a vision pass still in flight when the
+    mode changes cannot steer over whatever drives the robot next."""
+    def __init__(self, robot, rate=50, timeout=0.3, profiles=None):
+        self.robot = robot
+        self.rate = rate
+        self.timeout = timeout
+        self.profiles = {name: dict(gains) for name, gains in (profiles or DEFAULT_PROFILES).items()}
+        self.lock = threading.Lock()
+        self.profile = None
+        self.active = None
+        self.dropped = 0
+        self.error = None
+        self.forward = 0.0
+        self.measured_at = 0.0
+        self.derivative = 0.0
+        self.integral = 0.0
+        self.driving = False
+        self.output = (0.0, 0.0)
+        self.ticks = 0
+        self.overruns = 0
+        self.jitter_total = 0.0
+        self.jitter_max = 0.0
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def set_measurement(self, profile, error, forward):
+        "Latest normalised error (-1..1, positive = target to the right) and base forward speed"
+        now = time.monotonic()
+        with self.lock:
+            if profile != self.active:
+                self.dropped += 1
+                return
+            if profile != self.profile:
+                self.profile = profile
+                self.integral = 0.0
+                self.error = None
+            if self.error is not None and now > self.measured_at:
+                self.derivative = (error - self.error) / (now - self.measured_at)
+            else:
+                self.derivative = 0.0
+            self.error = error
+            self.forward = forward
+            self.measured_at = now
+
+    def clear(self, profile=None):
+        "Drops the measurement (target lost); the next tick stops the wheels"
+        with self.lock:
+            if profile is None or profile == self.active:
+                self.error = None
+
+    def release(self, active=None):
+        """Gives the wheels up without stopping them, for whoever drives next (manual control,
+        a program, another mode), and lets only profile `active` post from now on"""
+        with self.lock:
+            self.active = active
+            self.error = None
+            self.integral = 0.0
+            self.derivative = 0.0
+            self.driving = False
+            self.output = (0.0, 0.0)
+
+    def set_gains(self, profile, **gains):
+        """Updates some gains of profile. All values are checked first (finite, kp/ki/kd and
+        max_turn >= 0, slow_error > 0); ValueError leaves the profile unchanged"""
+        values = {name: float(value) for name, value in gains.items() if name in self.profiles[profile]}
+        for name, value in values.items():
+            if not math.isfinite(value) or value < 0 or (name == 'slow_error' and value == 0):
+                raise ValueError('invalid %s: %r' % (name, value))
+        with self.lock:
+            self.profiles[profile].update(values)
+            return dict(self.profiles[profile])
+
+    def stats(self):
+        return {
+            'rate': self.rate,
+            'ticks': self.ticks,
+            'overruns': self.overruns,
+            'jitter_avg_ms': 1000 * self.jitter_total / self.ticks if self.ticks else 0.0,
+            'jitter_max_ms': 1000 * self.jitter_max,
+            'active': self.active,
+            'dropped': self.dropped,
+            'forward': round(self.output[0], 1),
+            'turn': round(self.output[1], 1),
+            'profiles': self.profiles,
+        }
+
+    def _tick(self, dt):
+        with self.lock:
+            stale = self.error is None or time.monotonic() - self.measured_at > self.timeout
+            if stale:
+                self.error = None
+                command = None
+            else:
+                gains = self.profiles[self.profile]
+                self.integral += self.error * dt
+                # Anti-windup: the integral alone may never ask for more than max_turn
+                if gains['ki'] > 0:
+                    limit = gains['max_turn'] / gains['ki']
+                    self.integral = max(-limit, min(self.integral, limit))
+                turn = gains['kp'] * self.error + gains['ki'] * self.integral + gains['kd'] * self.derivative
+                turn = max(-gains['max_turn'], min(turn, gains['max_turn']))
+                forward = self.forward * max(0.0, 1.0 - abs(self.error) / gains['slow_error'])
+                command = (forward, turn)
+            # Sent under the lock (the robot is non-blocking), so nothing goes out after release()
+            if command is None:
+                if self.driving:
+                    self.robot.t_stop(0)
+                    self.driving = False
+                    self.output = (0.0, 0.0)
+                return
+            forward, turn = command
+            # Target to the right (positive error) means turning clockwise, i.e. negative omega.
+            # The short deadline stops the wheels by itself if this loop ever stalls.
+            self.robot.driveFor(forward, 0, -turn, 5.0 / self.rate)
+            self.driving = True
+            self.output = command
+
+    def _run(self):
+        period = 1.0 / self.rate
+        next_tick = time.monotonic() + period
+        while True:
+            delay = next_tick - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            now = time.monotonic()
+            lateness = now - next_tick
+            self.ticks += 1
+            self.jitter_total += abs(lateness)
+            self.jitter_max = max(self.jitter_max, abs(lateness))
+            try:
+                self._tick(period)
+            except Exception as e:
+                print(f"Steering controller error: {e}")
+            next_tick += period
+            if time.monotonic() > next_tick:
+                # The tick ran past the next deadline: count it and resynchronise
+                self.overruns += 1
+                next_tick = time.monotonic() + period
+            period = 1.0 / self.rate
@@ -0,0 +1,204 @@
+'''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''
+@ Filename: metrics.py
+@ Version: V1.0
+@ Author: Afandi Azmi
+@ Description: Metrics registry
+
+Counters, gauges and histograms, exported as Prometheus text or JSON
+'''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''
+
+
+import gc
+import math
+import time
+from bisect import bisect_left
+
+
+# Default histogram buckets in seconds, from I2C writes to slow vision passes
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+# Garbage collector pauses: young-generation passes take tens of microseconds
+GC_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1)
+
+
+class Counter:
+    "Monotonic count. With fn, the value is read from fn() at scrape time instead"
+    def __init__(self, fn=None):
+        self.value = 0
+        self.fn = fn
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def get(self):
+        return self.fn() if self.fn else self.value
+
+
+class Gauge(Counter):
+    "Value that goes up and down. With fn, it is only computed when scraped"
+    def set(self, value):
+        self.value = value
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+
+class Histogram:
+    "Fixed-bucket histogram; observe() is a bisect and three additions"
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        "Estimate of the q-quantile, interpolated inside the bucket it falls in"
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if n and seen + n >= rank:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                upper = self.buckets[i] if i < len(self.buckets) else self.buckets[-1]
+                return lower + (upper - lower) * (rank - seen) / n
+            seen += n
+        return self.buckets[-1]
+
+
+class Family:
+    "One metric name with its help text; holds a child per combination of label values"
+    def __init__(self, kind, name, help, labelnames, make):
+        self.kind = kind
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.make = make
+        self.children = {}
+
+    def labels(self, *values):
+        "The child for these label values, created on first use; keep it to skip the lookup"
+        child = self.children.get(values)
+        if child is None:
+            child = self.children.setdefault(values, self.make())
+        return child
+
+
+class Registry:
+    """All metrics of the app. Updates are plain attribute arithmetic without locks, so the
+    hot paths pay next to nothing; callback metrics and quantiles are only computed when
+    /metrics is scraped. A racing update from two threads can rarely lose a count."""
+    def __init__(self):
+        self.families = {}
+
+    def _add(self, kind, name, help, labels, make):
+        if name in self.families:
+            family = self.families[name]
+        else:
+            family = self.families[name] = Family(kind, name, help, labels, make)
+        # Metrics without labels hand out their single child directly
+        return family if labels else family.labels()
+
+    def counter(self, name, help, labels=(), fn=None):
+        return self._add('counter', name, help, labels, lambda: Counter(fn))
+
+    def gauge(self, name, help, labels=(), fn=None):
+        return self._add('gauge', name, help, labels, lambda: Gauge(fn))
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return self._add('histogram', name, help, labels, lambda: Histogram(buckets))
+
+    def _read(self, child):
+        try:
+            return child.get()
+        except Exception:
+            # A callback whose source is gone (e.g. hardware failed to start)
+            return float('nan')
+
+    def prometheus(self):
+        "Prometheus text exposition format (version 0.0.4)"
+        lines = []
+        for family in list(self.families.values()):
+            lines.append('# HELP %s %s' % (family.name, family.help))
+            lines.append('# TYPE %s %s' % (family.name, family.kind))
+            for values, child in list(family.children.items()):
+                pairs = ['%s="%s"' % (k, v) for k, v in zip(family.labelnames, values)]
+                if family.kind != 'histogram':
+                    lines.append('%s%s %s' % (family.name, _labels(pairs), _number(self._read(child))))
+                    continue
+                cumulative = 0
+                for bound, n in zip(child.buckets + (math.inf,), list(child.counts)):
+                    cumulative += n
+                    le = '+Inf' if bound == math.inf else repr(bound)
+                    lines.append('%s_bucket%s %d' % (family.name, _labels(pairs + ['le="%s"' % le]), cumulative))
+                lines.append('%s_sum%s %s' % (family.name, _labels(pairs), _number(child.sum)))
+                lines.append('%s_count%s %d' % (family.name, _labels(pairs), child.count))
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self):
+        """JSON-friendly view for the dashboard: {name: {label string: value}}; histograms
+        give count, sum and estimated p50/p95/p99 in milliseconds"""
+        result = {}
+        for family in list(self.families.values()):
+            series = {}
+            for values, child in list(family.children.items()):
+                key = ','.join('%s=%s' % pair for pair in zip(family.labelnames, values))
+                if family.kind != 'histogram':
+                    value = self._read(child)
+                    series[key] = None if isinstance(value, float) and math.isnan(value) else value
+                    continue
+                series[key] = {
+                    'count': child.count,
+                    'sum': child.sum,
+                    'p50_ms': round(1000 * child.quantile(0.50), 3),
+                    'p95_ms': round(1000 * child.quantile(0.95), 3),
+                    'p99_ms': round(1000 * child.quantile(0.99), 3),
+                }
+            result[family.name] = {'type': family.kind, 'help': family.help, 'series': series}
+        return result
+
+
+def _labels(pairs):
+    return '{%s}' % ','.join(pairs) if pairs else ''
+
+
+def _number(value):
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    if isinstance(value, float) and math.isnan(value):
+        return 'NaN'
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class GCWatch:
+    """Times every garbage collector pass through gc.callbacks; pauses go into a histogram
+    family labelled by generation, objects freed into a counter"""
+    def __init__(self, pauses, collected=None):
+        self.pauses = pauses
+        self.collected = collected
+        self.started = 0.0
+
+    def start(self):
+        if self._callback not in gc.callbacks:
+            gc.callbacks.append(self._callback)
+        return self
+
+    def stop(self):
+        if self._callback in gc.callbacks:
+            gc.callbacks.remove(self._callback)
+
+    def _callback(self, phase, info):
+        if phase == 'start':
+            self.started = time.perf_counter()
+            return
+        self.pauses.labels(str(info['generation'])).observe(time.perf_counter() - self.started)
+        if self.collected is not None:
+            self.collected.inc(info['collected'])
+
+
+# The process-wide registry the app and the hardware library report into
+REGISTRY = Registry()
@@ -0,0 +1,369 @@
+'''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''
+@ Filename: modes.py
+@ Version: V1.0
+@ Author: Afandi Azmi
+@ Description: Vision modes
+
+FACE_TRACK and LINE_FOLLOW stages, shared by the app and the replay benchmark
+'''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''
+
+
+import time
+import cv2
+from vision import scan_line
+from buffers import BufferPool
+
+
+def detect_line_contours(mask, top, k, size, out=None):
+    # Contour detector: returns the line found in the mask, 'cx' is None when there is none.
+    # out: preallocated array (mask shape) for the cleaned-up mask
+    VW, VH = size
+    line = {'cx': None, 'junction': False, 'marker': None, 'contours': [], 'chosen': None, 'status': 'Searching...'}
+
+    # Clean up the mask (the dilate runs in place)
+    mask = cv2.erode(mask, None, dst=out, iterations=2)
+    mask = cv2.dilate(mask, None, dst=mask, iterations=2)
+
+    # findContours leaves its input untouched since OpenCV 3.2, no copy needed
+    contours, hierarchy = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    line['contours'] = contours
+
+    if len(contours) == 0:
+        return line
+
+    # Junction detection: Check if multiple significant contours exist
+    large_contours = [cnt for cnt in contours if cv2.contourArea(cnt) > 500 * k * k]
+
+    # Calculate total line area (junction indicator)
+    total_line_area = sum([cv2.contourArea(cnt) for cnt in contours])
+    junction_threshold = 8000 * k * k  # Large area = junction/intersection
+    is_junction = len(large_contours) > 1 or total_line_area > junction_threshold
+
+    c = max(contours, key=cv2.contourArea)
+    M = cv2.moments(c)
+
+    if M['m00'] <= 0:
+        line['status'] = "No line detected"
+        return line
+
+    cx = int(M['m10'] / M['m00'])
+    cy = int(M['m01'] / M['m00'])
+    line['marker'] = (cx, cy)
+
+    # JUNCTION DETECTED - Slow down and decide
+    if is_junction:
+        # Decision logic: Find the contour most aligned with forward direction
+        # Check which path is most "straight ahead" (closest to center-bottom)
+        best_contour = None
+        best_score = float('inf')
+
+        for cnt in large_contours:
+            M_cnt = cv2.moments(cnt)
+            if M_cnt['m00'] > 0:
+                cnt_cx = int(M_cnt['m10'] / M_cnt['m00'])
+                cnt_cy = int(M_cnt['m01'] / M_cnt['m00'])
+                # Score: distance from center + prefer paths lower in frame (ahead)
+                score = abs(cnt_cx - VW / 2) + (VH - top - cnt_cy) * 0.5
+                if score < best_score:
+                    best_score = score
+                    best_contour = cnt
+
+        # Use best path if found, otherwise use largest
+        if best_contour is not None:
+            M_best = cv2.moments(best_contour)
+            if M_best['m00'] > 0:
+                cx = int(M_best['m10'] / M_best['m00'])
+                line['chosen'] = best_contour
+
+    line['cx'] = cx
+    line['junction'] = is_junction
+    return line
+
+def draw_line_contours(overlay, line, top, size):
+    VH = size[1]
+    if line['marker'] is None:
+        overlay.text(line['status'], (10, 30), 0.7, (0, 0, 255), 2)
+        return
+
+    # Draw line on the cropped region showing detected line
+    cx, cy = line['marker']
+    overlay.line((cx, top), (cx, VH), (255, 0, 0), 2)
+    overlay.circle((cx, top + cy), 5, (0, 0, 255), -1)
+    overlay.contours(line['contours'], (0, 255, 0), 1, offset=(0, top))
+
+    if line['junction']:
+        overlay.text("JUNCTION - Deciding...", (10, 30), 0.6, (255, 165, 0), 2)
+        if line['chosen'] is not None:
+            # Mark chosen path
+            overlay.contours([line['chosen']], (255, 0, 255), 3, offset=(0, top))
+
+def detect_line_scanline(mask):
+    # Scanline detector: band histograms give near/far line centers for lookahead steering
+    line = scan_line(mask, bands=4)
+    line['cx'] = line['target']
+    return line
+
+def draw_line_scanline(overlay, line, top, size):
+    if line['target'] is None:
+        overlay.text("Searching...", (10, 30), 0.7, (0, 0, 255), 2)
+        return
+
+    # Mark each band's line center, far bands at the top of the crop
+    VH = size[1]
+    band_height = line['band_height']
+    first_row = VH - band_height * len(line['centers'])
+    for band, center in enumerate(line['centers']):
+        if center is not None:
+            overlay.circle((center, first_row + band_height * band + band_height // 2), 4, (0, 0, 255), -1)
+    overlay.line((line['target'], top), (line['target'], VH), (255, 0, 0), 2)
+    if line['junction']:
+        overlay.text("JUNCTION", (10, 30), 0.6, (255, 165, 0), 2)
+
+
+class FaceTrackMode:
+    """FACE_TRACK: find the face on the Y plane and steer towards it. Each stage leaves its
+    result on the FrameContext (face box, normalised error, forward speed); without a
+    steering controller (replay) the decision is only recorded there."""
+    def __init__(self, tracker, steering=None, forward=30):
+        self.tracker = tracker
+        self.steering = steering
+        self.forward = forward
+
+    # Context fields set by compute_stages(), all steer() and draw() need
+    RESULT = ('face',)
+
+    def compute_stages(self):
+        return [('detect', self.detect)]
+
+    def stages(self):
+        return self.compute_stages() + [('steer', self.steer), ('overlay', self.draw, True)]
+
+    def detect(self, ctx):
+        # The Y plane of the lores stream is already grayscale
+        ctx.face = self.tracker.update(ctx.images.gray(), ctx.images)
+
+    def steer(self, ctx):
+        if ctx.face is None:
+            ctx.error = None
+            if self.steering:
+                self.steering.clear('FACE_TRACK')
+            return
+
+        x, y, w, h = ctx.face
+        dispW = ctx.size[0]
+        errorPan = x + w / 2 - dispW / 2
+
+        # Closed-loop steering: the controller thread turns the error into wheel commands
+        ctx.error = errorPan / (dispW / 2)
+        ctx.forward = self.forward
+        if self.steering:
+            self.steering.set_measurement('FACE_TRACK', ctx.error, ctx.forward)
+
+    def draw(self, ctx):
+        overlay = ctx.overlay
+        VW, VH = ctx.size
+
+        if ctx.face is None:
+            overlay.text("SEARCHING...", (10, 30), 0.7, (0, 0, 255), 2)
+            return
+
+        x, y, w, h = ctx.face
+        overlay.rectangle((x, y), (x+w, y+h), (0, 255, 0), 2)
+
+        # Draw center point
+        Xcent = int(x + w / 2)
+        Ycent = int(y + h / 2)
+        overlay.circle((Xcent, Ycent), 5, (0, 255, 0), -1)
+
+        # Draw crosshair
+        overlay.line((VW // 2, 0), (VW // 2, VH), (255, 0, 0), 1)
+        overlay.line((0, VH // 2), (VW, VH // 2), (255, 0, 0), 1)
+        overlay.text("TRACKING %+.2f" % ctx.error, (10, 30), 0.7, (0, 255, 0), 2)
+
+
+class PanTiltTrackMode(FaceTrackMode):
+    """FACE_PAN_TILT: keep the face in the middle of the picture with the camera servos;
+    the wheels stay still. Each frame aims the servos where the face is now: the current
+    angle plus gain times the face's offset in degrees (offset from the centre, as a
+    fraction of half the picture, times half the field of view). The servo engine smooths
+    the move, so the gain below 1 is what keeps it from overshooting while frames arrive.
+    Face right of centre means panning to a lower angle, below centre a higher tilt."""
+    def __init__(self, tracker, servos=None, gain=0.6, deadband=0.05, fov=(62.2, 48.8)):
+        FaceTrackMode.__init__(self, tracker)
+        self.servos = servos
+        self.gain = gain
+        self.deadband = deadband
+        # Pi Camera v2 field of view (horizontal, vertical) in degrees
+        self.fov = fov
+
+    def steer(self, ctx):
+        ctx.forward = 0
+        if ctx.face is None:
+            ctx.error = None
+            return
+
+        x, y, w, h = ctx.face
+        VW, VH = ctx.size
+        ctx.error = (x + w / 2 - VW / 2) / (VW / 2)
+        ctx.tilt_error = (y + h / 2 - VH / 2) / (VH / 2)
+        if self.servos is None:
+            return
+        if abs(ctx.error) > self.deadband:
+            self.servos.set_target('pan', self.servos.angle('pan') - self.gain * ctx.error * self.fov[0] / 2)
+        if abs(ctx.tilt_error) > self.deadband:
+            self.servos.set_target('tilt', self.servos.angle('tilt') + self.gain * ctx.tilt_error * self.fov[1] / 2)
+
+    def draw(self, ctx):
+        FaceTrackMode.draw(self, ctx)
+        if self.servos is not None:
+            ctx.overlay.text("PAN %.0f TILT %.0f" % (self.servos.angle('pan'), self.servos.angle('tilt')),
+                             (10, 55), 0.6, (0, 255, 0), 2)
+
+
+class LineFollowMode:
+    """LINE_FOLLOW: segment the line colour with the LUT, find the line with the selected
+    detector ('contour' or 'scanline') and steer along it, slower through junctions"""
+    def __init__(self, lut, detector='contour', steering=None, forward=35, junction_forward=25):
+        self.lut = lut
+        self.detector = detector
+        self.steering = steering
+        self.forward = forward
+        self.junction_forward = junction_forward
+        self.buffers = BufferPool()
+
+    RESULT = ('top', 'detector', 'line')
+
+    def compute_stages(self):
+        return [('segment', self.segment), ('detect', self.detect)]
+
+    def stages(self):
+        return self.compute_stages() + [('steer', self.steer), ('overlay', self.draw, True)]
+
+    def segment(self, ctx):
+        # Only the lower portion of the frame is used (rows 150:240 at 320x240)
+        ctx.top = ctx.size[1] * 150 // 240
+
+        # Segment the selected color straight from the YUV planes with the compiled LUT
+        ctx.mask = ctx.images.derive(('line_mask', self.lut, ctx.top),
+                                     lambda: self.lut.apply(ctx.lores, ctx.size, ctx.top))
+
+    def detect(self, ctx):
+        ctx.detector = self.detector
+        if ctx.detector == 'scanline':
+            ctx.line = detect_line_scanline(ctx.mask)
+        else:
+            # Pixel thresholds were tuned at 320x240, k rescales them to the vision size
+            ctx.line = detect_line_contours(ctx.mask, ctx.top, ctx.size[0] / 320.0, ctx.size,
+                                            self.buffers.get('clean', ctx.mask.shape))
+
+    def steer(self, ctx):
+        cx = ctx.line['cx']
+        if cx is None:
+            ctx.error = None
+            if self.steering:
+                self.steering.clear('LINE_FOLLOW')
+            return
+
+        # Closed-loop steering on the offset from center, slower through junctions
+        VW = ctx.size[0]
+        ctx.error = (cx - VW / 2) / (VW / 2)
+        ctx.forward = self.junction_forward if ctx.line['junction'] else self.forward
+        if self.steering:
+            self.steering.set_measurement('LINE_FOLLOW', ctx.error, ctx.forward)
+
+    def draw(self, ctx):
+        if ctx.detector == 'scanline':
+            draw_line_scanline(ctx.overlay, ctx.line, ctx.top, ctx.size)
+        else:
+            draw_line_contours(ctx.overlay, ctx.line, ctx.top, ctx.size)
+        if ctx.line['cx'] is not None:
+            ctx.overlay.text("Follow %+.2f" % ctx.error, (10, 55), 0.7, (0, 255, 0), 2)
+
+
+# QR payload keyword -> (MEEPOBOT movement, speed), as in notebook 10_qr_code_navigation
+QR_COMMANDS = (
+    ('Run', 't_up', 30),
+    ('Back', 't_down', 30),
+    ('Left', 'turnLeft', 30),
+    ('Right', 'turnRight', 30),
+    ('Stop', 't_stop', 0),
+)
+
+
+def parse_qr_command(payload):
+    "(movement, speed) for a QR payload; anything without a keyword means stop"
+    for keyword, movement, speed in QR_COMMANDS:
+        if keyword.lower() in payload.lower():
+            return movement, speed
+    return 't_stop', 0
+
+
+class QRNavMode:
+    """QR_NAV: drive by the QR codes in front of the camera. The QRReader decodes on its own
+    thread, so the detect stage only hands it the Y plane. Each payload is parsed once and
+    kept in a cache. A code only triggers its command when it is new: the same payload
+    again triggers nothing while it stays in view, and only re-arms after it has been out
+    of sight for `rearm` seconds. Commands run for `duration` seconds (non-blocking)."""
+    def __init__(self, reader, robot=None, duration=1.0, rearm=2.0):
+        self.reader = reader
+        self.robot = robot
+        self.duration = duration
+        self.rearm = rearm
+        self.commands = {}
+        self.active = None
+        self.last_seen = 0.0
+        self.triggered = 0
+        self.suppressed = 0
+
+    RESULT = ('qr',)
+
+    def compute_stages(self):
+        return [('detect', self.detect)]
+
+    def stages(self):
+        return self.compute_stages() + [('steer', self.steer), ('overlay', self.draw, True)]
+
+    def reset(self):
+        self.reader.reset()
+        self.active = None
+
+    def detect(self, ctx):
+        ctx.qr = self.reader.update(ctx.images.gray(), ctx.frame.seq if ctx.frame else 0,
+                                    ctx.images.small(self.reader.thumb_size))
+
+    def steer(self, ctx):
+        ctx.error = None
+        if ctx.qr is None:
+            return
+        payload = ctx.qr[0]
+        now = time.monotonic()
+        if payload == self.active and now - self.last_seen < self.rearm:
+            self.suppressed += 1
+        else:
+            if payload not in self.commands:
+                self.commands[payload] = parse_qr_command(payload)
+            movement, speed = self.commands[payload]
+            self.active = payload
+            self.triggered += 1
+            ctx.command = movement
+            if self.robot:
+                if movement == 't_stop':
+                    self.robot.t_stop(0)
+                else:
+                    getattr(self.robot, movement)(speed, self.duration)
+        self.last_seen = now
+
+    def draw(self, ctx):
+        overlay = ctx.overlay
+        if ctx.qr is None:
+            overlay.text("SCANNING...", (10, 30), 0.7, (0, 0, 255), 2)
+            return
+        payload, (x, y, w, h) = ctx.qr
+        overlay.rectangle((x, y), (x + w, y + h), (255, 255, 0), 2)
+        overlay.text("QR: %s -> %s" % (payload[:24], self.commands.get(payload, ('?',))[0]), (10, 30), 0.6, (0, 255, 0), 2)
+
+    def stats(self):
+        stats = self.reader.stats()
+        stats.update({'active': self.active, 'triggered': self.triggered, 'suppressed': self.suppressed,
+                      'cached_payloads': len(self.commands)})
+        return stats
@@ -0,0 +1,156 @@
+'''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''
+@ Filename: pipeline.py
+@ Version: V1.0
+@ Author: Afandi Azmi
+@ Description: Mode pipelines
+
+Robot modes as named, timed stages run once per camera frame
+'''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''
+
+
+import time
+import threading
+from collections import deque
+from buffers import FrameImages
+
+
+# Returned by a stage to end the current pass early
+STOP_PASS = object()
+
+
+class LatencyStats:
+    "Rolling latency percentiles over the last `window` samples"
+    def __init__(self, window=512):
+        self.samples = deque(maxlen=window)
+        self.lock = threading.Lock()
+        self.count = 0
+
+    def add(self, ns):
+        with self.lock:
+            self.samples.append(ns)
+            self.count += 1
+
+    def stats(self):
+        with self.lock:
+            samples = sorted(self.samples)
+        if not samples:
+            return {'count': self.count, 'p50_ms': 0.0, 'p95_ms': 0.0, 'p99_ms': 0.0, 'max_ms': 0.0}
+        def pick(q):
+            return round(samples[int(q * (len(samples) - 1))] / 1e6, 3)
+        return {
+            'count': self.count,
+            'p50_ms': pick(0.50),
+            'p95_ms': pick(0.95),
+            'p99_ms': pick(0.99),
+            'max_ms': round(samples[-1] / 1e6, 3),
+        }
+
+
+class FrameContext:
+    """Everything the stages of one pass share: the vision frame, the viewer image (None
+    while nobody is watching) and its overlay. Stages hand results on as new attributes.
+    images gives the gray/BGR/HSV/downscaled variants of the vision frame (FrameImages);
+    loops pass their own so its buffers carry over from frame to frame."""
+    def __init__(self, mode, frame=None, lores=None, size=None, image=None, overlay=None, watching=False,
+                 images=None):
+        self.mode = mode
+        self.frame = frame
+        self.lores = lores
+        self.size = size
+        self.image = image
+        self.overlay = overlay
+        self.watching = watching
+        self.images = (images or FrameImages()).start(frame.seq if frame is not None else None, lores, size)
+
+
+class Stage:
+    "A named step of a mode. Optional stages only matter to viewers and are skipped without one"
+    def __init__(self, name, func, optional=False):
+        self.name = name
+        self.func = func
+        self.optional = optional
+        self.timing = LatencyStats()
+        self.skipped = 0
+
+
+class ModePipeline:
+    """The stages a mode runs for every frame, in order. A stage may return STOP_PASS to
+    end the pass early. Modes that do not use the camera (uses_camera=False) let it sleep
+    while nobody is watching; `delay` is the pause after each pass."""
+    def __init__(self, name, stages, uses_camera=True, selectable=True, delay=0.02, on_error=None):
+        self.name = name
+        self.stages = stages
+        self.uses_camera = uses_camera
+        self.selectable = selectable
+        self.delay = delay
+        self.on_error = on_error
+        self.timing = LatencyStats()
+        self.errors = 0
+
+
+class PipelineRunner:
+    """Registry of mode pipelines; runs one pass of a mode and times every stage with
+    perf_counter_ns. Stage times also go to `histogram` (labelled mode, stage) if given."""
+    def __init__(self, histogram=None):
+        self.modes = {}
+        self.extra = {}
+        self.histogram = histogram
+
+    def register(self, name, stages, **options):
+        """Adds (or replaces) a mode. stages is a list of Stage objects or (name, func) /
+        (name, func, optional) tuples"""
+        stages = [s if isinstance(s, Stage) else Stage(*s) for s in stages]
+        self.modes[name] = ModePipeline(name, stages, **options)
+        return self.modes[name]
+
+    def get(self, name):
+        return self.modes.get(name)
+
+    def selectable(self):
+        return [name for name, pipeline in self.modes.items() if pipeline.selectable]
+
+    def record(self, mode, name, ns):
+        "Times work done outside the stages (e.g. waiting for the frame) under the mode's stats"
+        key = (mode, name)
+        if key not in self.extra:
+            self.extra[key] = LatencyStats()
+        self.extra[key].add(ns)
+
+    def run(self, ctx):
+        "Runs every stage of ctx.mode once; returns the pipeline, or None for an unknown mode"
+        pipeline = self.modes.get(ctx.mode)
+        if pipeline is None:
+            return None
+        start = time.perf_counter_ns()
+        try:
+            for stage in pipeline.stages:
+                if stage.optional and not ctx.watching:
+                    stage.skipped += 1
+                    continue
+                t0 = time.perf_counter_ns()
+                result = stage.func(ctx)
+                elapsed = time.perf_counter_ns() - t0
+                stage.timing.add(elapsed)
+                if self.histogram is not None:
+                    self.histogram.labels(ctx.mode, stage.name).observe(elapsed / 1e9)
+                if result is STOP_PASS:
+                    break
+        except Exception as e:
+            pipeline.errors += 1
+            if pipeline.on_error is None:
+                raise
+            pipeline.on_error(ctx, e)
+        pipeline.timing.add(time.perf_counter_ns() - start)
+        return pipeline
+
+    def stats(self):
+        stats = {}
+        for name, pipeline in self.modes.items():
+            stages = {}
+            for (mode, extra), timing in list(self.extra.items()):
+                if mode == name:
+                    stages[extra] = timing.stats()
+            for stage in pipeline.stages:
+                stages[stage.name] = dict(stage.timing.stats(), optional=stage.optional, skipped=stage.skipped)
+            stats[name] = {'total': pipeline.timing.stats(), 'errors': pipeline.errors, 'stages': stages}
+        return stats
@@ -0,0 +1,406 @@
+'''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''
+@ Filename: program.py
+@ Version: V1.0
+@ Author: Afandi Azmi
+@ Description: Motion programs
+
+Compiles uploaded programs (Blockly or cmd:duration strings) to bytecode and runs it on a tick
+'''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''
+
+
+import time
+import itertools
+import threading
+from collections import deque
+from pipeline import LatencyStats
+
+
+# Opcodes. Every instruction is a tuple (op, a, b, c, step); step is the index of the
+# source statement it came from, for progress reports
+HALT, MOVE, STOP, WAIT, REPEAT, NEXT, JUMP_UNLESS, JUMP = range(8)
+OPCODE_NAMES = ('halt', 'move', 'stop', 'wait', 'repeat', 'next', 'jump_unless', 'jump')
+
+# MOVE a: direction, (vx, vy, omega) per unit of speed for MEEPOBOT.driveFor
+DIRECTIONS = (
+    ('forward', (1, 0, 0)),
+    ('backward', (-1, 0, 0)),
+    ('left', (0, 0, 1)),
+    ('right', (0, 0, -1)),
+    ('strafe_left', (0, 1, 0)),
+    ('strafe_right', (0, -1, 0)),
+)
+DIRECTION_INDEX = {name: index for index, (name, vector) in enumerate(DIRECTIONS)}
+
+# Sensor conditions: the obstacle is nearer than the distance, or the path is clear up to it
+CONDITIONS = ('near', 'clear')
+
+# The names /run_instructions has always accepted in cmd:duration strings
+LEGACY_COMMANDS = {
+    't_up': 'forward', 't_down': 'backward', 'turnLeft': 'left', 'turnRight': 'right',
+    'moveLeft': 'strafe_left', 'moveRight': 'strafe_right', 't_stop': 'stop', 'stop': 'stop',
+}
+
+DEFAULT_SPEED = 50
+MAX_INSTRUCTIONS = 1024
+MAX_DURATION = 60.0
+MAX_REPEAT = 1000
+MAX_DEPTH = 8
+
+
+class ProgramError(ValueError):
+    pass
+
+
+class Program:
+    "Compiled bytecode plus one entry per source statement (op, block id, text)"
+    def __init__(self, code, steps, counters, uses_sensor):
+        self.code = tuple(tuple(instruction) for instruction in code)
+        self.steps = steps
+        self.counters = counters
+        self.uses_sensor = uses_sensor
+
+    def listing(self):
+        return ['%3d  %-11s %s' % (pc, OPCODE_NAMES[op], ' '.join(str(arg) for arg in args[:3]))
+                for pc, (op, *args) in enumerate(self.code)]
+
+
+def parse_instructions(text):
+    """The cmd:duration[:speed] list /run_instructions has always taken, e.g. 't_up:2,turnLeft:1:80',
+    as statements for compile_program"""
+    statements = []
+    for n, item in enumerate(text.replace(';', ',').split(',')):
+        item = item.strip()
+        if not item:
+            continue
+        parts = item.split(':')
+        if len(parts) not in (2, 3) or parts[0] not in LEGACY_COMMANDS:
+            raise ProgramError('Instruction %d (%r) is not cmd:duration[:speed]' % (n + 1, item))
+        name = LEGACY_COMMANDS[parts[0]]
+        statement = {'op': 'stop'} if name == 'stop' else {'op': 'move', 'direction': name}
+        statement['duration'] = parts[1]
+        if len(parts) == 3:
+            statement['speed'] = parts[2]
+        statements.append(statement)
+    return statements
+
+
+def compile_program(source):
+    """Compiles a program to bytecode. source is a cmd:duration string or a list of statements:
+        {'op': 'move', 'direction': 'forward', 'speed': 50, 'duration': 2}
+        {'op': 'stop', 'duration': 1}
+        {'op': 'repeat', 'times': 3, 'body': [...]}
+        {'op': 'while', 'condition': 'clear', 'distance': 0.4, 'body': [...]}
+        {'op': 'if', 'condition': 'near', 'distance': 0.3, 'then': [...], 'else': [...]}
+        {'op': 'wait_until', 'condition': 'near', 'distance': 0.3, 'timeout': 10}
+    Any statement may carry a 'block' id, handed back in progress events. Raises ProgramError."""
+    if isinstance(source, str):
+        source = parse_instructions(source)
+    if not isinstance(source, list):
+        raise ProgramError('A program is a list of statements or a cmd:duration string')
+    compiler = _Compiler()
+    compiler.block(source, 0)
+    compiler.emit(HALT, 0, 0, 0, None)
+    if len(compiler.steps) == 0:
+        raise ProgramError('The program is empty')
+    return Program(compiler.code, compiler.steps, compiler.counters, compiler.uses_sensor)
+
+
+def _number(statement, key, low, high, default=None):
+    value = statement.get(key, default)
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        raise ProgramError('%s: %s must be a number' % (statement.get('op'), key))
+    if not low <= value <= high:
+        raise ProgramError('%s: %s must be between %g and %g' % (statement.get('op'), key, low, high))
+    return value
+
+
+class _Compiler:
+    def __init__(self):
+        self.code = []
+        self.steps = []
+        self.counters = 0
+        self.uses_sensor = False
+
+    def emit(self, op, a, b, c, step):
+        if len(self.code) >= MAX_INSTRUCTIONS:
+            raise ProgramError('The program is longer than %d instructions' % MAX_INSTRUCTIONS)
+        self.code.append([op, a, b, c, step])
+        return len(self.code) - 1
+
+    def condition(self, statement):
+        condition = statement.get('condition')
+        if condition not in CONDITIONS:
+            raise ProgramError('%s: condition must be one of %s' % (statement.get('op'), ', '.join(CONDITIONS)))
+        self.uses_sensor = True
+        return CONDITIONS.index(condition), _number(statement, 'distance', 0.02, 4.0)
+
+    def block(self, statements, depth):
+        if not isinstance(statements, list):
+            raise ProgramError('A block is a list of statements')
+        if depth > MAX_DEPTH:
+            raise ProgramError('Blocks are nested more than %d deep' % MAX_DEPTH)
+        for statement in statements:
+            self.statement(statement, depth)
+
+    def statement(self, statement, depth):
+        if not isinstance(statement, dict):
+            raise ProgramError('A statement is an object with an op')
+        op = statement.get('op')
+        step = len(self.steps)
+        self.steps.append({'op': op, 'block': statement.get('block')})
+        if op == 'move':
+            direction = statement.get('direction')
+            if direction not in DIRECTION_INDEX:
+                raise ProgramError('move: unknown direction %r' % direction)
+            speed = _number(statement, 'speed', 0, 100, DEFAULT_SPEED)
+            duration = _number(statement, 'duration', 0, MAX_DURATION)
+            self.emit(MOVE, DIRECTION_INDEX[direction], speed, duration, step)
+            self.steps[step]['text'] = '%s %g s at %g' % (direction, duration, speed)
+        elif op == 'stop':
+            duration = _number(statement, 'duration', 0, MAX_DURATION, 0)
+            self.emit(STOP, duration, 0, 0, step)
+            self.steps[step]['text'] = 'stop %g s' % duration
+        elif op == 'wait_until':
+            condition, distance = self.condition(statement)
+            timeout = _number(statement, 'timeout', 0, MAX_DURATION, MAX_DURATION)
+            self.emit(WAIT, condition, distance, timeout, step)
+            self.steps[step]['text'] = 'wait until %s %g m' % (CONDITIONS[condition], distance)
+        elif op == 'repeat':
+            times = int(_number(statement, 'times', 0, MAX_REPEAT))
+            self.steps[step]['text'] = 'repeat %d' % times
+            if times == 0:
+                return
+            # One counter per nesting level; inner loops reuse the slots of finished ones
+            counter = depth
+            self.counters = max(self.counters, depth + 1)
+            self.emit(REPEAT, counter, times, 0, step)
+            top = len(self.code)
+            self.block(statement.get('body', []), depth + 1)
+            self.emit(NEXT, counter, top, 0, step)
+        elif op == 'while':
+            condition, distance = self.condition(statement)
+            self.steps[step]['text'] = 'while %s %g m' % (CONDITIONS[condition], distance)
+            top = self.emit(JUMP_UNLESS, condition, distance, None, step)
+            self.block(statement.get('body', []), depth + 1)
+            self.emit(JUMP, top, 0, 0, step)
+            self.code[top][3] = len(self.code)
+        elif op == 'if':
+            condition, distance = self.condition(statement)
+            self.steps[step]['text'] = 'if %s %g m' % (CONDITIONS[condition], distance)
+            test = self.emit(JUMP_UNLESS, condition, distance, None, step)
+            self.block(statement.get('then', []), depth + 1)
+            if statement.get('else'):
+                skip = self.emit(JUMP, None, 0, 0, step)
+                self.code[test][3] = len(self.code)
+                self.block(statement['else'], depth + 1)
+                self.code[skip][1] = len(self.code)
+            else:
+                self.code[test][3] = len(self.code)
+        else:
+            raise ProgramError('Unknown statement %r' % op)
+
+
+class MotionVM:
+    """Runs one compiled program at a time without blocking anyone: tick() executes
+    instructions until one has to wait (a timed move or stop, a sensor wait) or `budget`
+    instructions have run, then returns how long until it needs to run again. A thread of
+    its own calls it on time; sensor conditions are polled `rate` times a second.
+
+    Moves go out as MEEPOBOT.driveFor with a deadline a little past their own, so the next
+    instruction replaces them without a stop in between, and the motion scheduler stops
+    the wheels by itself if this thread ever stalls. cancel() stops the robot at once,
+    whatever instruction is running.
+
+    Progress goes out as events (see events()): 'begin' when a statement starts, 'end'
+    with its planned and measured duration, then 'done', 'cancelled' or 'error'."""
+    def __init__(self, robot, distance=None, rate=50, budget=64, on_finish=None, histogram=None):
+        self.robot = robot
+        self.distance = distance
+        self.period = 1.0 / rate
+        self.budget = budget
+        self.on_finish = on_finish
+        self.histogram = histogram
+        self.cond = threading.Condition()
+        self.event_cond = threading.Condition()
+        self.events_log = deque(maxlen=256)
+        self.event_seq = 0
+        self.runs = itertools.count(1)
+        self.run = 0
+        self.program = None
+        self.status = 'idle'
+        self.pc = 0
+        self.counters = []
+        self.deadline = None
+        self.current = None     # (pc, started, planned) of the timed instruction running
+        self.started = 0.0
+        self.executed = 0
+        self.yields = 0
+        self.lateness = LatencyStats()
+        self.tick_time = LatencyStats()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def start(self, program):
+        "Runs program from the top, replacing any program still running; returns its run id"
+        if program.uses_sensor and self.distance is None:
+            raise ProgramError('The program reads the distance sensor, which is not available')
+        self.cancel('replaced')
+        with self.cond:
+            self.run = next(self.runs)
+            self.program = program
+            self.pc = 0
+            self.counters = [0] * program.counters
+            self.deadline = None
+            self.current = None
+            self.started = time.monotonic()
+            self.status = 'running'
+            self._event('start', steps=len(program.steps), instructions=len(program.code))
+            self.cond.notify_all()
+            return self.run
+
+    def cancel(self, reason='cancelled'):
+        "Stops the running program and the robot; False if nothing was running"
+        with self.cond:
+            if self.status != 'running':
+                return False
+            self.robot.t_stop(0)
+            self._finish(reason)
+            self.cond.notify_all()
+        return True
+
+    def running(self):
+        return self.status == 'running'
+
+    def tick(self, now=None):
+        "Runs the program as far as it can go now; returns seconds until the next tick, None when idle"
+        start = time.perf_counter_ns()
+        with self.cond:
+            if self.status != 'running':
+                return None
+            now = time.monotonic() if now is None else now
+            try:
+                delay = self._step(now)
+            except Exception as e:
+                print(f"Motion program error: {e}")
+                self.robot.t_stop(0)
+                self._finish('error', message=str(e))
+                delay = None
+        self.tick_time.add(time.perf_counter_ns() - start)
+        return delay
+
+    def _step(self, now):
+        code = self.program.code
+        if self.deadline is not None:
+            if now < self.deadline:
+                return self.deadline - now
+            self._end(now)
+        for _ in range(self.budget):
+            op, a, b, c, step = code[self.pc]
+            self.executed += 1
+            if op == MOVE:
+                vx, vy, omega = DIRECTIONS[a][1]
+                self.robot.driveFor(vx * b, vy * b, omega * b, c + 2 * self.period)
+                return self._begin(now, c)
+            elif op == STOP:
+                self.robot.t_stop(0)
+                return self._begin(now, a)
+            elif op == WAIT:
+                if self.current is None:
+                    self._begin(now, None)
+                    self.deadline = None
+                if self._test(a, b) or now - self.current[1] >= c:
+                    self._end(now)
+                    continue
+                return self.period
+            elif op == REPEAT:
+                self.counters[a] = b
+                self.pc += 1
+            elif op == NEXT:
+                self.counters[a] -= 1
+                self.pc = b if self.counters[a] > 0 else self.pc + 1
+            elif op == JUMP_UNLESS:
+                self.pc = self.pc + 1 if self._test(a, b) else c
+            elif op == JUMP:
+                self.pc = a
+            elif op == HALT:
+                self.robot.t_stop(0)
+                self._finish('done')
+                return None
+        # Out of budget (e.g. a loop that never waits): let the other threads run first
+        self.yields += 1
+        return self.period
+
+    def _test(self, condition, distance):
+        reading = self.distance()
+        return reading < distance if condition == 0 else reading >= distance
+
+    def _begin(self, now, planned):
+        step = self.program.code[self.pc][4]
+        self.current = (self.pc, now, planned)
+        self.deadline = now + planned if planned is not None else None
+        info = self.program.steps[step]
+        self._event('begin', step=step, block=info['block'], text=info.get('text'))
+        return planned
+
+    def _end(self, now):
+        pc, started, planned = self.current
+        step = self.program.code[pc][4]
+        late = now - self.deadline if self.deadline is not None else 0.0
+        if self.deadline is not None:
+            self.lateness.add(int(late * 1e9))
+            if self.histogram:
+                self.histogram.observe(late)
+        self._event('end', step=step, block=self.program.steps[step]['block'], planned_s=planned,
+                    actual_s=round(now - started, 4), late_ms=round(1000 * late, 2))
+        self.current = None
+        self.deadline = None
+        self.pc += 1
+
+    def _finish(self, status, **fields):
+        # Caller holds the lock
+        self.status = status
+        self.deadline = None
+        self.current = None
+        self._event(status, elapsed_s=round(time.monotonic() - self.started, 3), **fields)
+        if self.on_finish:
+            self.on_finish(status)
+
+    def _event(self, kind, **fields):
+        with self.event_cond:
+            self.event_seq += 1
+            fields.update(seq=self.event_seq, run=self.run, type=kind, t=round(time.monotonic() - self.started, 4))
+            self.events_log.append(fields)
+            self.event_cond.notify_all()
+
+    def events(self, after=0, timeout=None):
+        "Events with seq above after, waiting up to timeout for the first one"
+        with self.event_cond:
+            self.event_cond.wait_for(lambda: self.event_seq > after, timeout)
+            return [event for event in self.events_log if event['seq'] > after]
+
+    def _run(self):
+        while True:
+            delay = self.tick()
+            with self.cond:
+                if self.status != 'running':
+                    self.cond.wait()
+                elif delay:
+                    self.cond.wait(delay)
+
+    def stats(self):
+        step = None
+        if self.status == 'running' and self.program:
+            step = self.program.code[self.pc][4]
+        return {
+            'status': self.status,
+            'run': self.run,
+            'step': step,
+            'steps': len(self.program.steps) if self.program else 0,
+            'instructions': len(self.program.code) if self.program else 0,
+            'executed': self.executed,
+            'yields': self.yields,
+            'lateness': self.lateness.stats(),
+            'tick': self.tick_time.stats(),
+        }
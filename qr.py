@@ -0,0 +1,194 @@
+'''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''
+@ Filename: qr.py
+@ Version: V1.0
+@ Author: Afandi Azmi
+@ Description: QR code reader
+
+Decodes QR codes off the camera loop, only where and when the picture changed
+'''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''
+
+
+import time
+import atexit
+import threading
+import cv2
+import numpy as np
+from pipeline import LatencyStats
+from buffers import BufferPool
+try:
+    from pyzbar import pyzbar
+except ImportError:
+    # Without pyzbar, OpenCV's QR detector is used (slower)
+    pyzbar = None
+
+
+class QRReader:
+    """Reads QR codes from grayscale frames, doing as little decoding as it can:
+    - Frames that barely changed since the last decoded one (mean absolute difference of a
+      small thumbnail under change_threshold grey levels) are skipped; the last result stands.
+    - Once a code is found, the next decode only looks at its box grown by margin on every
+      side. The whole frame is only scanned when the code is not there any more.
+    - threaded=True decodes on the reader's own thread: update() copies the frame and
+      returns the newest result at once, and frames arriving while a decode runs replace
+      each other. threaded=False decodes inside update() (replay, tests).
+    - reset() may come from another thread: a decode that started before it is thrown away
+      instead of bringing the old code back.
+
+    A result is (payload, (x, y, w, h)), or None when no code is in view."""
+    def __init__(self, threaded=False, change_threshold=2.0, margin=0.5, thumb_size=(40, 30), histogram=None):
+        self.change_threshold = change_threshold
+        self.margin = margin
+        self.thumb_size = thumb_size
+        self.histogram = histogram
+        self.detector = None if pyzbar else cv2.QRCodeDetector()
+        self.buffers = BufferPool()
+        self.reference = None    # thumbnail of the last frame sent for decoding
+        self.roi = None          # (x0, y0, x1, y1) to try first
+        self.result = None
+        self.result_seq = 0
+        self.frames = 0
+        self.skipped = 0
+        self.attempts = 0
+        self.hits = 0
+        self.roi_attempts = 0
+        self.roi_hits = 0
+        self.full_scans = 0
+        self.decode_latency = LatencyStats()
+        # Guards the result, ROI and reference; generation counts resets
+        self.cond = threading.Condition()
+        self.generation = 0
+        self.discarded = 0
+        self.threaded = threaded
+        if threaded:
+            self.pending = None
+            self.pending_seq = 0
+            self.fresh = False
+            self.closed = False
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+            # Lets a decode in progress finish: OpenCV aborts the process if it is torn down mid-call
+            atexit.register(self.close)
+
+    def reset(self):
+        "Forgets the last code, its region and the reference frame, and any frame not decoded yet"
+        with self.cond:
+            self.generation += 1
+            self.reference = None
+            self.roi = None
+            self.result = None
+            if self.threaded:
+                self.fresh = False
+
+    def update(self, gray, seq=0, thumb=None):
+        """Hands in the newest frame; returns the newest result. thumb is the frame already
+        downscaled to thumb_size (INTER_AREA), if the caller has it"""
+        self.frames += 1
+        if thumb is None:
+            thumb = cv2.resize(gray, self.thumb_size, dst=self.buffers.get('thumb', self.thumb_size[::-1]),
+                               interpolation=cv2.INTER_AREA)
+        with self.cond:
+            if self.reference is not None and cv2.norm(thumb, self.reference, cv2.NORM_L1) < \
+                    self.change_threshold * thumb.size:
+                self.skipped += 1
+                return self.result
+            self.reference = self.buffers.get('reference', thumb.shape)
+            np.copyto(self.reference, thumb)
+            if self.threaded:
+                # Two frame buffers: the one being filled here and the one being decoded
+                if self.pending is None or self.pending.shape != gray.shape:
+                    self.pending = np.empty_like(gray)
+                np.copyto(self.pending, gray)
+                self.pending_seq = seq
+                self.fresh = True
+                self.cond.notify()
+                return self.result
+            generation = self.generation
+        self._decode(gray, seq, generation)
+        return self.result
+
+    def _run(self):
+        frame = None
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: self.fresh or self.closed)
+                if self.closed:
+                    return
+                frame, self.pending = self.pending, frame
+                seq = self.pending_seq
+                generation = self.generation
+                self.fresh = False
+            try:
+                self._decode(frame, seq, generation)
+            except Exception as e:
+                print(f"QR reader error: {e}")
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+        self.thread.join(timeout=1.0)
+
+    def _symbols(self, gray):
+        if pyzbar is not None:
+            # QR only: zbar does not look for the 1D barcode types at all
+            return [(s.data.decode('utf-8', 'replace'), tuple(s.rect))
+                    for s in pyzbar.decode(gray, symbols=[pyzbar.ZBarSymbol.QRCODE])]
+        payload, points, _ = self.detector.detectAndDecode(gray)
+        if not payload or points is None:
+            return []
+        x, y, w, h = cv2.boundingRect(points.astype(np.float32))
+        return [(payload, (x, y, w, h))]
+
+    def _decode(self, gray, seq, generation):
+        start = time.perf_counter_ns()
+        found = None
+        roi = self.roi
+        if roi is not None:
+            x0, y0, x1, y1 = roi
+            self.roi_attempts += 1
+            symbols = self._symbols(gray[y0:y1, x0:x1])
+            if symbols:
+                self.roi_hits += 1
+                payload, (x, y, w, h) = symbols[0]
+                found = (payload, (x0 + x, y0 + y, w, h))
+        if found is None:
+            self.full_scans += 1
+            symbols = self._symbols(gray)
+            if symbols:
+                found = symbols[0]
+        elapsed = time.perf_counter_ns() - start
+        self.attempts += 1
+        self.decode_latency.add(elapsed)
+        if self.histogram:
+            self.histogram.observe(elapsed / 1e9)
+        if found is None:
+            roi = None
+        else:
+            self.hits += 1
+            x, y, w, h = found[1]
+            grow_w, grow_h = int(w * self.margin), int(h * self.margin)
+            rows, cols = gray.shape[:2]
+            roi = (max(x - grow_w, 0), max(y - grow_h, 0), min(x + w + grow_w, cols), min(y + h + grow_h, rows))
+        with self.cond:
+            if generation != self.generation:
+                # Reset while decoding: the frame is from before it
+                self.discarded += 1
+                return
+            self.roi = roi
+            self.result = found
+            self.result_seq = seq
+
+    def stats(self):
+        return {
+            'decoder': 'pyzbar' if pyzbar else 'opencv',
+            'frames': self.frames,
+            'skipped': self.skipped,
+            'attempts': self.attempts,
+            'hits': self.hits,
+            'hit_rate': round(self.hits / self.attempts, 3) if self.attempts else 0.0,
+            'roi_attempts': self.roi_attempts,
+            'roi_hit_rate': round(self.roi_hits / self.roi_attempts, 3) if self.roi_attempts else 0.0,
+            'full_scans': self.full_scans,
+            'discarded': self.discarded,
+            'decode': self.decode_latency.stats(),
+        }
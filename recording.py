@@ -0,0 +1,170 @@
+'''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''
+@ Filename: recording.py
+@ Version: V1.0
+@ Author: Afandi Azmi
+@ Description: Session recording
+
+Append-only recordings of vision frames, settings, decisions and motor commands
+'''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''
+
+
+import os
+import json
+import mmap
+import time
+import struct
+import threading
+import numpy as np
+
+
+MAGIC = b'MEEPREC1'
+# Every record: 4-byte tag, payload length, timestamp (ns, monotonic)
+RECORD = struct.Struct('<4sIq')
+# Frame payload header: capture sequence number, width, height, sensor timestamp (ns); raw YUV420 follows
+FRAME = struct.Struct('<IHHq')
+
+TAG_FRAME = b'FRAM'
+TAG_STATE = b'STAT'
+TAG_DECISION = b'DECI'
+TAG_COMMAND = b'CMD '
+
+
+class SessionRecorder:
+    """Appends a session to a file: every lores frame as raw YUV420 (so replay can map it
+    without decoding), the settings in force whenever they change, the decision taken
+    on each frame and the motor commands issued. Records are only ever appended, so a
+    recording cut short by a crash is still readable up to its last complete record."""
+    def __init__(self, path, every=1):
+        self.path = path
+        self.every = max(int(every), 1)
+        new = not os.path.exists(path) or os.path.getsize(path) == 0
+        self.file = open(path, 'ab')
+        if new:
+            self.file.write(MAGIC)
+        self.lock = threading.Lock()
+        self.state = None
+        self.seen = 0
+        self.frames = 0
+        self.bytes = 0
+        self.started = time.monotonic()
+
+    def _write(self, tag, payload):
+        header = RECORD.pack(tag, len(payload), time.monotonic_ns())
+        with self.lock:
+            if self.file is None:
+                return
+            self.file.write(header)
+            self.file.write(payload)
+            self.bytes += len(header) + len(payload)
+
+    def _json(self, tag, value):
+        self._write(tag, json.dumps(value, separators=(',', ':')).encode())
+
+    def frame(self, seq, timestamp, yuv, size, state):
+        "Records one lores frame; returns False when it was skipped by `every`"
+        self.seen += 1
+        if (self.seen - 1) % self.every:
+            return False
+        if state != self.state:
+            self.state = dict(state)
+            self._json(TAG_STATE, self.state)
+        w, h = size
+        self._write(TAG_FRAME, FRAME.pack(seq, w, h, timestamp) + yuv[:h * 3 // 2, :w].tobytes())
+        self.frames += 1
+        return True
+
+    def decision(self, seq, mode, error, forward=None):
+        self._json(TAG_DECISION, {'seq': seq, 'mode': mode, 'error': error, 'forward': forward})
+
+    def command(self, name, args):
+        "Hook for MEEPOBOT.command_log"
+        self._json(TAG_COMMAND, {'name': name, 'args': list(args)})
+
+    def stats(self):
+        return {
+            'path': self.path,
+            'frames': self.frames,
+            'bytes': self.bytes,
+            'seconds': round(time.monotonic() - self.started, 1),
+        }
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+class RecordedFrame:
+    "A frame from a recording; yuv is a read-only view straight into the mapped file"
+    def __init__(self, seq, timestamp, sensor_timestamp, size, yuv, state, decision):
+        self.seq = seq
+        self.timestamp = timestamp
+        self.sensor_timestamp = sensor_timestamp
+        self.size = size
+        self.yuv = yuv
+        self.state = state
+        self.decision = decision
+
+
+class SessionReader:
+    """Memory-maps a recording and indexes it in one pass over the record headers. Frames
+    are numpy views into the mapping, so replaying never copies or decodes pixel data."""
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map[:len(MAGIC)] != MAGIC:
+            raise ValueError("%s is not a MEEPOBOT recording" % path)
+        self.frames = []       # (pixel offset, timestamp, sensor timestamp, seq, size, state)
+        self.decisions = {}    # frame index -> decision taken on that frame
+        self.commands = []     # (timestamp, name, args)
+        self._index()
+
+    def _index(self):
+        state = {}
+        offset = len(MAGIC)
+        end = len(self.map)
+        while offset + RECORD.size <= end:
+            tag, length, timestamp = RECORD.unpack_from(self.map, offset)
+            start = offset + RECORD.size
+            if start + length > end:
+                # Truncated last record (recording interrupted)
+                break
+            if tag == TAG_FRAME:
+                seq, w, h, sensor_timestamp = FRAME.unpack_from(self.map, start)
+                self.frames.append((start + FRAME.size, timestamp, sensor_timestamp, seq, (w, h), state))
+            elif tag == TAG_STATE:
+                state = json.loads(self.map[start:start + length])
+            elif tag == TAG_DECISION:
+                decision = json.loads(self.map[start:start + length])
+                # Sequence numbers restart with the app, so match against the latest frame only
+                if self.frames and self.frames[-1][3] == decision['seq']:
+                    self.decisions[len(self.frames) - 1] = decision
+            elif tag == TAG_COMMAND:
+                command = json.loads(self.map[start:start + length])
+                self.commands.append((timestamp, command['name'], command['args']))
+            offset = start + length
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __iter__(self):
+        for index, (offset, timestamp, sensor_timestamp, seq, (w, h), state) in enumerate(self.frames):
+            yuv = np.frombuffer(self.map, np.uint8, h * 3 // 2 * w, offset).reshape(h * 3 // 2, w)
+            yield RecordedFrame(seq, timestamp, sensor_timestamp, (w, h), yuv, state, self.decisions.get(index))
+
+    def duration(self):
+        if len(self.frames) < 2:
+            return 0.0
+        return (self.frames[-1][1] - self.frames[0][1]) / 1e9
+
+    def close(self):
+        # Frames still referenced keep the mapping alive; let them go first
+        self.map.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,273 @@
+'''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''
+@ Filename: replay.py
+@ Version: V1.0
+@ Author: Afandi Azmi
+@ Description: Replay benchmark
+
+Runs recorded sessions through the FACE_TRACK and LINE_FOLLOW stages without the robot
+'''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''
+
+
+import os
+import json
+import time
+import argparse
+import tracemalloc
+import cv2
+import numpy as np
+from pipeline import PipelineRunner, FrameContext
+from buffers import FrameImages
+from vision import FaceTracker, LINE_COLORS, get_color_lut
+from modes import FaceTrackMode, LineFollowMode, PanTiltTrackMode
+from recording import SessionRecorder, SessionReader
+from workers import VisionPool
+from metrics import Registry, GCWatch, GC_BUCKETS
+
+
+VISION_MODES = ('FACE_TRACK', 'FACE_PAN_TILT', 'LINE_FOLLOW')
+
+
+CASCADE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'image', 'haarcascade_frontalface_default.xml')
+
+
+def replay(reader, mode=None, detector=None, color=None, repeat=1, cascade=CASCADE, memory=False):
+    """Feeds every recorded frame through its mode's stages (overlay and encoding off).
+    mode/detector/color override what was recorded. Returns one result per frame replayed:
+    {'index', 'seq', 'mode', 'error', 'forward', 'latency_ns'} from the last repeat, plus the runner.
+    With memory, each result also gets 'alloc_bytes': the peak Python/NumPy memory the frame
+    allocated on top of what was live before it (tracemalloc; slows the replay down)."""
+    runner = PipelineRunner()
+    tracker = FaceTracker(cv2.CascadeClassifier(cascade), detect_every=10)
+    face_mode = FaceTrackMode(tracker)
+    line_mode = LineFollowMode(get_color_lut(LINE_COLORS['black']))
+    runner.register('FACE_TRACK', face_mode.stages())
+    runner.register('FACE_PAN_TILT', PanTiltTrackMode(tracker).stages())
+    runner.register('LINE_FOLLOW', line_mode.stages())
+
+    images = FrameImages()
+    results = []
+    for _ in range(repeat):
+        tracker.reset()
+        results = []
+        for index, frame in enumerate(reader):
+            state = frame.state
+            frame_mode = mode or state.get('mode')
+            if frame_mode not in VISION_MODES:
+                continue
+            if frame_mode == 'LINE_FOLLOW':
+                ranges = LINE_COLORS[color] if color else state.get('ranges', LINE_COLORS['black'])
+                line_mode.lut = get_color_lut(ranges)
+                line_mode.detector = detector or state.get('detector', 'contour')
+            ctx = FrameContext(frame_mode, lores=frame.yuv, size=frame.size, images=images)
+            if memory:
+                tracemalloc.start()
+                tracemalloc.reset_peak()
+                live = tracemalloc.get_traced_memory()[0]
+            start = time.perf_counter_ns()
+            runner.run(ctx)
+            latency = time.perf_counter_ns() - start
+            if memory:
+                alloc = tracemalloc.get_traced_memory()[1] - live
+            results.append({
+                'index': index,
+                'seq': frame.seq,
+                'mode': frame_mode,
+                'error': getattr(ctx, 'error', None),
+                'forward': getattr(ctx, 'forward', None),
+                'latency_ns': latency,
+            })
+            if memory:
+                results[-1]['alloc_bytes'] = alloc
+            del ctx, frame
+    if memory:
+        tracemalloc.stop()
+    return results, runner
+
+
+def replay_workers(reader, workers, mode=None, detector=None, color=None, cascade=CASCADE):
+    """replay() with the compute stages in a VisionPool of worker processes. Frames are
+    queued as fast as the shared ring takes them and every result is kept (not just the
+    newest). Returns the results in frame order, the pool's stats and the wall time."""
+    w = max(size[0] for _, _, _, _, size, _ in reader.frames)
+    h = max(size[1] for _, _, _, _, size, _ in reader.frames)
+    pool = VisionPool(workers, (w, h), cascade=cascade)
+    # Steering runs here on each result, as in the app (without a controller)
+    steer = {'FACE_TRACK': FaceTrackMode(None).steer, 'FACE_PAN_TILT': PanTiltTrackMode(None).steer,
+             'LINE_FOLLOW': LineFollowMode(None).steer}
+    pending = {}
+    results = []
+
+    def collect(timeout):
+        if not pool.alive:
+            raise RuntimeError("vision worker exited")
+        for seq, frame_mode, result in pool.poll(timeout):
+            index, frame_seq, size, start = pending.pop(seq)
+            ctx = FrameContext(frame_mode, size=size)
+            ctx.__dict__.update(result)
+            steer[frame_mode](ctx)
+            results.append({
+                'index': index,
+                'seq': frame_seq,
+                'mode': frame_mode,
+                'error': getattr(ctx, 'error', None),
+                'forward': getattr(ctx, 'forward', None),
+                'latency_ns': time.perf_counter_ns() - start,
+            })
+
+    start = time.perf_counter()
+    try:
+        for index, frame in enumerate(reader):
+            state = frame.state
+            frame_mode = mode or state.get('mode')
+            if frame_mode not in VISION_MODES:
+                continue
+            if frame_mode == 'LINE_FOLLOW':
+                ranges = LINE_COLORS[color] if color else state.get('ranges', LINE_COLORS['black'])
+                pool.configure({'ranges': ranges, 'detector': detector or state.get('detector', 'contour')})
+            while pool.busy() >= pool.ring.slots:
+                collect(1.0)
+            # Frame indexes as sequence numbers: recorded seqs restart with the app
+            pending[index + 1] = (index, frame.seq, frame.size, time.perf_counter_ns())
+            pool.submit(frame_mode, index + 1, frame.yuv, frame.size)
+            del frame
+            collect(0)
+        while pool.busy():
+            collect(1.0)
+        seconds = time.perf_counter() - start
+        stats = pool.stats()
+    finally:
+        pool.close()
+    results.sort(key=lambda r: r['index'])
+    return results, stats, seconds
+
+
+def agreement(results, reference, tolerance=0.05):
+    """How often two runs took the same decision on the same frames: both lost the target,
+    or both saw it with steering errors within tolerance (errors are normalised to -1..1)"""
+    ref = {r['index']: r for r in reference if r.get('mode') in VISION_MODES}
+    pairs = [(r, ref[r['index']]) for r in results if r['index'] in ref and ref[r['index']]['mode'] == r['mode']]
+    if not pairs:
+        return None
+    same_found = [(a['error'] is None) == (b['error'] is None) for a, b in pairs]
+    diffs = [abs(a['error'] - b['error']) for a, b in pairs if a['error'] is not None and b['error'] is not None]
+    agree = sum(1 for (a, b), found in zip(pairs, same_found)
+                if found and (a['error'] is None or abs(a['error'] - b['error']) <= tolerance))
+    return {
+        'frames': len(pairs),
+        'agreement': round(agree / len(pairs), 4),
+        'found_agreement': round(sum(same_found) / len(pairs), 4),
+        'mean_error_diff': round(float(np.mean(diffs)), 4) if diffs else 0.0,
+        'max_error_diff': round(float(np.max(diffs)), 4) if diffs else 0.0,
+    }
+
+
+def summarize(results, runner):
+    summary = {}
+    for name in VISION_MODES:
+        latencies = np.array([r['latency_ns'] for r in results if r['mode'] == name], np.float64) / 1e6
+        if not len(latencies):
+            continue
+        stages = runner.stats()[name]['stages']
+        summary[name] = {
+            'frames': len(latencies),
+            'fps': round(1000 * len(latencies) / latencies.sum(), 1),
+            'p50_ms': round(float(np.percentile(latencies, 50)), 3),
+            'p95_ms': round(float(np.percentile(latencies, 95)), 3),
+            'p99_ms': round(float(np.percentile(latencies, 99)), 3),
+            'stages_p50_ms': {stage: s['p50_ms'] for stage, s in stages.items() if s['count']},
+            'found': round(sum(r['error'] is not None for r in results if r['mode'] == name) / len(latencies), 4),
+        }
+        alloc = [r['alloc_bytes'] for r in results if r['mode'] == name and 'alloc_bytes' in r]
+        if alloc:
+            summary[name]['alloc_kb_per_frame'] = round(float(np.mean(alloc)) / 1024, 1)
+    return summary
+
+
+def synthesize(path, scene, frames, size=(320, 240)):
+    "Writes a recording of a simulated scene ('line' or 'face'), for benchmarks without a robot"
+    from sim import make_scene
+    source = make_scene(scene)
+    mode = 'FACE_TRACK' if scene == 'face' else 'LINE_FOLLOW'
+    state = {'mode': mode, 'color': 'black', 'ranges': LINE_COLORS['black'], 'detector': 'contour',
+             'size': list(size)}
+    recorder = SessionRecorder(path)
+    for n in range(frames):
+        yuv = cv2.cvtColor(source.render(n, size), cv2.COLOR_BGR2YUV_I420)
+        recorder.frame(n + 1, time.monotonic_ns(), yuv, size, state)
+    recorder.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Replay a recorded session through the vision modes")
+    parser.add_argument('session', help="recording made with POST /recording")
+    parser.add_argument('--mode', choices=VISION_MODES, help="replay every frame in this mode")
+    parser.add_argument('--detector', choices=('contour', 'scanline'), help="override the line detector")
+    parser.add_argument('--color', choices=sorted(LINE_COLORS), help="override the line colour")
+    parser.add_argument('--repeat', type=int, default=1, help="replay this many times, time the last")
+    parser.add_argument('--save', help="write per-frame decisions and the summary to this JSON file")
+    parser.add_argument('--compare', help="JSON from an earlier --save to check decision agreement against")
+    parser.add_argument('--synthesize', choices=('line', 'face'),
+                        help="first write the session file from a simulated scene")
+    parser.add_argument('--frames', type=int, default=300, help="frames to synthesize")
+    parser.add_argument('--memory', action='store_true',
+                        help="report memory allocated per frame and garbage collector pauses")
+    parser.add_argument('--workers', type=int, default=0,
+                        help="also replay through this many vision worker processes and report the speedup")
+    args = parser.parse_args()
+
+    if args.synthesize:
+        synthesize(args.session, args.synthesize, args.frames)
+
+    reader = SessionReader(args.session)
+    print("%s: %d frames, %.1f s recorded, %d commands" % (
+        args.session, len(reader), reader.duration(), len(reader.commands)))
+    gc_pauses = Registry().histogram('gc_pause_seconds', 'GC pauses', ['generation'], GC_BUCKETS)
+    watch = GCWatch(gc_pauses).start()
+    start = time.perf_counter()
+    results, runner = replay(reader, args.mode, args.detector, args.color, args.repeat, memory=args.memory)
+    single_seconds = (time.perf_counter() - start) / args.repeat
+    watch.stop()
+    summary = summarize(results, runner)
+    for name, s in summary.items():
+        print("%-12s %5d frames  %8.1f fps  p50 %.3f  p95 %.3f  p99 %.3f ms  target found %.1f%%" % (
+            name, s['frames'], s['fps'], s['p50_ms'], s['p95_ms'], s['p99_ms'], 100 * s['found']))
+        print("             stages p50: " + ", ".join("%s %.3f ms" % item for item in s['stages_p50_ms'].items()))
+        if 'alloc_kb_per_frame' in s:
+            print("             allocated per frame: %.1f KB" % s['alloc_kb_per_frame'])
+    if args.memory:
+        for (generation,), h in sorted(gc_pauses.children.items()):
+            print("GC generation %s: %d passes, mean %.3f ms, p99 %.3f ms, total %.1f ms" % (
+                generation, h.count, 1000 * h.sum / h.count, 1000 * h.quantile(0.99), 1000 * h.sum))
+
+    # Decisions taken live (if the recording has them) and by an earlier run
+    recorded = [dict(d, index=i) for i, d in reader.decisions.items()]
+    live = agreement(results, recorded)
+    if live:
+        print("agreement with recorded decisions: %s" % live)
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+        other = agreement(results, previous['frames'])
+        print("agreement with %s: %s" % (args.compare, other))
+        for name, s in summary.items():
+            before = previous['summary'].get(name)
+            if before:
+                print("%-12s p50 %.3f -> %.3f ms (%+.1f%%)" % (
+                    name, before['p50_ms'], s['p50_ms'], 100 * (s['p50_ms'] / before['p50_ms'] - 1)))
+    if args.workers and results:
+        # Same frames through the worker processes: throughput against the single thread above
+        offloaded, stats, seconds = replay_workers(reader, args.workers, args.mode, args.detector, args.color)
+        single_fps = len(results) / single_seconds
+        workers_fps = len(offloaded) / seconds
+        print("%d vision workers (%d CPUs): %.1f fps vs %.1f fps single-thread, speedup %.2fx" % (
+            args.workers, os.cpu_count(), workers_fps, single_fps, workers_fps / single_fps))
+        print("             worker compute p50 %.3f ms, round trip p50 %.3f p99 %.3f ms" % (
+            stats['compute']['p50_ms'], stats['round_trip']['p50_ms'], stats['round_trip']['p99_ms']))
+        print("agreement with single-thread decisions: %s" % agreement(offloaded, results))
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'session': args.session, 'summary': summary,
+                       'frames': [{k: r[k] for k in ('index', 'seq', 'mode', 'error', 'forward')} for r in results]},
+                      f, indent=1)
+    del results
+    reader.close()
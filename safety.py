@@ -0,0 +1,115 @@
+'''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''
+@ Filename: safety.py
+@ Version: V1.0
+@ Author: Afandi Azmi
+@ Description: Obstacle safety interlock
+
+Stops and slows the robot from the ultrasonic sensor, whatever mode is running
+'''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''
+
+
+import time
+import threading
+from pipeline import LatencyStats
+from vision import RateCounter
+
+
+class SafetyInterlock:
+    """Obstacle interlock on the ultrasonic DistanceSensor, below every mode.
+
+    - Stop: the sensor's when_in_range event (distance under its threshold_distance) cuts
+      all wheel duty at once with a single ALL_LED write, queued ahead of everything else
+      for the bus thread (a pending wheel update is dropped), if the robot is moving
+      forward. The camera servos get their pulse back straight after.
+    - Speed limit: every wheel update passes through limit(). Between slow_distance and the
+      stop distance, the forward part of the motion is scaled down in proportion to the
+      distance, down to zero. Turning, strafing and reversing are left alone, so the
+      robot can still get away from the obstacle.
+    - A monitor thread reads the distance every period. It counts new readings to give
+      the sensor's real sample rate, and it re-applies a tighter limit to a command that
+      is still running (e.g. a held forward button) as the obstacle gets closer.
+
+    Trigger-to-stop latency runs from the in-range event to the end of the I2C write."""
+    def __init__(self, robot, sensor, slow_distance=0.6, period=0.02, keep=(9, 10), histogram=None):
+        self.robot = robot
+        self.sensor = sensor
+        self.stop_distance = sensor.threshold_distance
+        self.slow_distance = slow_distance
+        self.period = period
+        self.keep = keep
+        self.histogram = histogram
+        self.enabled = True
+        self.distance = float(sensor.distance)
+        self.scale = self._scale(self.distance)
+        # Scale the last wheel update was limited with
+        self.applied_scale = 1.0
+        self.requested = [0, 0, 0, 0]
+        self.stops = 0
+        self.limited = 0
+        self.stop_latency = LatencyStats()
+        self.samples = RateCounter(window=5.0)
+        robot.wheel_limiter = self.limit
+        sensor.when_in_range = self._on_in_range
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _scale(self, distance):
+        if distance <= self.stop_distance:
+            return 0.0
+        if distance >= self.slow_distance:
+            return 1.0
+        return (distance - self.stop_distance) / (self.slow_distance - self.stop_distance)
+
+    def limit(self, duties):
+        "Wheel limiter hook: removes the part of the forward speed the distance does not allow"
+        self.requested = list(duties)
+        self.applied_scale = self.scale
+        forward = sum(duties) / 4
+        if not self.enabled or forward <= 0 or self.scale >= 1.0:
+            return duties
+        self.limited += 1
+        cut = forward * (1.0 - self.scale)
+        return [duty - cut for duty in duties]
+
+    def _on_in_range(self):
+        start = time.perf_counter_ns()
+        self.scale = 0.0
+        if not self.enabled or sum(self.requested) <= 0:
+            return
+        elapsed = self.robot.emergencyStop(self.keep) - start
+        self.stop_latency.add(elapsed)
+        if self.histogram:
+            self.histogram.observe(elapsed / 1e9)
+        self.stops += 1
+        # Queued behind anything already in flight, so the wheels end up with only the allowed motion
+        self.robot.setWheels(self.requested)
+
+    def _run(self):
+        while True:
+            try:
+                distance = self.sensor.distance
+                if distance != self.distance:
+                    self.samples.add(0)
+                self.distance = distance
+                scale = self._scale(distance)
+                # Limits tighten at once on a running command; they only loosen for the next one
+                tighter = scale < self.applied_scale - 0.05 or (scale == 0.0 and self.applied_scale > 0.0)
+                self.scale = scale
+                if tighter and self.enabled and sum(self.requested) > 0:
+                    self.robot.setWheels(self.requested)
+            except Exception as e:
+                print(f"Safety monitor error: {e}")
+            time.sleep(self.period)
+
+    def stats(self):
+        return {
+            'enabled': self.enabled,
+            'distance_m': round(self.distance, 3),
+            'stop_distance_m': self.stop_distance,
+            'slow_distance_m': self.slow_distance,
+            'speed_scale': round(self.scale, 3),
+            'stops': self.stops,
+            'limited': self.limited,
+            'sample_hz': round(self.samples.stats()[0], 1),
+            'stop_latency': self.stop_latency.stats(),
+        }
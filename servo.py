@@ -0,0 +1,169 @@
+'''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''
+@ Filename: servo.py
+@ Version: V1.0
+@ Author: Afandi Azmi
+@ Description: Camera servos
+
+Calibrated angle-to-tick tables and smooth pan/tilt trajectories at a fixed rate
+'''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''
+
+
+import math
+import time
+import threading
+
+
+class ServoTable:
+    """Angle -> PCA9685 off tick for one servo, precomputed every `resolution` degrees over
+    its travel, so setting an angle is a clamp and a list index. The pulse is
+    zero_us + us_per_degree * (angle + trim) microseconds, out of the period of the chip's
+    actual PWM frequency (25 MHz / 4096 / (prescale + 1), 50.03 Hz when asked for 50).
+    The defaults are the 500 + 11 * angle us the servos have always been driven with."""
+    def __init__(self, min_angle=0.0, max_angle=180.0, frequency=50.0, zero_us=500.0, us_per_degree=11.0,
+                 trim=0.0, resolution=0.1):
+        self.min_angle = float(min_angle)
+        self.max_angle = float(max_angle)
+        self.resolution = resolution
+        self.calibration = {'zero_us': zero_us, 'us_per_degree': us_per_degree, 'trim': trim}
+        ticks_per_us = 4096 * frequency / 1e6
+        steps = int(round((self.max_angle - self.min_angle) / resolution))
+        self.ticks = [int(round(ticks_per_us * (zero_us + us_per_degree * (self.min_angle + i * resolution + trim))))
+                      for i in range(steps + 1)]
+
+    def clamp(self, angle):
+        return max(self.min_angle, min(float(angle), self.max_angle))
+
+    def lookup(self, angle):
+        "Off tick for angle (clamped to the servo's travel)"
+        return self.ticks[int((self.clamp(angle) - self.min_angle) / self.resolution + 0.5)]
+
+
+class ServoEngine:
+    """Moves the camera servos smoothly instead of jumping them to each new angle. Callers
+    only set targets (set_target, nudge); a thread ticks `rate` times a second and moves
+    every servo towards its target with its speed limited to max_speed and its
+    acceleration and braking to accel (deg/s, deg/s^2). All servos whose tick changed go
+    out together through MEEPOBOT.set_servo_angles, one register burst for pan (10) and
+    tilt (9). The thread sleeps while every servo is on target.
+
+    servos: {name: (channel, start angle)}. Travel limits come from the robot's ServoTables."""
+    def __init__(self, robot, servos, rate=50, max_speed=240.0, accel=1200.0):
+        self.robot = robot
+        self.rate = rate
+        self.max_speed = max_speed
+        self.accel = accel
+        self.cond = threading.Condition()
+        self.servos = {}
+        for name, (channel, angle) in servos.items():
+            table = robot.servo_table(channel)
+            angle = table.clamp(angle)
+            self.servos[name] = {'channel': channel, 'table': table, 'angle': angle, 'target': angle,
+                                 'velocity': 0.0, 'tick': None}
+        self.ticks = 0
+        self.writes = 0
+        self.overruns = 0
+        self.moving = False
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        # Puts every servo at its start angle
+        with self.cond:
+            self._write()
+        self.thread.start()
+
+    def set_target(self, name, angle):
+        "Sets where servo name should go; returns the target after clamping to its travel"
+        with self.cond:
+            servo = self.servos[name]
+            servo['target'] = servo['table'].clamp(angle)
+            self.cond.notify()
+            return servo['target']
+
+    def nudge(self, name, delta):
+        "Moves the target of servo name by delta degrees"
+        with self.cond:
+            return self.set_target(name, self.servos[name]['target'] + delta)
+
+    def angle(self, name):
+        "Where servo name is now on its trajectory"
+        return self.servos[name]['angle']
+
+    def target(self, name):
+        return self.servos[name]['target']
+
+    def _settled(self):
+        return all(servo['angle'] == servo['target'] for servo in self.servos.values())
+
+    def _advance(self, servo, dt):
+        error = servo['target'] - servo['angle']
+        velocity = servo['velocity']
+        if error == 0 and velocity == 0:
+            return
+        # Fastest speed that can still brake to a stop on the target
+        brake = math.copysign(math.sqrt(2 * self.accel * abs(error)), error)
+        wanted = max(-self.max_speed, min(brake, self.max_speed))
+        change = self.accel * dt
+        velocity += max(-change, min(wanted - velocity, change))
+        step = velocity * dt
+        if abs(step) >= abs(error) or (abs(error) < 0.05 and abs(velocity) <= change):
+            servo['angle'] = servo['target']
+            servo['velocity'] = 0.0
+        else:
+            servo['angle'] += step
+            servo['velocity'] = velocity
+
+    def _write(self):
+        # Caller holds the lock
+        angles = {}
+        for servo in self.servos.values():
+            tick = servo['table'].lookup(servo['angle'])
+            if tick != servo['tick']:
+                servo['tick'] = tick
+                angles[servo['channel']] = servo['angle']
+        if angles:
+            self.robot.set_servo_angles(angles)
+            self.writes += 1
+
+    def _tick(self, dt):
+        with self.cond:
+            for servo in self.servos.values():
+                self._advance(servo, dt)
+            self._write()
+            self.moving = not self._settled()
+
+    def _run(self):
+        period = 1.0 / self.rate
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: not self._settled())
+            next_tick = time.monotonic()
+            # Fixed-rate ticks until every servo has arrived
+            while True:
+                self.ticks += 1
+                try:
+                    self._tick(period)
+                except Exception as e:
+                    print(f"Servo engine error: {e}")
+                if not self.moving:
+                    break
+                next_tick += period
+                delay = next_tick - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                else:
+                    self.overruns += 1
+                    next_tick = time.monotonic()
+
+    def stats(self):
+        return {
+            'rate': self.rate,
+            'max_speed': self.max_speed,
+            'accel': self.accel,
+            'moving': self.moving,
+            'ticks': self.ticks,
+            'writes': self.writes,
+            'overruns': self.overruns,
+            'servos': {name: {'channel': servo['channel'], 'angle': round(servo['angle'], 2),
+                              'target': servo['target'], 'tick': servo['tick']}
+                       for name, servo in self.servos.items()},
+        }
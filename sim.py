@@ -0,0 +1,469 @@
+'''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''
+@ Filename: sim.py
+@ Version: V1.0
+@ Author: Afandi Azmi
+@ Description: Hardware simulation
+
+Simulated I2C bus with a PCA9685 register file, GPIO and camera for running off the robot
+'''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''
+
+
+import os
+import glob
+import math
+import time
+import threading
+import cv2
+import numpy as np
+
+
+# I2C clock and fixed per-transaction cost (syscall, driver, start/stop). The Pi's default
+# bus runs at 100 kHz; each byte on the wire takes 9 clocks (8 data bits + ACK).
+I2C_HZ = float(os.environ.get('MEEPOBOT_SIM_I2C_HZ', 100000))
+I2C_OVERHEAD = float(os.environ.get('MEEPOBOT_SIM_I2C_OVERHEAD', 60e-6))
+
+# PCA9685 registers the simulation gives meaning to
+MODE1 = 0x00
+MODE1_AI = 0x20
+MODE1_RESTART = 0x80
+LED0_ON_L = 0x06
+ALLLED_ON_L = 0xFA
+PRESCALE = 0xFE
+
+
+class i2c_msg:
+    "Stand-in for smbus2.i2c_msg; only raw writes are needed"
+    def __init__(self, addr, buf):
+        self.addr = addr
+        self.buf = list(buf)
+
+    @staticmethod
+    def write(addr, buf):
+        return i2c_msg(addr, buf)
+
+    def __iter__(self):
+        return iter(self.buf)
+
+    def __len__(self):
+        return len(self.buf)
+
+
+class SMBus:
+    """Simulated I2C bus holding one PCA9685-style register file per address. Writes honour
+    MODE1 auto-increment, ALL_LED fan-out and the general call reset, and each transaction
+    sleeps for the time it would take on the wire. Sleeping (rather than spinning) releases
+    the GIL like a real blocking ioctl does; expect the OS to add some oversleep."""
+    def __init__(self, bus=1, hz=None, overhead=None):
+        self.bus = bus
+        self.hz = hz or I2C_HZ
+        self.overhead = I2C_OVERHEAD if overhead is None else overhead
+        self.devices = {}
+        self.lock = threading.Lock()
+        self.transactions = 0
+        self.bytes = 0
+        self.busy_time = 0.0
+
+    def _device(self, addr):
+        if addr not in self.devices:
+            self.devices[addr] = self._power_on()
+        return self.devices[addr]
+
+    def _power_on(self):
+        regs = bytearray(256)
+        regs[MODE1] = 0x11           # SLEEP | ALLCALL
+        regs[0x01] = 0x04            # MODE2: totem pole outputs
+        regs[PRESCALE] = 0x1E        # 200 Hz
+        for channel in range(16):
+            regs[LED0_ON_L + 4 * channel + 3] = 0x10    # full off
+        return regs
+
+    def _transfer(self, nbytes):
+        # Address byte plus payload, 9 clocks per byte
+        latency = self.overhead + 9 * (1 + nbytes) / self.hz
+        with self.lock:
+            self.transactions += 1
+            self.bytes += nbytes
+            self.busy_time += latency
+        time.sleep(latency)
+
+    def _store(self, addr, reg, data):
+        regs = self._device(addr)
+        if not regs[MODE1] & MODE1_AI:
+            # Without auto-increment every byte lands in the same register
+            data = data[-1:]
+        for value in data:
+            value &= 0xFF
+            if reg == MODE1:
+                value &= ~MODE1_RESTART & 0xFF      # RESTART clears itself
+            regs[reg] = value
+            if ALLLED_ON_L <= reg < ALLLED_ON_L + 4:
+                # ALL_LED loads the same byte into every channel
+                offset = reg - ALLLED_ON_L
+                for channel in range(16):
+                    regs[LED0_ON_L + 4 * channel + offset] = value
+            reg = (reg + 1) & 0xFF
+
+    def write_byte(self, addr, value):
+        self._transfer(1)
+        if addr == 0x00 and value == 0x06:
+            # General call software reset
+            for address in self.devices:
+                self.devices[address] = self._power_on()
+
+    def write_byte_data(self, addr, reg, value):
+        self._transfer(2)
+        self._store(addr, reg, [value])
+
+    def write_i2c_block_data(self, addr, reg, data):
+        data = list(data)
+        if len(data) > 32:
+            raise OSError("SMBus block write is limited to 32 bytes")
+        self._transfer(1 + len(data))
+        self._store(addr, reg, data)
+
+    def i2c_rdwr(self, *messages):
+        for msg in messages:
+            self._transfer(len(msg))
+            buf = list(msg)
+            self._store(msg.addr, buf[0], buf[1:])
+
+    def read_byte_data(self, addr, reg):
+        self._transfer(3)
+        return self._device(addr)[reg]
+
+    def close(self):
+        pass
+
+    def pwm(self, channel, addr=0x40):
+        "(on, off) ticks of a PCA9685 channel, with the full-on/full-off bits"
+        regs = self._device(addr)
+        base = LED0_ON_L + 4 * channel
+        return (regs[base] | regs[base + 1] << 8, regs[base + 2] | regs[base + 3] << 8)
+
+    def stats(self):
+        return {
+            'transactions': self.transactions,
+            'bytes': self.bytes,
+            'busy_ms': round(1000 * self.busy_time, 3),
+        }
+
+
+# Simulated GPIO: output levels by pin number, for tests and benchmarks to inspect
+GPIO_PINS = {}
+
+
+class LED:
+    "gpiozero.LED stand-in"
+    def __init__(self, pin, active_high=True, initial_value=False):
+        self.pin = pin
+        self.value = int(initial_value)
+        GPIO_PINS[pin] = self.value
+
+    def on(self):
+        self.value = 1
+        GPIO_PINS[self.pin] = 1
+
+    def off(self):
+        self.value = 0
+        GPIO_PINS[self.pin] = 0
+
+    @property
+    def is_lit(self):
+        return bool(self.value)
+
+    def close(self):
+        GPIO_PINS.pop(self.pin, None)
+
+
+class DistanceSensor:
+    """gpiozero.DistanceSensor stand-in. Set `distance` (metres) to move the obstacle;
+    crossing threshold_distance fires when_in_range / when_out_of_range like the real one"""
+    def __init__(self, echo=None, trigger=None, queue_len=9, max_distance=1, threshold_distance=0.3, **kwargs):
+        self.echo = echo
+        self.trigger = trigger
+        self.max_distance = max_distance
+        self.threshold_distance = threshold_distance
+        self.when_in_range = None
+        self.when_out_of_range = None
+        self._distance = min(float(os.environ.get('MEEPOBOT_SIM_DISTANCE', max_distance)), max_distance)
+
+    @property
+    def distance(self):
+        return self._distance
+
+    @distance.setter
+    def distance(self, value):
+        was_in_range = self.in_range
+        self._distance = max(0.0, min(value, self.max_distance))
+        if self.in_range and not was_in_range and self.when_in_range:
+            self.when_in_range()
+        elif was_in_range and not self.in_range and self.when_out_of_range:
+            self.when_out_of_range()
+
+    @property
+    def in_range(self):
+        return self._distance < self.threshold_distance
+
+    @property
+    def value(self):
+        return self._distance / self.max_distance
+
+    def close(self):
+        pass
+
+
+class Button:
+    "gpiozero.Button stand-in; press() and release() drive it"
+    def __init__(self, pin=None, pull_up=True, bounce_time=None, **kwargs):
+        self.pin = pin
+        self.is_pressed = False
+        self.when_pressed = None
+        self.when_released = None
+
+    def press(self):
+        self.is_pressed = True
+        if self.when_pressed:
+            self.when_pressed()
+
+    def release(self):
+        self.is_pressed = False
+        if self.when_released:
+            self.when_released()
+
+    def close(self):
+        pass
+
+
+class Transform:
+    "libcamera.Transform stand-in; the simulated sensor ignores flips"
+    def __init__(self, hflip=0, vflip=0):
+        self.hflip = hflip
+        self.vflip = vflip
+
+
+def draw_face(image, cx, cy, size):
+    "A flat cartoon face the frontal-face Haar cascade picks up; size is the face width"
+    cv2.ellipse(image, (cx, cy), (size // 2, int(size * 0.65)), 0, 0, 360, (150, 170, 200), -1)
+    ey = cy - size // 8
+    for dx in (-size // 5, size // 5):
+        cv2.ellipse(image, (cx + dx, ey - size // 7), (size // 7, size // 30 + 1), 0, 180, 360,
+                    (40, 40, 50), max(2, size // 25))
+        cv2.ellipse(image, (cx + dx, ey), (size // 9, size // 16), 0, 0, 360, (40, 40, 50), -1)
+    cv2.line(image, (cx, ey), (cx, cy + size // 8), (120, 140, 170), max(2, size // 30))
+    cv2.ellipse(image, (cx, cy + size // 4), (size // 6, size // 20 + 1), 0, 0, 360, (60, 60, 120), -1)
+
+
+class LineScene:
+    "Light floor with a dark track that sways and bends over time"
+    def __init__(self, color=(20, 20, 20), floor=(190, 190, 190)):
+        self.color = color
+        self.floor = floor
+
+    def render(self, n, size):
+        w, h = size
+        image = np.empty((h, w, 3), np.uint8)
+        image[:] = self.floor
+        phase = n / 30.0
+        rows = np.arange(0, h + 1, max(h // 12, 1))
+        xs = w / 2 + 0.25 * w * np.sin(phase) + 0.15 * w * np.sin(phase * 0.7 + rows / h * math.pi) * (1 - rows / h)
+        points = np.stack([xs, rows], axis=1).astype(np.int32)
+        cv2.polylines(image, [points], False, self.color, max(w // 16, 2))
+        return image
+
+
+class FaceScene:
+    "A face drifting across a plain background, growing and shrinking as if walking around"
+    def render(self, n, size):
+        w, h = size
+        image = np.full((h, w, 3), 90, np.uint8)
+        phase = n / 30.0
+        face = int(w * (0.25 + 0.08 * math.sin(phase * 0.5)))
+        draw_face(image, int(w / 2 + 0.3 * w * math.sin(phase)), int(h * 0.45), face)
+        return image
+
+
+class FileScene:
+    "Plays image files (a path, directory or glob) or a video file, looping forever"
+    def __init__(self, path):
+        self.video = None
+        self.images = []
+        self.cache = {}
+        if os.path.isdir(path):
+            path = os.path.join(path, '*')
+        files = sorted(glob.glob(path))
+        images = [f for f in files if cv2.haveImageReader(f)]
+        if images:
+            self.images = images
+        elif files:
+            self.video = cv2.VideoCapture(files[0])
+        if not self.images and (self.video is None or not self.video.isOpened()):
+            raise FileNotFoundError("No images or video at %s" % path)
+
+    def render(self, n, size):
+        if self.video is not None:
+            ok, image = self.video.read()
+            if not ok:
+                self.video.set(cv2.CAP_PROP_POS_FRAMES, 0)
+                ok, image = self.video.read()
+            return cv2.resize(image, size)
+        key = (n % len(self.images), tuple(size))
+        if key not in self.cache:
+            self.cache[key] = cv2.resize(cv2.imread(self.images[key[0]]), size)
+        return self.cache[key]
+
+
+def make_scene(source):
+    "'line', 'face' or a path to images/video"
+    if source == 'line':
+        return LineScene()
+    if source == 'face':
+        return FaceScene()
+    return FileScene(source)
+
+
+class SimRequest:
+    def __init__(self, arrays, metadata):
+        self.arrays = arrays
+        self.metadata = metadata
+
+    def get_metadata(self):
+        return self.metadata
+
+    def make_array(self, name):
+        return self.arrays[name]
+
+    def release(self):
+        pass
+
+
+class MappedArray:
+    "picamera2.MappedArray stand-in"
+    def __init__(self, request, stream, write=True):
+        self.request = request
+        self.stream = stream
+
+    def __enter__(self):
+        self.array = self.request.arrays[self.stream]
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+class Picamera2:
+    """Picamera2 stand-in producing frames from a scene at a fixed frame rate. The scene comes
+    from MEEPOBOT_SIM_CAMERA: 'line' (default), 'face', or a path to images or a video."""
+    def __init__(self, camera_num=0, source=None, fps=None):
+        self.scene = make_scene(source or os.environ.get('MEEPOBOT_SIM_CAMERA', 'line'))
+        self.fps = fps or float(os.environ.get('MEEPOBOT_SIM_FPS', 30))
+        self.config = None
+        self.started = False
+        self.frames = 0
+        self.next_frame = 0.0
+
+    def create_preview_configuration(self, main=None, lores=None, **kwargs):
+        config = {'main': dict({'format': 'XBGR8888', 'size': (640, 480)}, **(main or {}))}
+        if lores:
+            config['lores'] = dict({'format': 'YUV420'}, **lores)
+        return config
+
+    create_video_configuration = create_preview_configuration
+    create_still_configuration = create_preview_configuration
+
+    def configure(self, config):
+        # Like the ISP, YUV420 rows are padded to a multiple of 64 bytes
+        for name in ('main', 'lores'):
+            if name in config:
+                w = config[name]['size'][0]
+                config[name]['stride'] = -(-w // 64) * 64 if config[name].get('format') == 'YUV420' else None
+        self.config = config
+
+    def stream_configuration(self, name='main'):
+        return self.config[name]
+
+    def start(self):
+        if self.config is None:
+            self.configure(self.create_preview_configuration())
+        self.started = True
+        self.next_frame = time.monotonic()
+
+    def stop(self):
+        self.started = False
+
+    def close(self):
+        self.stop()
+
+    def _stream(self, image, spec):
+        fmt = spec.get('format', 'RGB888')
+        if fmt == 'YUV420':
+            yuv = cv2.cvtColor(image, cv2.COLOR_BGR2YUV_I420)
+            w, h = spec['size']
+            stride = spec.get('stride') or w
+            if stride == w:
+                return yuv
+            # Planes with padded rows, in a (h * 3 // 2, stride) buffer like Picamera2's
+            flat = yuv.reshape(-1)
+            padded = np.zeros(h * 3 // 2 * stride, np.uint8)
+            padded[:h * stride].reshape(h, stride)[:, :w] = flat[:h * w].reshape(h, w)
+            for plane in range(2):
+                src = flat[h * w + plane * h * w // 4:h * w + (plane + 1) * h * w // 4].reshape(h // 2, w // 2)
+                start = h * stride + plane * (h // 2) * (stride // 2)
+                padded[start:start + (h // 2) * (stride // 2)].reshape(h // 2, stride // 2)[:, :w // 2] = src
+            return padded.reshape(h * 3 // 2, stride)
+        if fmt in ('XBGR8888', 'XRGB8888'):
+            return cv2.cvtColor(image, cv2.COLOR_BGR2BGRA)
+        # RGB888 is stored B, G, R in memory, i.e. what OpenCV calls BGR
+        return image
+
+    def capture_request(self):
+        if not self.started:
+            raise RuntimeError("Camera is not started")
+        # Pace frames like a sensor running at self.fps
+        delay = self.next_frame - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        self.next_frame = max(self.next_frame + 1.0 / self.fps, time.monotonic())
+        if not self.started:
+            raise RuntimeError("Camera stopped")
+        self.frames += 1
+        main = self.config['main']
+        image = self.scene.render(self.frames, tuple(main['size']))
+        arrays = {'main': self._stream(image, main)}
+        if 'lores' in self.config:
+            lores = self.config['lores']
+            small = cv2.resize(image, tuple(lores['size']), interpolation=cv2.INTER_AREA)
+            arrays['lores'] = self._stream(small, lores)
+        return SimRequest(arrays, {'SensorTimestamp': time.monotonic_ns(), 'FrameDuration': int(1e6 / self.fps)})
+
+    def capture_array(self, name='main'):
+        request = self.capture_request()
+        return request.make_array(name)
+
+
+if __name__ == '__main__':
+    # python sim.py: bus cost of common robot commands and camera throughput, no robot needed
+    os.environ['MEEPOBOT_BACKEND'] = 'sim'
+    from MEEPOBOT import MEEPOBOT
+    robot = MEEPOBOT(blocking=True)
+    bus = robot.pwm.bus
+    for name, command in [('setWheels', lambda i: robot.setWheels([(i % 100) - 50] * 4)),
+                          ('drive', lambda i: robot.drive(50, 0, (i % 40) - 20)),
+                          ('servo', lambda i: robot.set_servo_angle(10, i % 180))]:
+        before = dict(bus.stats())
+        start = time.perf_counter()
+        for i in range(200):
+            command(i)
+        elapsed = time.perf_counter() - start
+        after = bus.stats()
+        print("%-10s %6.3f ms/call  %5.2f transactions/call  %6.3f ms simulated bus time/call" % (
+            name, 1000 * elapsed / 200, (after['transactions'] - before['transactions']) / 200,
+            (after['busy_ms'] - before['busy_ms']) / 200))
+    for source in ('line', 'face'):
+        camera = Picamera2(source=source, fps=1000)
+        camera.configure(camera.create_preview_configuration(main={'format': 'RGB888', 'size': (640, 480)},
+                                                             lores={'format': 'YUV420', 'size': (320, 240)}))
+        camera.start()
+        start = time.perf_counter()
+        for _ in range(100):
+            camera.capture_request().release()
+        print("camera %-5s %6.3f ms/frame to render" % (source, 1000 * (time.perf_counter() - start) / 100))
@@ -1,80 +1,226 @@
-// Register custom blocks for MEEPOBOT movement
+// Custom Blockly blocks for MEEPOBOT movement, and the walk that turns a workspace into
+// the statement list /run_instructions compiles (see program.py on the robot)
+
+const DIRECTION_OPTIONS = [
+  ["Forward", "forward"],
+  ["Backward", "backward"],
+  ["Turn Left", "left"],
+  ["Turn Right", "right"],
+  ["Strafe Left", "strafe_left"],
+  ["Strafe Right", "strafe_right"],
+];
+
+const CONDITION_OPTIONS = [
+  ["an obstacle is nearer than", "near"],
+  ["the path is clear for", "clear"],
+];
+
+function appendSpeedInput(block) {
+  block.appendValueInput("SPEED").setCheck("Number").appendField("at speed");
+}
+
 function defineRobotBlocks() {
-  // --- Block 1: Move Direction for Duration ---
-Blockly.Blocks['robot_move'] = {
-  init: function() {
-    this.appendDummyInput()
+  // --- Move in any direction for a duration, at a speed (0-100) ---
+  Blockly.Blocks["robot_move"] = {
+    init: function () {
+      this.appendDummyInput()
         .appendField("Move")
-        .appendField(new Blockly.FieldDropdown([
-            ["Forward", "forward"], 
-            ["Backward", "backward"], 
-            ["Left", "left"], 
-            ["Right", "right"]
-        ]), "DIRECTION");
-    this.appendValueInput("DURATION")
-        .setCheck("Number")
-        .appendField("for");
-    this.appendDummyInput()
-        .appendField("seconds");
-    this.setPreviousStatement(true, null);
-    this.setNextStatement(true, null);
-    this.setColour(160);
-    this.setTooltip("Move the robot in a specified direction for a set duration.");
-    this.setHelpUrl("");
-  }
-};
+        .appendField(new Blockly.FieldDropdown(DIRECTION_OPTIONS), "DIRECTION");
+      this.appendValueInput("DURATION").setCheck("Number").appendField("for");
+      this.appendDummyInput().appendField("seconds");
+      appendSpeedInput(this);
+      this.setInputsInline(true);
+      this.setPreviousStatement(true, null);
+      this.setNextStatement(true, null);
+      this.setColour(210);
+      this.setTooltip("Move the robot in a direction for a set duration.");
+      this.setHelpUrl("");
+    },
+  };
 
-// Defines the JavaScript code generator for 'robot_move'
-Blockly.JavaScript['robot_move'] = function(block) {
-  const direction = block.getFieldValue('DIRECTION');
-  const duration = Blockly.JavaScript.valueToCode(block, 'DURATION', Blockly.JavaScript.ORDER_ATOMIC) || '0';
-  
-  // The output format is a string command that your backend Python script (or equivalent) expects,
-  // typically 'command:duration'. Example: 'forward:3'
-  const code = `'${direction}:${duration}'`; 
-  return code + ';\n';
-};
+  // --- One block per direction (the original toolbox) ---
+  const fixedMoves = [
+    ["robot_forward", "Move Forward for", 210, "Move robot forward"],
+    ["robot_backward", "Move Backward for", 210, "Move robot backward"],
+    ["robot_left", "Turn Left for", 160, "Turn robot left"],
+    ["robot_right", "Turn Right for", 160, "Turn robot right"],
+  ];
+  fixedMoves.forEach(([type, label, colour, tooltip]) => {
+    Blockly.Blocks[type] = {
+      init: function () {
+        this.appendDummyInput().appendField(label);
+        this.appendValueInput("DURATION").setCheck("Number");
+        this.appendDummyInput().appendField("seconds");
+        appendSpeedInput(this);
+        this.setInputsInline(true);
+        this.setPreviousStatement(true, null);
+        this.setNextStatement(true, null);
+        this.setColour(colour);
+        this.setTooltip(tooltip);
+        this.setHelpUrl("");
+      },
+    };
+  });
 
-// Defines the 'robot_stop' block
-Blockly.Blocks['robot_stop'] = {
-  init: function() {
-    this.appendDummyInput()
-        .appendField("STOP");
-    this.setPreviousStatement(true, null);
-    this.setNextStatement(true, null);
-    this.setColour(160);
-    this.setTooltip("Stop all robot movement immediately.");
-    this.setHelpUrl("");
-  }
-};
+  Blockly.Blocks["robot_stop"] = {
+    init: function () {
+      this.appendDummyInput().appendField("Stop for");
+      this.appendValueInput("DURATION").setCheck("Number");
+      this.appendDummyInput().appendField("seconds");
+      this.setInputsInline(true);
+      this.setPreviousStatement(true, null);
+      this.setNextStatement(true, null);
+      this.setColour(0);
+      this.setTooltip("Stop robot movement");
+      this.setHelpUrl("");
+    },
+  };
 
-// Defines the JavaScript code generator for 'robot_stop'
-Blockly.JavaScript['robot_stop'] = function(block) {
-  // Output a simple 'stop' command
-  const code = "'stop:0'";
-  return code + ';\n';
-};
+  // --- Sensor blocks: the ultrasonic distance ahead of the robot, in metres ---
+  Blockly.Blocks["robot_if_obstacle"] = {
+    init: function () {
+      this.appendDummyInput()
+        .appendField("if")
+        .appendField(new Blockly.FieldDropdown(CONDITION_OPTIONS), "CONDITION");
+      this.appendValueInput("DISTANCE").setCheck("Number");
+      this.appendDummyInput().appendField("m");
+      this.appendStatementInput("DO").appendField("do");
+      this.appendStatementInput("ELSE").appendField("else");
+      this.setInputsInline(true);
+      this.setPreviousStatement(true, null);
+      this.setNextStatement(true, null);
+      this.setColour(30);
+      this.setTooltip("Run one branch or the other depending on the distance sensor.");
+      this.setHelpUrl("");
+    },
+  };
 
-// Register generators (how Blockly turns the blocks into text)
-function registerRobotGenerators(generator) {
-  // Generator for the Move block
-  generator["robot_move"] = function (block) {
-    const direction = block.getFieldValue("DIRECTION");
-    const duration =
-      generator.valueToCode(block, "DURATION", generator.ORDER_NONE) || "1";
-    // Generate the instruction string: e.g., "t_up:2"
-    const code = `${direction}:${duration}`;
-    return code;
+  Blockly.Blocks["robot_while_obstacle"] = {
+    init: function () {
+      this.appendDummyInput()
+        .appendField("repeat while")
+        .appendField(new Blockly.FieldDropdown(CONDITION_OPTIONS), "CONDITION");
+      this.appendValueInput("DISTANCE").setCheck("Number");
+      this.appendDummyInput().appendField("m");
+      this.appendStatementInput("DO").appendField("do");
+      this.setInputsInline(true);
+      this.setPreviousStatement(true, null);
+      this.setNextStatement(true, null);
+      this.setColour(30);
+      this.setTooltip("Repeat the blocks inside as long as the distance condition holds.");
+      this.setHelpUrl("");
+    },
   };
 
-  // Generator for the Stop block
-  generator["robot_stop"] = function (block) {
-    // We'll use a short stop duration to separate commands
-    const code = "t_stop:0.1";
-    return code;
+  Blockly.Blocks["robot_wait_until"] = {
+    init: function () {
+      this.appendDummyInput()
+        .appendField("wait until")
+        .appendField(new Blockly.FieldDropdown(CONDITION_OPTIONS), "CONDITION");
+      this.appendValueInput("DISTANCE").setCheck("Number");
+      this.appendValueInput("TIMEOUT").setCheck("Number").appendField("m, at most");
+      this.appendDummyInput().appendField("seconds");
+      this.setInputsInline(true);
+      this.setPreviousStatement(true, null);
+      this.setNextStatement(true, null);
+      this.setColour(30);
+      this.setTooltip("Wait for the distance condition, or until the timeout.");
+      this.setHelpUrl("");
+    },
   };
 }
 
-// Call the functions to define and register the blocks
+// Workspace -> statements. Numbers are evaluated here (number and arithmetic blocks),
+// so the robot only ever receives plain values.
+const FIXED_DIRECTIONS = {
+  robot_forward: "forward",
+  robot_backward: "backward",
+  robot_left: "left",
+  robot_right: "right",
+};
+
+function numberValue(block, name, fallback) {
+  const target = block.getInputTargetBlock(name);
+  if (!target) {
+    return fallback;
+  }
+  switch (target.type) {
+    case "math_number":
+      return Number(target.getFieldValue("NUM"));
+    case "math_arithmetic": {
+      const a = numberValue(target, "A", 0);
+      const b = numberValue(target, "B", 0);
+      switch (target.getFieldValue("OP")) {
+        case "ADD":
+          return a + b;
+        case "MINUS":
+          return a - b;
+        case "MULTIPLY":
+          return a * b;
+        case "DIVIDE":
+          return a / b;
+        case "POWER":
+          return Math.pow(a, b);
+      }
+    }
+  }
+  throw new Error(`A "${target.type}" block cannot be used as a number`);
+}
+
+function statementList(block) {
+  const statements = [];
+  for (; block; block = block.getNextBlock()) {
+    if (block.isEnabled && !block.isEnabled()) {
+      continue;
+    }
+    statements.push(blockStatement(block));
+  }
+  return statements;
+}
+
+function blockStatement(block) {
+  const statement = { block: block.id };
+  if (block.type === "robot_move" || FIXED_DIRECTIONS[block.type]) {
+    statement.op = "move";
+    statement.direction =
+      FIXED_DIRECTIONS[block.type] || block.getFieldValue("DIRECTION");
+    statement.duration = numberValue(block, "DURATION", 1);
+    statement.speed = numberValue(block, "SPEED", 50);
+  } else if (block.type === "robot_stop") {
+    statement.op = "stop";
+    statement.duration = numberValue(block, "DURATION", 0);
+  } else if (block.type === "controls_repeat_ext") {
+    statement.op = "repeat";
+    statement.times = numberValue(block, "TIMES", 0);
+    statement.body = statementList(block.getInputTargetBlock("DO"));
+  } else if (block.type === "robot_if_obstacle") {
+    statement.op = "if";
+    statement.condition = block.getFieldValue("CONDITION");
+    statement.distance = numberValue(block, "DISTANCE", 0.3);
+    statement.then = statementList(block.getInputTargetBlock("DO"));
+    statement.else = statementList(block.getInputTargetBlock("ELSE"));
+  } else if (block.type === "robot_while_obstacle") {
+    statement.op = "while";
+    statement.condition = block.getFieldValue("CONDITION");
+    statement.distance = numberValue(block, "DISTANCE", 0.3);
+    statement.body = statementList(block.getInputTargetBlock("DO"));
+  } else if (block.type === "robot_wait_until") {
+    statement.op = "wait_until";
+    statement.condition = block.getFieldValue("CONDITION");
+    statement.distance = numberValue(block, "DISTANCE", 0.3);
+    statement.timeout = numberValue(block, "TIMEOUT", 10);
+  } else {
+    throw new Error(`The "${block.type}" block cannot run on the robot`);
+  }
+  return statement;
+}
+
+// Top-level stacks run one after the other, top to bottom
+function robotProgram(workspace) {
+  return workspace
+    .getTopBlocks(true)
+    .filter((block) => block.previousConnection || block.nextConnection)
+    .flatMap((block) => statementList(block));
+}
+
 defineRobotBlocks();
-registerRobotGenerators(Blockly.JavaScript);
@@ -0,0 +1,122 @@
+'''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''
+@ Filename: streaming.py
+@ Version: V1.0
+@ Author: Afandi Azmi
+@ Description: Camera frame distribution
+
+Hands the latest encoded camera frame to every /video_feed viewer
+'''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''
+
+
+import time
+import threading
+import cv2
+import numpy as np
+
+
+class FrameHub:
+    "Latest-frame broadcaster: the capture thread publishes, each viewer waits for a newer sequence number"
+    def __init__(self, max_fps=30, on_subscribe=None):
+        self.cond = threading.Condition()
+        self.on_subscribe = on_subscribe
+        self.frame = None
+        self.seq = 0
+        self.max_fps = max_fps
+        self.subscribers = 0
+        self.frames_served = 0
+        self.frames_dropped = 0
+
+    def publish(self, jpeg):
+        """Stores a new encoded frame (bytes or a uint8 array from cv2.imencode) and wakes every
+        waiting viewer. The multipart part is built once here, viewers all send the same bytes"""
+        frame = b''.join((b'--frame\r\nContent-Type: image/jpeg\r\n\r\n', jpeg, b'\r\n'))
+        with self.cond:
+            self.frame = frame
+            self.seq += 1
+            self.cond.notify_all()
+
+    def wait_frame(self, last_seq, timeout=1.0):
+        "Blocks until a frame newer than last_seq exists; returns (seq, frame) or None on timeout"
+        with self.cond:
+            if not self.cond.wait_for(lambda: self.seq != last_seq and self.frame is not None, timeout):
+                return None
+            return self.seq, self.frame
+
+    def stream(self, max_fps=None):
+        "Multipart MJPEG generator for one viewer, capped at max_fps"
+        fps = min(max_fps or self.max_fps, self.max_fps)
+        interval = 1.0 / fps if fps > 0 else 0
+        with self.cond:
+            self.subscribers += 1
+        if self.on_subscribe:
+            self.on_subscribe()
+        try:
+            last_seq = 0
+            last_sent = 0.0
+            while True:
+                latest = self.wait_frame(last_seq)
+                if latest is None:
+                    continue
+                seq, frame = latest
+                # A slow viewer only ever gets the newest frame, everything in between is dropped
+                with self.cond:
+                    if last_seq:
+                        self.frames_dropped += seq - last_seq - 1
+                    self.frames_served += 1
+                last_seq = seq
+                yield frame
+                wait = last_sent + interval - time.monotonic()
+                if wait > 0:
+                    time.sleep(wait)
+                last_sent = time.monotonic()
+        finally:
+            with self.cond:
+                self.subscribers -= 1
+
+    def has_viewers(self):
+        return self.subscribers > 0
+
+    def stats(self):
+        return {
+            'subscribers': self.subscribers,
+            'published': self.seq,
+            'served': self.frames_served,
+            'dropped': self.frames_dropped,
+        }
+
+
+class Overlay:
+    """Draws annotations given in vision-stream coordinates onto the viewer frame, scaled to
+    its resolution. Without a viewer frame (nobody watching) every call is a no-op."""
+    def __init__(self, image, vision_size):
+        self.image = image
+        if image is not None:
+            self.sx = image.shape[1] / vision_size[0]
+            self.sy = image.shape[0] / vision_size[1]
+
+    def _pt(self, x, y):
+        return (int(x * self.sx), int(y * self.sy))
+
+    def rectangle(self, p1, p2, color, thickness=1):
+        if self.image is not None:
+            cv2.rectangle(self.image, self._pt(*p1), self._pt(*p2), color, thickness)
+
+    def circle(self, center, radius, color, thickness=1):
+        if self.image is not None:
+            cv2.circle(self.image, self._pt(*center), int(radius * self.sx), color, thickness)
+
+    def line(self, p1, p2, color, thickness=1):
+        if self.image is not None:
+            cv2.line(self.image, self._pt(*p1), self._pt(*p2), color, thickness)
+
+    def text(self, text, org, scale, color, thickness=1):
+        if self.image is not None:
+            cv2.putText(self.image, text, self._pt(*org), cv2.FONT_HERSHEY_SIMPLEX, scale * self.sx, color, thickness)
+
+    def contours(self, contours, color, thickness=1, offset=(0, 0)):
+        if self.image is None:
+            return
+        scale = np.array([self.sx, self.sy])
+        shift = np.array(offset)
+        scaled = [((c + shift) * scale).astype(np.int32) for c in contours]
+        cv2.drawContours(self.image, scaled, -1, color, thickness)
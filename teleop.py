@@ -0,0 +1,231 @@
+'''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''
+@ Filename: teleop.py
+@ Version: V1.0
+@ Author: Afandi Azmi
+@ Description: Manual control channel
+
+Drive and servo commands over a WebSocket, coalesced and applied at a fixed rate
+'''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''
+
+
+import json
+import time
+import itertools
+import threading
+from pipeline import LatencyStats
+
+
+DRIVE_COMMANDS = ('forward', 'backward', 'left', 'right', 'stop')
+SERVOS = ('pan', 'tilt')
+
+
+def _number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def check_message(message):
+    "Why a decoded control message cannot be used, or None if it can"
+    if not isinstance(message, dict):
+        return 'message must be a JSON object'
+    kind = message.get('type')
+    if kind == 'drive':
+        if message.get('command') not in DRIVE_COMMANDS:
+            return 'command must be one of %s' % ', '.join(DRIVE_COMMANDS)
+        speed = message.get('speed', 50)
+        if not _number(speed) or not 0 <= speed <= 100:
+            return 'speed must be a number from 0 to 100'
+    elif kind == 'servo':
+        if message.get('servo') not in SERVOS:
+            return 'servo must be pan or tilt'
+        if message.get('action') not in ('increment', 'decrement'):
+            return 'action must be increment or decrement'
+    if 'rtt' in message and message['rtt'] is not None and not _number(message['rtt']):
+        return 'rtt must be a number'
+    return None
+
+
+class TeleopChannel:
+    """Manual drive and servo commands from persistent client connections. Receiving a
+    message only records it: the newest drive command replaces any not yet applied, servo
+    steps add up per servo. An actuation thread applies them at most `rate` times a second,
+    so a burst of updates costs one bus command. Every message is acked with its id and the
+    client's timestamp (t) so the client can time the round trip and report it back (rtt).
+    If the client that is driving sends nothing for `deadman` seconds, or disconnects, the
+    robot is stopped.
+
+    drive(command, speed) and servo(name, steps) do the actual work (steps is signed)."""
+    def __init__(self, drive, servo, rate=20, deadman=0.5):
+        self.drive = drive
+        self.servo = servo
+        self.interval = 1.0 / rate
+        self.deadman = deadman
+        self.cond = threading.Condition()
+        self.pending_drive = None    # (command, speed, received ns)
+        self.pending_servo = {}      # servo name -> net steps
+        self.driver = None           # connection whose drive command is active
+        self.last_seen = {}
+        self.ids = itertools.count(1)
+        self.connections = 0
+        self.received = 0
+        self.applied = 0
+        self.coalesced = 0
+        self.rejected = 0
+        self.deadman_stops = 0
+        self.apply_latency = LatencyStats()
+        self.client_rtt = LatencyStats()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def serve(self, ws):
+        "Runs one connection (a flask-sock WebSocket) until it closes"
+        client = next(self.ids)
+        with self.cond:
+            self.connections += 1
+            self.last_seen[client] = time.monotonic()
+        try:
+            while True:
+                raw = ws.receive(timeout=self.deadman)
+                if raw is None:
+                    if self._check_deadman(client):
+                        ws.send(json.dumps({'type': 'deadman'}))
+                    continue
+                try:
+                    message = json.loads(raw)
+                except ValueError:
+                    ws.send(json.dumps({'type': 'error', 'message': 'invalid JSON'}))
+                    continue
+                ws.send(json.dumps(self.handle(client, message)))
+        finally:
+            with self.cond:
+                self.connections -= 1
+                self.last_seen.pop(client, None)
+                if self.driver == client:
+                    self._stop()
+
+    def handle(self, client, message):
+        "Records one message and returns its ack, or an error reply for a message it cannot use"
+        error = check_message(message)
+        if error is not None:
+            with self.cond:
+                self.rejected += 1
+            reply = {'type': 'error', 'message': error}
+            if isinstance(message, dict):
+                reply['id'] = message.get('id')
+            return reply
+        now = time.monotonic_ns()
+        kind = message.get('type')
+        with self.cond:
+            self.received += 1
+            self.last_seen[client] = now / 1e9
+            if kind == 'drive':
+                if self.pending_drive is not None:
+                    self.coalesced += 1
+                command = message.get('command')
+                self.pending_drive = (command, message.get('speed', 50), now)
+                self.driver = None if command == 'stop' else client
+                self.cond.notify()
+            elif kind == 'servo':
+                name = message.get('servo')
+                step = 1 if message.get('action') == 'increment' else -1
+                if name in self.pending_servo:
+                    self.coalesced += 1
+                self.pending_servo[name] = self.pending_servo.get(name, 0) + step
+                self.cond.notify()
+        if message.get('rtt'):
+            self.client_rtt.add(int(float(message['rtt']) * 1e6))
+        return {'type': 'ack', 'id': message.get('id'), 't': message.get('t')}
+
+    def cancel(self):
+        "Forgets the active driver and anything not applied yet (an autonomous mode took over)"
+        with self.cond:
+            self.pending_drive = None
+            self.pending_servo = {}
+            self.driver = None
+
+    def _stop(self):
+        # Caller holds the lock
+        self.pending_drive = ('stop', 0, time.monotonic_ns())
+        self.driver = None
+        self.cond.notify()
+
+    def _check_deadman(self, client):
+        with self.cond:
+            if self.driver != client or time.monotonic() - self.last_seen[client] < self.deadman:
+                return False
+            self.deadman_stops += 1
+            self._stop()
+            return True
+
+    def _run(self):
+        last = 0.0
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: self.pending_drive is not None or self.pending_servo)
+            # Applied right away when idle; updates arriving within interval are merged meanwhile
+            wait = last + self.interval - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            with self.cond:
+                drive, self.pending_drive = self.pending_drive, None
+                servo, self.pending_servo = self.pending_servo, {}
+            last = time.monotonic()
+            try:
+                if drive is not None:
+                    command, speed, received = drive
+                    self.drive(command, speed)
+                    self.apply_latency.add(time.monotonic_ns() - received)
+                for name, steps in servo.items():
+                    if steps:
+                        self.servo(name, steps)
+                self.applied += 1
+            except Exception as e:
+                print(f"Teleop error: {e}")
+
+    def stats(self):
+        return {
+            'connections': self.connections,
+            'driving': self.driver is not None,
+            'received': self.received,
+            'applied': self.applied,
+            'coalesced': self.coalesced,
+            'rejected': self.rejected,
+            'deadman_stops': self.deadman_stops,
+            'apply_latency': self.apply_latency.stats(),
+            'client_rtt': self.client_rtt.stats(),
+        }
+
+
+if __name__ == '__main__':
+    # python teleop.py [http://robot:5000]: round trip of a stop command over POST and the WebSocket
+    import sys
+    import http.client
+    from urllib.parse import urlparse
+    import numpy as np
+    from simple_websocket import Client
+
+    url = urlparse(sys.argv[1] if len(sys.argv) > 1 else 'http://127.0.0.1:5000')
+    count = 200
+
+    conn = http.client.HTTPConnection(url.hostname, url.port or 80)
+    body = json.dumps({'command': 'stop', 'speed': 0})
+    post = []
+    for _ in range(count):
+        start = time.perf_counter()
+        conn.request('POST', '/manual_control', body, {'Content-Type': 'application/json'})
+        conn.getresponse().read()
+        post.append(time.perf_counter() - start)
+    conn.close()
+
+    ws = Client.connect('ws://%s:%d/control_ws' % (url.hostname, url.port or 80))
+    socket = []
+    for n in range(count):
+        start = time.perf_counter()
+        ws.send(json.dumps({'type': 'drive', 'id': n, 't': start, 'command': 'stop', 'speed': 0}))
+        ws.receive()
+        socket.append(time.perf_counter() - start)
+    ws.close()
+
+    for name, samples in (('POST /manual_control', post), ('WebSocket /control_ws', socket)):
+        ms = 1000 * np.array(samples)
+        print("%-22s p50 %.3f  p95 %.3f  p99 %.3f ms" % (
+            name, np.percentile(ms, 50), np.percentile(ms, 95), np.percentile(ms, 99)))
@@ -0,0 +1,290 @@
+'''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''
+@ Filename: vision.py
+@ Version: V1.0
+@ Author: Afandi Azmi
+@ Description: Vision engines for the autonomous modes
+
+Face tracking and line detection helpers used by app.py
+'''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''
+
+
+import time
+from collections import deque
+import cv2
+import numpy as np
+from buffers import BufferPool
+
+
+class RateCounter:
+    "Calls per second and mean duration over a sliding time window"
+    def __init__(self, window=2.0):
+        self.window = window
+        self.samples = deque()
+
+    def add(self, duration):
+        now = time.monotonic()
+        self.samples.append((now, duration))
+        while self.samples and now - self.samples[0][0] > self.window:
+            self.samples.popleft()
+
+    def stats(self):
+        if not self.samples:
+            return 0.0, 0.0
+        span = max(time.monotonic() - self.samples[0][0], 1e-3)
+        fps = len(self.samples) / min(span, self.window) if len(self.samples) > 1 else 0.0
+        mean_ms = 1000 * sum(d for _, d in self.samples) / len(self.samples)
+        return fps, mean_ms
+
+
+class FaceTracker:
+    """Detect-then-track face engine. A full Haar detection (on a downscaled frame) only runs
+    every detect_every frames or once the face is lost; in between, the cascade is re-run on
+    a small region around the last box, which costs a fraction of a full-frame pass."""
+    def __init__(self, cascade, detect_every=10, detect_budget=0.015, max_scale=4.0):
+        self.cascade = cascade
+        self.detect_every = detect_every
+        # Target time for a full detection; the downscale factor adapts to stay under it
+        self.detect_budget = detect_budget
+        self.max_scale = max_scale
+        self.scale = 1.0
+        self.detect_rate = RateCounter()
+        self.track_rate = RateCounter()
+        self.buffers = BufferPool()
+        self.reset()
+
+    def reset(self):
+        self.box = None
+        self.since_detect = 0
+
+    def update(self, gray, images=None):
+        """Returns the face box (x, y, w, h) in frame coordinates, or None. With the frame's
+        FrameImages, the downscaled frame for detection comes from (and stays in) its cache"""
+        if self.box is None or self.since_detect >= self.detect_every:
+            self.box = self._detect(gray, images)
+            self.since_detect = 0
+        else:
+            self.box = self._track(gray)
+            self.since_detect += 1
+            if self.box is None:
+                # Lost it: fall back to a full detection straight away
+                self.box = self._detect(gray, images)
+                self.since_detect = 0
+        return self.box
+
+    def _detect(self, gray, images=None):
+        start = time.perf_counter()
+        small = gray
+        if self.scale > 1.0:
+            h, w = gray.shape
+            size = (max(int(w / self.scale), 1), max(int(h / self.scale), 1))
+            if images is not None:
+                small = images.small(size)
+            else:
+                small = cv2.resize(gray, size, dst=self.buffers.get('small', size[::-1]), interpolation=cv2.INTER_AREA)
+        faces = self.cascade.detectMultiScale(small, 1.3, 5)
+        elapsed = time.perf_counter() - start
+        self.detect_rate.add(elapsed)
+        self._adapt_scale(elapsed)
+        if len(faces) == 0:
+            return None
+        x, y, w, h = faces[0]
+        s = gray.shape[1] / small.shape[1]
+        return (int(x * s), int(y * s), int(w * s), int(h * s))
+
+    def _adapt_scale(self, elapsed):
+        if elapsed > self.detect_budget and self.scale < self.max_scale:
+            self.scale = min(self.scale * 1.25, self.max_scale)
+        elif elapsed < self.detect_budget / 2 and self.scale > 1.0:
+            self.scale = max(self.scale / 1.25, 1.0)
+
+    def _track(self, gray):
+        start = time.perf_counter()
+        x, y, w, h = self.box
+        # Search window: the last box grown by half its size on every side
+        x0, y0 = max(x - w // 2, 0), max(y - h // 2, 0)
+        x1, y1 = min(x + w + w // 2, gray.shape[1]), min(y + h + h // 2, gray.shape[0])
+        roi = gray[y0:y1, x0:x1]
+        faces = self.cascade.detectMultiScale(roi, 1.2, 4, minSize=(w * 2 // 3, h * 2 // 3),
+                                              maxSize=(w * 3 // 2, h * 3 // 2))
+        self.track_rate.add(time.perf_counter() - start)
+        if len(faces) == 0:
+            return None
+        fx, fy, fw, fh = faces[0]
+        return (int(x0 + fx), int(y0 + fy), int(fw), int(fh))
+
+    def stats(self):
+        detect_fps, detect_ms = self.detect_rate.stats()
+        track_fps, track_ms = self.track_rate.stats()
+        return {
+            'detect_fps': round(detect_fps, 1),
+            'detect_ms': round(detect_ms, 2),
+            'track_fps': round(track_fps, 1),
+            'track_ms': round(track_ms, 2),
+            'scale': round(self.scale, 2),
+        }
+
+
+# Predefined line colours as lists of HSV (lower, upper) ranges
+LINE_COLORS = {
+    'black':  [([0, 0, 0],      [180, 255, 60])],
+    'white':  [([0, 0, 200],    [180, 30, 255])],
+    'red':    [([0, 120, 70],   [10, 255, 255]),     # Red wraps around hue
+               ([170, 120, 70], [180, 255, 255])],
+    'red2':   [([170, 120, 70], [180, 255, 255])],   # Red second range
+    'blue':   [([100, 100, 50], [130, 255, 255])],
+    'green':  [([40, 50, 50],   [80, 255, 255])],
+    'yellow': [([20, 100, 100], [40, 255, 255])],
+    'orange': [([10, 100, 100], [25, 255, 255])],
+}
+
+
+class ColorLUT:
+    """Lookup table over quantized YUV that says whether a pixel falls inside any of a set of
+    HSV ranges. It is indexed straight from the lores YUV420 planes at chroma resolution, so
+    line segmentation needs neither the YUV->BGR nor the BGR->HSV conversion, nor one
+    inRange pass per range. Hue wrap-around (red) is just a second range."""
+    def __init__(self, ranges, bits=6):
+        self.ranges = [(tuple(lower), tuple(upper)) for lower, upper in ranges]
+        self.bits = bits
+        shift = 8 - bits
+        # Classify the centre of every quantization cell once, through the same YUV->BGR->HSV path
+        levels = (np.arange(1 << bits, dtype=np.uint16) << shift) + ((1 << shift) >> 1)
+        y, u, v = np.meshgrid(levels, levels, levels, indexing='ij')
+        cells = np.stack([y, u, v], axis=-1).astype(np.uint8).reshape(-1, 1, 3)
+        hsv = cv2.cvtColor(cv2.cvtColor(cells, cv2.COLOR_YUV2BGR), cv2.COLOR_BGR2HSV)
+        table = np.zeros(len(cells), np.uint8)
+        for lower, upper in self.ranges:
+            table |= cv2.inRange(hsv, np.array(lower), np.array(upper)).reshape(-1)
+        self.table = table
+        self.buffers = BufferPool()
+
+    def apply(self, yuv, size, top=0):
+        """0/255 mask of rows top..height of a YUV420 (I420) frame, at full resolution.
+        Everything is computed in preallocated buffers; the mask is overwritten by the next call."""
+        w, h = size
+        shift = 8 - self.bits
+        # Chroma planes are quarter size; sample Y at the same positions
+        u = yuv[h:h + h // 4].reshape(h // 2, w // 2)[top // 2:]
+        v = yuv[h + h // 4:h * 3 // 2].reshape(h // 2, w // 2)[top // 2:]
+        luma = yuv[top:h:2, 0:w:2]
+        # Index arithmetic in intp: mixed-dtype ufuncs and take() would allocate casting buffers
+        index = self.buffers.get('index', luma.shape, np.intp)
+        part = self.buffers.get('part', luma.shape, np.intp)
+        np.copyto(index, luma)
+        np.right_shift(index, shift, out=index)
+        np.left_shift(index, 2 * self.bits, out=index)
+        np.copyto(part, u)
+        np.right_shift(part, shift, out=part)
+        np.left_shift(part, self.bits, out=part)
+        np.bitwise_or(index, part, out=index)
+        np.copyto(part, v)
+        np.right_shift(part, shift, out=part)
+        np.bitwise_or(index, part, out=index)
+        # mode='clip' (indexes are always in range) lets take() write straight into out
+        small = np.take(self.table, index, out=self.buffers.get('small', luma.shape), mode='clip')
+        return cv2.resize(small, (w, h - top), dst=self.buffers.get('mask', (h - top, w)),
+                          interpolation=cv2.INTER_NEAREST)
+
+
+_lut_cache = {}
+
+def get_color_lut(ranges, bits=6):
+    "Compiled ColorLUT for a list of (lower, upper) HSV ranges, cached by colour configuration"
+    key = (tuple((tuple(lower), tuple(upper)) for lower, upper in ranges), bits)
+    if key not in _lut_cache:
+        _lut_cache[key] = ColorLUT(ranges, bits)
+    return _lut_cache[key]
+
+
+def hsv_mask(bgr, ranges):
+    "Reference segmentation: HSV conversion plus one inRange per range"
+    hsv = cv2.cvtColor(bgr, cv2.COLOR_BGR2HSV)
+    mask = cv2.inRange(hsv, np.array(ranges[0][0]), np.array(ranges[0][1]))
+    for lower, upper in ranges[1:]:
+        mask = cv2.bitwise_or(mask, cv2.inRange(hsv, np.array(lower), np.array(upper)))
+    return mask
+
+
+def benchmark_color_lut(yuv, size, ranges, top=0, repeats=200, bits=6):
+    """Times the old path (I420->BGR, crop, HSV, inRange per range) against the LUT on one
+    YUV420 frame; returns ms per frame and the fraction of mask pixels that agree"""
+    w, h = size
+    lut = get_color_lut(ranges, bits)
+    start = time.perf_counter()
+    for _ in range(repeats):
+        bgr = cv2.cvtColor(yuv[:h * 3 // 2, :w], cv2.COLOR_YUV2BGR_I420)
+        reference = hsv_mask(bgr[top:h], ranges)
+    hsv_ms = 1000 * (time.perf_counter() - start) / repeats
+    start = time.perf_counter()
+    for _ in range(repeats):
+        mask = lut.apply(yuv, size, top)
+    lut_ms = 1000 * (time.perf_counter() - start) / repeats
+    return {
+        'hsv_ms': round(hsv_ms, 3),
+        'lut_ms': round(lut_ms, 3),
+        'agreement': round(float(np.mean(mask == reference)), 4),
+    }
+
+
+
+def scan_line(mask, bands=4, min_fraction=0.05, lookahead=0.3):
+    """Scanline line detector: column-sum histograms over horizontal bands of a 0/255 mask,
+    all bands in one NumPy pass. Bands run from far (top) to near (bottom). Returns the line
+    centre per band (None where the band is empty), a lookahead steering target, the
+    curvature of the centres and a junction flag (several separate runs, or a band that is
+    mostly line)."""
+    h, w = mask.shape
+    rows = h // bands
+    # Drop leftover rows at the top so the nearest band touches the bottom edge
+    # int64: the column-weighted moment grows as rows * 255 * w^2 / 2 and overflows 32 bits
+    # at the larger lores sizes
+    hist = mask[h - rows * bands:].reshape(bands, rows, w).sum(axis=1, dtype=np.int64)
+    weight = hist.sum(axis=1)
+    moment = hist @ np.arange(w, dtype=np.int64)
+    min_weight = min_fraction * rows * w * 255
+
+    # Columns where the band is at least a third full; rising edges count separate runs
+    on = hist * 3 >= rows * 255
+    edges = np.count_nonzero(on[:, 1:] > on[:, :-1], axis=1) + on[:, 0]
+    coverage = np.count_nonzero(on, axis=1)
+
+    centers = []
+    junction = False
+    for band in range(bands):
+        if weight[band] < min_weight:
+            centers.append(None)
+            continue
+        centers.append(float(moment[band]) / float(weight[band]))
+        if edges[band] > 1 or coverage[band] * 2 > w:
+            junction = True
+
+    found = [c for c in centers if c is not None]
+    near = found[-1] if found else None
+    target = None
+    if near is not None:
+        target = (1 - lookahead) * near + lookahead * found[0]
+    # Second difference of the band centres: ~0 on straights, sign gives the bend direction
+    curvature = 0.0
+    if len(found) >= 3:
+        curvature = (found[-1] - found[-2] - found[1] + found[0]) / (len(found) - 2)
+    return {
+        'centers': centers,
+        'band_height': rows,
+        'near': near,
+        'target': target,
+        'curvature': curvature,
+        'junction': junction,
+    }
+
+if __name__ == '__main__':
+    # python vision.py [image]: LUT vs HSV segmentation timings for every predefined colour
+    import sys
+    size = (320, 240)
+    if len(sys.argv) > 1:
+        bgr = cv2.resize(cv2.imread(sys.argv[1]), size)
+    else:
+        bgr = np.full((size[1], size[0], 3), 180, np.uint8)
+        cv2.rectangle(bgr, (140, 100), (180, 240), (20, 20, 20), -1)
+    yuv = cv2.cvtColor(bgr, cv2.COLOR_BGR2YUV_I420)
+    for name, ranges in LINE_COLORS.items():
+        print(name, benchmark_color_lut(yuv, size, ranges, top=150))
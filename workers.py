@@ -0,0 +1,354 @@
+'''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''
+@ Filename: workers.py
+@ Version: V1.0
+@ Author: Afandi Azmi
+@ Description: Vision and encoding worker processes
+
+Moves detection and JPEG encoding off the Flask process onto the other cores
+'''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''
+
+
+import time
+import atexit
+import threading
+import multiprocessing
+from multiprocessing import shared_memory
+import cv2
+import numpy as np
+from pipeline import FrameContext, LatencyStats
+from buffers import FrameImages
+
+
+# Modes whose compute stages keep state between frames (the face tracker) always run on worker 0
+PINNED_MODES = ('FACE_TRACK', 'FACE_PAN_TILT')
+
+
+class SharedFrameRing:
+    """Fixed-size frame slots in one shared-memory block. The owning process copies a frame
+    into a free slot and sends only the slot number to a worker; the slot stays taken until
+    the worker's reply comes back, so a worker never reads a slot being overwritten."""
+    def __init__(self, slots, slot_bytes):
+        self.slots = slots
+        self.slot_bytes = slot_bytes
+        self.shm = shared_memory.SharedMemory(create=True, size=slots * slot_bytes)
+        self.name = self.shm.name
+        self.free = list(range(slots))
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        "A free slot number, or None when every slot is still with a worker"
+        with self.lock:
+            return self.free.pop(0) if self.free else None
+
+    def release(self, slot):
+        with self.lock:
+            self.free.append(slot)
+
+    def view(self, slot, shape):
+        return np.ndarray(shape, np.uint8, self.shm.buf, slot * self.slot_bytes)
+
+    def close(self):
+        self.shm.close()
+        try:
+            self.shm.unlink()
+        except FileNotFoundError:
+            pass
+
+
+def _attach(name, slot_bytes):
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, lambda slot, shape: np.ndarray(shape, np.uint8, shm.buf, slot * slot_bytes)
+
+
+def _vision_worker(conn, ring_name, slot_bytes, cascade):
+    # Runs in the worker process: builds its own modes and runs their compute stages
+    from vision import FaceTracker, get_color_lut, LINE_COLORS
+    from modes import FaceTrackMode, LineFollowMode
+    cv2.setNumThreads(1)
+    shm, view = _attach(ring_name, slot_bytes)
+    images = FrameImages()
+    face_mode = FaceTrackMode(FaceTracker(cv2.CascadeClassifier(cascade), detect_every=10))
+    modes = {
+        'FACE_TRACK': face_mode,
+        # Only the compute stages run here, and those are FACE_TRACK's
+        'FACE_PAN_TILT': face_mode,
+        'LINE_FOLLOW': LineFollowMode(get_color_lut(LINE_COLORS['black'])),
+    }
+    try:
+        while True:
+            message = conn.recv()
+            if message is None:
+                break
+            if message[0] == 'config':
+                config = message[1]
+                modes['LINE_FOLLOW'].lut = get_color_lut(config['ranges'])
+                modes['LINE_FOLLOW'].detector = config['detector']
+                continue
+            if message[0] == 'reset':
+                face_mode.tracker.reset()
+                continue
+            slot, seq, mode, (w, h) = message
+            start = time.perf_counter_ns()
+            ctx = FrameContext(mode, lores=view(slot, (h * 3 // 2, w)), size=(w, h), images=images)
+            for name, func in modes[mode].compute_stages():
+                func(ctx)
+            result = {field: getattr(ctx, field) for field in modes[mode].RESULT}
+            del ctx
+            # The tracker only lives here, so its stats travel back with its results
+            tracker = face_mode.tracker.stats() if mode in PINNED_MODES else None
+            conn.send((slot, seq, mode, result, time.perf_counter_ns() - start, tracker))
+    except (EOFError, KeyboardInterrupt):
+        pass
+    finally:
+        shm.close()
+
+
+def _encode_worker(conn, ring_name, slot_bytes, quality):
+    cv2.setNumThreads(1)
+    shm, view = _attach(ring_name, slot_bytes)
+    params = [cv2.IMWRITE_JPEG_QUALITY, quality]
+    try:
+        while True:
+            message = conn.recv()
+            if message is None:
+                break
+            slot, seq, shape = message
+            start = time.perf_counter_ns()
+            jpeg = cv2.imencode('.jpg', view(slot, shape), params)[1].tobytes()
+            conn.send((slot, seq, jpeg, time.perf_counter_ns() - start))
+    except (EOFError, KeyboardInterrupt):
+        pass
+    finally:
+        shm.close()
+
+
+def _context():
+    # fork: the app's module-level hardware setup must not run again in the workers,
+    # which spawn/forkserver would do by re-importing the main module
+    return multiprocessing.get_context('fork')
+
+
+class VisionPool:
+    """Worker processes running the compute stages (segmentation, detection) of the vision
+    modes on frames from a shared-memory ring. Results come back over pipes and only the
+    newest one counts: replies for frames older than one already applied are dropped. The
+    stateful face tracker always runs on worker 0 so it sees frames in order."""
+    def __init__(self, workers, frame_size=(320, 240), slots=None, cascade='./image/haarcascade_frontalface_default.xml'):
+        w, h = frame_size
+        self.frame_bytes = w * h * 3 // 2
+        self.ring = SharedFrameRing(slots or 2 * workers, self.frame_bytes)
+        self.conns = []
+        self.procs = []
+        self.inflight = [0] * workers
+        context = _context()
+        for i in range(workers):
+            parent, child = context.Pipe()
+            proc = context.Process(target=_vision_worker, name='vision-%d' % i, daemon=True,
+                                   args=(child, self.ring.name, self.ring.slot_bytes, cascade))
+            proc.start()
+            child.close()
+            self.conns.append(parent)
+            self.procs.append(proc)
+        self.alive = True
+        self.config = None
+        self.tracker_stats = None
+        self.newest_seq = 0
+        self.newest = None
+        self.consumed_seq = 0
+        self.submitted = 0
+        self.completed = 0
+        self.dropped = 0
+        self.superseded = 0
+        self.compute = LatencyStats()
+        self.round_trip = LatencyStats()
+        self.sent_at = {}
+        atexit.register(self.close)
+
+    def configure(self, config):
+        "Sends LINE_FOLLOW settings ({'ranges', 'detector'}) to every worker when they change"
+        if config == self.config:
+            return
+        self.config = dict(config)
+        for conn in self.conns:
+            conn.send(('config', self.config))
+
+    def reset(self):
+        "Forgets the face tracker's state on worker 0, e.g. when the mode changes"
+        if self.conns:
+            self.conns[0].send(('reset',))
+
+    def accepts(self, size):
+        "False for frames larger than the ring slots"
+        w, h = size
+        return w * h * 3 // 2 <= self.frame_bytes
+
+    def submit(self, mode, seq, lores, size):
+        "Copies the frame into the ring and queues it; False (frame dropped) if the ring is full"
+        w, h = size
+        slot = self.ring.acquire()
+        if slot is None:
+            self.dropped += 1
+            return False
+        np.copyto(self.ring.view(slot, (h * 3 // 2, w)), lores[:h * 3 // 2, :w])
+        if mode in PINNED_MODES:
+            worker = 0
+        else:
+            worker = min(range(len(self.conns)), key=self.inflight.__getitem__)
+        self.inflight[worker] += 1
+        self.sent_at[slot] = time.perf_counter_ns()
+        self.conns[worker].send((slot, seq, mode, (w, h)))
+        self.submitted += 1
+        return True
+
+    def poll(self, timeout=0.0):
+        "Receives every finished result (waiting up to timeout for the first); returns them all"
+        results = []
+        ready = multiprocessing.connection.wait(self.conns, timeout)
+        for conn in ready:
+            worker = self.conns.index(conn)
+            while True:
+                try:
+                    if not conn.poll():
+                        break
+                    slot, seq, mode, result, compute_ns, tracker = conn.recv()
+                except (EOFError, OSError):
+                    print(f"Vision worker {worker} exited")
+                    self.alive = False
+                    break
+                self.round_trip.add(time.perf_counter_ns() - self.sent_at.pop(slot))
+                self.ring.release(slot)
+                self.inflight[worker] -= 1
+                self.completed += 1
+                self.compute.add(compute_ns)
+                if tracker is not None:
+                    self.tracker_stats = tracker
+                if seq > self.newest_seq:
+                    self.newest_seq = seq
+                    self.newest = (seq, mode, result)
+                else:
+                    self.superseded += 1
+                results.append((seq, mode, result))
+        return results
+
+    def latest(self, mode, seq=0, timeout=0.0):
+        """The newest result not handed out yet, if it is for mode; None otherwise.
+        Waits up to timeout for the result of frame seq to come back first."""
+        deadline = time.monotonic() + timeout
+        self.poll()
+        while self.newest_seq < seq and self.alive:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            self.poll(remaining)
+        if self.newest is None or self.newest_seq <= self.consumed_seq:
+            return None
+        self.consumed_seq = self.newest_seq
+        seq, result_mode, result = self.newest
+        return result if result_mode == mode else None
+
+    def busy(self):
+        return sum(self.inflight)
+
+    def stats(self):
+        return {
+            'workers': len(self.procs),
+            'alive': self.alive,
+            'submitted': self.submitted,
+            'completed': self.completed,
+            'dropped': self.dropped,
+            'superseded': self.superseded,
+            'in_flight': self.busy(),
+            'compute': self.compute.stats(),
+            'round_trip': self.round_trip.stats(),
+        }
+
+    def close(self):
+        for conn in self.conns:
+            try:
+                conn.send(None)
+            except (OSError, ValueError):
+                pass
+        for proc in self.procs:
+            proc.join(timeout=1.0)
+        self.conns = []
+        self.procs = []
+        self.ring.close()
+
+
+class EncodeWorker:
+    """JPEG encoding in its own process. submit() copies the viewer frame into a shared
+    slot and returns at once; a receiver thread hands finished JPEGs to on_jpeg(jpeg, seconds)
+    in frame order, dropping any that arrive after a newer one."""
+    def __init__(self, frame_size=(640, 480), on_jpeg=None, slots=2, quality=95):
+        w, h = frame_size
+        self.frame_bytes = w * h * 3
+        self.ring = SharedFrameRing(slots, self.frame_bytes)
+        self.on_jpeg = on_jpeg
+        context = _context()
+        self.conn, child = context.Pipe()
+        self.proc = context.Process(target=_encode_worker, name='encoder', daemon=True,
+                                    args=(child, self.ring.name, self.ring.slot_bytes, quality))
+        self.proc.start()
+        child.close()
+        self.send_lock = threading.Lock()
+        self.alive = True
+        self.seq = 0
+        self.published_seq = 0
+        self.submitted = 0
+        self.encoded = 0
+        self.dropped = 0
+        self.thread = threading.Thread(target=self._receive, daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def accepts(self, image):
+        "False when the image has to be encoded in-process (encoder gone, frame too large)"
+        return self.alive and image.nbytes <= self.frame_bytes
+
+    def submit(self, image):
+        "Queues image (HxWx3 uint8) for encoding; False when the encoder is busy and it was dropped"
+        slot = self.ring.acquire()
+        if slot is None:
+            self.dropped += 1
+            return False
+        np.copyto(self.ring.view(slot, image.shape), image)
+        with self.send_lock:
+            self.seq += 1
+            self.conn.send((slot, self.seq, image.shape))
+            self.submitted += 1
+        return True
+
+    def _receive(self):
+        while True:
+            try:
+                slot, seq, jpeg, encode_ns = self.conn.recv()
+            except (EOFError, OSError):
+                self.alive = False
+                return
+            self.ring.release(slot)
+            self.encoded += 1
+            if seq <= self.published_seq:
+                continue
+            self.published_seq = seq
+            if self.on_jpeg:
+                self.on_jpeg(jpeg, encode_ns / 1e9)
+
+    def stats(self):
+        return {
+            'alive': self.alive,
+            'submitted': self.submitted,
+            'encoded': self.encoded,
+            'dropped': self.dropped,
+        }
+
+    def close(self):
+        if self.proc is None:
+            return
+        try:
+            with self.send_lock:
+                self.conn.send(None)
+        except (OSError, ValueError):
+            pass
+        self.proc.join(timeout=1.0)
+        self.proc = None
+        self.ring.close()